@@ -4,6 +4,8 @@ from pathlib import Path
 import os
 from nilearn.image import smooth_img
 
+from bids_index import open_index
+
 
 DEFAULT_BASE = Path("/root/data")
 DEFAULT_SES = os.getenv("SESSION", "ses-01")
@@ -32,10 +34,11 @@ def main() -> int:
         "thresholded_tissue_segment_z_scores_native",
     ]
     suffix = f"_s{args.fwhm:g}"
+    index = open_index(args.base_dir)
     targets = []
     for analysis in analysis_dirs:
         pattern = f"*/{args.session}/{analysis}/{DEFAULT_GLOB}"
-        targets.extend(args.base_dir.glob(pattern))
+        targets.extend(index.glob(pattern))
 
     if not targets:
         print(f"No composite maps found under {args.base_dir} for {args.session}.")
@@ -1,15 +1,26 @@
 import argparse
+import hashlib
 import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import numpy as np
 import nibabel as nib
 from scipy.ndimage import map_coordinates
 
+from clean_atrophy import clean_values, get_mask
+from mapped_nifti import map_image_data
+from stats_cache import publish_mode
+
+PLAN_VERSION = 1
+
 
 class ImageLoader:
-    def __init__(self, path: str):
+    def __init__(self, path: str, dtype=np.float64):
         self.path = path
         self.img = nib.load(path)
-        self.data = self.img.get_fdata()
+        self.data = self.img.get_fdata(dtype=dtype)
         self.affine = self.img.affine
         self.shape = self.data.shape[:3]
 
@@ -29,11 +40,15 @@ class WarpField:
     Guarantees:
     - self.field has shape (X, Y, Z, 3)
     - values are absolute world coordinates (mm)
+
+    The field keeps its on-disk dtype (float32 for CAT12/SPM) and is memory-mapped (see
+    mapped_nifti.map_image_data; a .nii.gz is inflated once into a temp file), so slabs are read from
+    disk only when they are sampled and the field never sits in anonymous memory.
     """
     def __init__(self, path: str):
         self.path = path
         self.img = nib.load(path)
-        raw = self.img.get_fdata()
+        raw = map_image_data(self.img)
 
         # Normalize shape
         raw = np.squeeze(raw)
@@ -47,23 +62,142 @@ class WarpField:
         self.affine = self.img.affine
         self.shape = raw.shape[:3]
 
-    def get_world_coords(self):
+    def get_world_coords(self, zs: slice = slice(None)):
+        """World coordinates of the whole grid, or of the z-slab zs."""
         return (
-            self.field[..., 0],
-            self.field[..., 1],
-            self.field[..., 2],
+            self.field[:, :, zs, 0],
+            self.field[:, :, zs, 1],
+            self.field[:, :, zs, 2],
         )
 
+    def cache_key(self) -> str:
+        st = os.stat(self.path)
+        return f"{os.path.abspath(self.path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+class AffineMap:
+    """
+    World-to-world pull step: output-side mm -> input-side mm via a 4x4 matrix
+    (e.g. a rigid/affine registration, or its inverse).
+    """
+    def __init__(self, matrix: np.ndarray, name: str = "affine"):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        if self.matrix.shape != (4, 4):
+            raise ValueError(f"Affine must be 4x4. Got {self.matrix.shape}")
+        self.name = name
+
+    @classmethod
+    def from_file(cls, path: str, invert: bool = False) -> "AffineMap":
+        matrix = np.loadtxt(path)
+        return cls(np.linalg.inv(matrix) if invert else matrix, name=f"{'inverse ' if invert else ''}{path}")
+
+    def __call__(self, xyz: np.ndarray) -> np.ndarray:
+        return self.matrix[:3, :3] @ xyz + self.matrix[:3, 3:]
+
+    def cache_key(self) -> str:
+        return f"affine:{self.matrix.tobytes().hex()}"
+
+
+class DeformationMap:
+    """
+    World-to-world pull step through a deformation field evaluated at arbitrary points.
+    Each field component is interpolated trilinearly. Points outside the field give NaN, and
+    map_coordinates then samples NaN coordinates as cval. Components are strided views of the
+    memory-mapped field, not copies; map_coordinates reads them in place.
+    """
+    def __init__(self, warp: WarpField):
+        self.warp = warp
+        self.inv_affine = np.linalg.inv(warp.affine)
+        self.components = [warp.field[..., c] for c in range(3)]
+
+    def __call__(self, xyz: np.ndarray) -> np.ndarray:
+        ijk = self.inv_affine[:3, :3] @ xyz + self.inv_affine[:3, 3:]
+        return np.stack([
+            map_coordinates(comp, ijk, order=1, mode="constant", cval=np.nan, output=np.float64)
+            for comp in self.components
+        ])
+
+    def cache_key(self) -> str:
+        return f"field:{self.warp.cache_key()}"
+
+
+class ComposedWarp:
+    """
+    A chain of registration/resampling steps collapsed into one sampling grid, usable wherever a
+    WarpField is (WarpApplier, coordinate plans).
+
+    Output voxels on (shape, affine) are mapped to world mm, then through each step in order from
+    the output side back to the source: AffineMap or DeformationMap. WarpApplier then maps the
+    result into the source image's voxels. Pure regridding steps (resample_to_target.py,
+    run_resample_bids.py) are the identity in world space and need no step; the final grid is
+    simply the last target. The whole chain costs one interpolation of the image. If the first
+    step is a deformation field on the output grid itself, its values are read directly, as
+    WarpField does.
+
+    Deformation steps interpolate their memory-mapped fields in place (see DeformationMap), so the
+    chain adds only per-slab temporaries (output voxel indices and float64 world coordinates, about
+    48 bytes per slab voxel) to the WarpApplier peak, however many fields it composes.
+    """
+    def __init__(self, shape, affine: np.ndarray, steps: list):
+        self.shape = tuple(int(n) for n in shape[:3])
+        self.affine = np.asarray(affine, dtype=np.float64)
+        self.steps = list(steps)
+        self.direct = None
+        first = self.steps[0] if self.steps else None
+        if isinstance(first, DeformationMap) and first.warp.shape == self.shape and np.allclose(first.warp.affine, self.affine):
+            self.direct, self.steps = first.warp, self.steps[1:]
+
+    def get_world_coords(self, zs: slice = slice(None)):
+        """Source-side world coordinates of the whole output grid, or of the z-slab zs."""
+        ks = np.arange(self.shape[2])[zs]
+        slab_shape = (self.shape[0], self.shape[1], len(ks))
+        if self.direct is not None:
+            xyz = np.stack([c.reshape(-1) for c in self.direct.get_world_coords(zs)]).astype(np.float64)
+        else:
+            ijk = np.stack(np.meshgrid(np.arange(self.shape[0]), np.arange(self.shape[1]), ks, indexing="ij")).reshape(3, -1)
+            xyz = self.affine[:3, :3] @ ijk + self.affine[:3, 3:]
+        for step in self.steps:
+            xyz = step(xyz)
+        return tuple(c.reshape(slab_shape) for c in xyz)
+
+    def cache_key(self) -> str:
+        parts = [str(self.shape), self.affine.tobytes().hex()]
+        if self.direct is not None:
+            parts.append(f"field:{self.direct.cache_key()}")
+        return "|".join(parts + [step.cache_key() for step in self.steps])
+
 
 class WarpApplier:
     """
     Applies a WarpField to an ImageLoader source image
     using pull-based resampling.
+
+    The output grid is processed in z-slabs of `slab` planes. Each slab's world coordinates are
+    mapped to source voxels and sampled on their own, so the coordinate temporaries scale with one
+    slab instead of the whole field. Per-voxel arithmetic is unchanged, so the output is identical to
+    transforming the full grid at once.
+
+    Peak memory is not bounded by the slab: the source image (float64, interpolated at arbitrary
+    points) and the float32 output volume are held whole, plus an in-memory plan of 12 bytes per
+    output voxel when one is built without a cache directory. The warp field itself is memory-mapped
+    (see WarpField) and only its pages are resident.
+
+    For several images on the same source grid, build_plan() computes the source-voxel coordinates
+    once as a (3, X, Y, Z) float32 plan, optionally memory-mapped from a cache directory. Every
+    later sample() only interpolates. Plan coordinates are rounded to float32, so plan-based
+    outputs can differ from the direct path in the last bits.
+
+    With threads > 1, slabs are transformed and sampled concurrently into the shared output volume.
+    map_coordinates releases the GIL, and slabs write disjoint z-ranges, so no locking is needed and
+    the result does not depend on the thread count.
     """
-    def __init__(self, source: ImageLoader, warp: WarpField):
+    def __init__(self, source: ImageLoader, warp: WarpField, slab: int = 8, threads: int = 1):
         self.source = source
         self.warp = warp
+        self.slab = max(1, slab)
+        self.threads = max(1, threads)
         self.inv_source_affine = np.linalg.inv(source.affine)
+        self.plan = None
 
     def world_to_source_voxels(self, xw, yw, zw):
         world = np.vstack([
@@ -79,42 +213,162 @@ class WarpApplier:
             vox[2].reshape(xw.shape),
         )
 
+    def slabs(self):
+        """z-slices covering the output grid."""
+        depth = self.warp.shape[2]
+        for z0 in range(0, depth, self.slab):
+            yield slice(z0, min(z0 + self.slab, depth))
+
+    def source_voxels(self, zs: slice):
+        """Source-voxel coordinates of one slab, from the plan if there is one."""
+        if self.plan is not None:
+            return self.plan[:, :, :, zs]
+        return self.world_to_source_voxels(*self.warp.get_world_coords(zs))
+
+    def plan_key(self) -> str:
+        """Identifies a plan by the warp (file path, size and mtime of every field; affines; grid) and the source grid."""
+        h = hashlib.sha256(f"warp-plan-v{PLAN_VERSION}:{self.warp.cache_key()}".encode())
+        h.update(np.asarray(self.source.affine, dtype=np.float64).tobytes())
+        h.update(str(tuple(self.source.shape)).encode())
+        return h.hexdigest()
+
+    def build_plan(self, cache_dir: str | None = None) -> np.ndarray:
+        """
+        Compute (or map from cache_dir) the (3, X, Y, Z) float32 source-voxel plan and use it from now on.
+        New cache files are filled slab by slab in a memmap and renamed into place when complete.
+        """
+        shape = (3,) + tuple(self.warp.shape)
+        if cache_dir is None:
+            plan = np.empty(shape, dtype=np.float32)
+            for zs in self.slabs():
+                plan[:, :, :, zs] = self.world_to_source_voxels(*self.warp.get_world_coords(zs))
+            self.plan = plan
+            return plan
+
+        path = Path(cache_dir) / f"warpplan-{self.plan_key()[:24]}.npy"
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            os.close(fd)
+            try:
+                plan = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=shape)
+                for zs in self.slabs():
+                    plan[:, :, :, zs] = self.world_to_source_voxels(*self.warp.get_world_coords(zs))
+                plan.flush()
+                del plan
+                os.chmod(tmp, publish_mode(path))
+                os.replace(tmp, path)
+            except BaseException:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+        self.plan = np.load(path, mmap_mode="r")
+        if self.plan.shape != shape:
+            raise ValueError(f"Cached plan {path} has shape {self.plan.shape}; expected {shape}")
+        return self.plan
+
+    def sample(self, data: np.ndarray, order: int = 1, cval: float = 0.0) -> np.ndarray:
+        """Pull `data` (on the source grid) through the warp, slab by slab, into a float32 volume."""
+        warped = np.empty(self.warp.shape, dtype=np.float32)
+
+        def _sample_slab(zs: slice) -> None:
+            xi, yi, zi = self.source_voxels(zs)
+            warped[:, :, zs] = map_coordinates(
+                data,
+                [xi, yi, zi],
+                order=order,
+                mode="constant",
+                cval=cval,
+            )
+
+        if self.threads == 1:
+            for zs in self.slabs():
+                _sample_slab(zs)
+        else:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                list(pool.map(_sample_slab, self.slabs()))
+        return warped
+
+    def benchmark(self, threads: int, order: int = 1, repeats: int = 3) -> dict:
+        """Best-of-`repeats` sample() time on self.source at 1 thread and at `threads`, and whether outputs match."""
+        timings, outputs = {}, {}
+        saved = self.threads
+        try:
+            for n in sorted({1, max(1, threads)}):
+                self.threads = n
+                best = np.inf
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    outputs[n] = self.sample(self.source.data, order=order)
+                    best = min(best, time.perf_counter() - start)
+                timings[n] = best
+        finally:
+            self.threads = saved
+        n = max(timings)
+        return {
+            "threads": n,
+            "single_thread_seconds": timings[1],
+            "threaded_seconds": timings[n],
+            "speedup": timings[1] / timings[n],
+            "identical": bool(np.array_equal(outputs[1], outputs[n])),
+        }
+
     def apply(
         self,
         out_path: str,
         out_affine: np.ndarray | None = None,
         interp: str = "linear",
         cval: float = 0.0,
+        source: ImageLoader | None = None,
     ):
+        """Warp self.source, or another image on the same grid (reusing the plan), and save it."""
         order = 0 if interp == "nearest" else 1
+        if source is None:
+            source = self.source
+        elif source.shape != self.source.shape or not np.allclose(source.affine, self.source.affine):
+            raise ValueError(f"{source.path} is not on the grid of {self.source.path}")
 
-        xw, yw, zw = self.warp.get_world_coords()
-        xi, yi, zi = self.world_to_source_voxels(xw, yw, zw)
-
-        warped = map_coordinates(
-            self.source.data,
-            [xi, yi, zi],
-            order=order,
-            mode="constant",
-            cval=cval,
-        )
+        warped = self.sample(source.data, order=order, cval=cval)
 
         if out_affine is None:
             out_affine = self.warp.affine
 
         nib.save(
-            nib.Nifti1Image(warped.astype(np.float32), out_affine),
+            nib.Nifti1Image(warped, out_affine),
             out_path,
         )
 
 
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
-        description="Apply a deformation field to an image."
+        description="Apply a deformation field, or a composed chain of transforms, to images in one interpolation."
+    )
+    parser.add_argument("--i", required=True, nargs="+", help="Input image(s) to warp.")
+    parser.add_argument("--o", required=True, nargs="+", help="Output warped image(s), one per input.")
+    parser.add_argument("--field", default=None, help="Warp field (iy*.nii). Same as a leading --step field:PATH.")
+    parser.add_argument(
+        "--step",
+        action="append",
+        default=[],
+        metavar="KIND:PATH",
+        help="Transform step, listed from the output side back to the source. KIND is field (deformation "
+             "with absolute mm values), affine (4x4 text matrix mapping output-side mm to input-side mm) "
+             "or affine-inv (the inverse of such a matrix). Repeatable; the whole chain is sampled once.",
+    )
+    parser.add_argument(
+        "--grid",
+        default=None,
+        help="Image defining the output grid (default: the grid of the first field).",
+    )
+    parser.add_argument(
+        "--clean-mask",
+        default=None,
+        help="Clean each input in memory as clean_atrophy.py does (NaN outside this source-grid mask) before warping.",
+    )
+    parser.add_argument(
+        "--clean-limit",
+        default="false",
+        help="With --clean-mask: limit values to 2-5 as clean_atrophy.py --l (true/false).",
     )
-    parser.add_argument("--i", required=True, help="Input image to warp.")
-    parser.add_argument("--o", required=True, help="Output warped image.")
-    parser.add_argument("--field", required=True, help="Warp field (iy*.nii).")
     parser.add_argument(
         "--interp",
         choices=["linear", "nearest"],
@@ -127,19 +381,91 @@ def build_parser() -> argparse.ArgumentParser:
         default=0.0,
         help="Constant fill value for out-of-bounds.",
     )
+    parser.add_argument(
+        "--slab",
+        type=int,
+        default=8,
+        help="z-planes of the output grid transformed and sampled at a time (bounds the coordinate temporaries).",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Slabs sampled concurrently (default: 1).",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="Time sampling at 1 thread and at --threads on the first input and exit without writing.",
+    )
+    parser.add_argument(
+        "--plan-cache",
+        default=None,
+        help="Directory for memory-mapped coordinate plans, reused by later warps with the same field and source grid. "
+             "A plan (also built in memory for several --i) holds float32 source coordinates, so its output differs "
+             "from a single unplanned warp by float32 rounding (~6e-6). Plans are ~12 bytes per "
+             "output voxel; keep the cache out of the data tree.",
+    )
     return parser
 
+
+def build_warp(args: argparse.Namespace):
+    """A plain WarpField for --field alone; otherwise the --field/--step chain on the --grid as a ComposedWarp."""
+    if args.field and not args.step and not args.grid:
+        return WarpField(args.field)
+    specs = ([f"field:{args.field}"] if args.field else []) + args.step
+    steps = []
+    for spec in specs:
+        kind, _, path = spec.partition(":")
+        if kind == "field":
+            steps.append(DeformationMap(WarpField(path)))
+        elif kind in ("affine", "affine-inv"):
+            steps.append(AffineMap.from_file(path, invert=kind == "affine-inv"))
+        else:
+            raise SystemExit(f"Unknown step {spec!r}; use field:PATH, affine:PATH or affine-inv:PATH.")
+    if args.grid:
+        ref = nib.load(args.grid)
+        shape, affine = ref.shape[:3], ref.affine
+    elif steps and isinstance(steps[0], DeformationMap):
+        shape, affine = steps[0].warp.shape, steps[0].warp.affine
+    else:
+        raise SystemExit("--grid is required unless the chain starts with a field.")
+    return ComposedWarp(shape, affine, steps)
+
+
 def run_pipeline(args: argparse.Namespace) -> None:
     """Orchestrates the classes and pipeline"""
-    source = ImageLoader(args.i)
-    warp = WarpField(args.field)
-    applier = WarpApplier(source, warp)
-    applier.apply(
-        out_path=args.o,
-        interp=args.interp,
-        cval=args.cval,
-    )
-    
+    if len(args.i) != len(args.o):
+        raise SystemExit(f"Got {len(args.i)} inputs but {len(args.o)} outputs.")
+    warp = build_warp(args)
+    # The clean mask is only ever a boolean (1 byte per voxel); cleaned inputs are loaded as float32, as
+    # clean_atrophy.py loads them, and cleaned in place rather than through a float64 copy.
+    clean_mask = get_mask(map_image_data(nib.load(args.clean_mask))) if args.clean_mask else None
+    appliers = {}                                         # one plan per source grid
+    for in_path, out_path in zip(args.i, args.o):
+        source = ImageLoader(in_path, dtype=np.float32 if clean_mask is not None else np.float64)
+        if clean_mask is not None:
+            source.data = clean_values(source.data, clean_mask, args.clean_limit)
+        grid = (source.shape, source.affine.tobytes())
+        applier = appliers.get(grid)
+        if applier is None:
+            applier = appliers[grid] = WarpApplier(source, warp, slab=args.slab, threads=args.threads)
+            if args.benchmark:
+                order = 0 if args.interp == "nearest" else 1
+                for key, value in applier.benchmark(args.threads, order=order).items():
+                    print(f"{key}: {value:.4g}" if isinstance(value, float) else f"{key}: {value}")
+                return
+            if len(args.i) > 1 or args.plan_cache:
+                applier.build_plan(args.plan_cache)
+        applier.apply(
+            out_path=out_path,
+            interp=args.interp,
+            cval=args.cval,
+            source=source,
+        )
+        print(f"Warped {in_path} -> {out_path}")
+
 
 if __name__ == "__main__":
     parser = build_parser()
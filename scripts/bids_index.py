@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Persistent directory index of a BIDS data tree, shared by the pipeline stages.
+
+Each stage used to find its inputs with its own recursive glob or `find`, and on network storage every one of
+those walks lists every directory again. This index stores the tree as a JSON cache outside the data: each
+directory's file and subdirectory names plus its mtime. A refresh stats every indexed directory but calls
+os.scandir only on those whose mtime has changed, that is, where entries were added, removed or renamed. A
+run after a stage has written its outputs therefore lists only the directories it wrote to. Directories
+modified less than RACY_SECONDS before a scan are relisted on the next refresh, so writes landing in the
+same mtime tick are not missed. Queries take pathlib-style glob patterns relative to the root: `*` stays
+within one path component, `**` spans any number of them, and names starting with "." only match patterns
+that start with "." (glob.glob semantics, so AppleDouble "._*" files never match).
+Quick Start:
+    python bids_index.py refresh --root /root/data
+    python bids_index.py find --root /root/data --pattern "**/ses-01/anat/*T1*.nii*"
+    python bids_index.py find --root /root/data --pattern "**/ses-01" --dirs
+Cache Location:
+    <BIDS_INDEX_DIR>/bids_index-<hash of root>.json, where BIDS_INDEX_DIR defaults to
+    ${XDG_CACHE_HOME:-~/.cache}/bids_index. The cache is kept out of the data tree: a file written there would
+    add to the dataset and bump its directory's mtime, so every run would relist that directory and rewrite
+    the cache. If the cache cannot be written the index still works for that process. Other caches use the
+    same directory: the run_z_scoring.py --incremental manifest (cache_path(root, prefix)) and the
+    control-stats digests of stats_cache.py.
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Dict, List, Set
+
+from stats_cache import publish_atomic
+
+INDEX_VERSION = 1
+RACY_SECONDS = 2.0
+_MAGIC = re.compile(r"[*?[]")
+_OPEN: Dict[tuple, "BidsIndex"] = {}
+
+
+def cache_dir() -> Path:
+    """Directory for per-root pipeline caches, kept out of the data tree (see Cache Location)."""
+    return Path(os.getenv("BIDS_INDEX_DIR") or Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "bids_index")
+
+
+def cache_path(root: Path, prefix: str = "bids_index") -> Path:
+    return cache_dir() / f"{prefix}-{hashlib.sha256(str(root).encode()).hexdigest()[:16]}.json"
+
+
+def _name_matches(name: str, segment: str) -> bool:
+    if name.startswith(".") and not segment.startswith("."):
+        return False
+    return fnmatchcase(name, segment)
+
+
+class BidsIndex:
+    """File and directory names under one root, refreshed from directory mtimes."""
+    def __init__(self, root: Path, path: Path | None = None):
+        self.base = Path(root)
+        self.root = self.base.absolute()
+        self.path = Path(path) if path is not None else cache_path(self.root)
+        self.dirs: Dict[str, dict] = {}
+        self.rescanned = 0
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            if cached.get("version") == INDEX_VERSION and cached.get("root") == str(self.root):
+                self.dirs = cached["dirs"]
+        except (OSError, ValueError):
+            pass
+
+    def refresh(self) -> "BidsIndex":
+        """Stat every indexed directory, relist the changed ones and save the cache if anything changed."""
+        started = time.time()
+        old, new, seen = self.dirs, {}, set()
+        self.rescanned = 0
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.root, rel)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:                            # symlink loop
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            entry = old.get(rel)
+            if entry is None or entry["mtime"] != st.st_mtime_ns:
+                files, subdirs = [], []
+                try:
+                    with os.scandir(path) as it:
+                        for item in it:
+                            try:
+                                is_dir = item.is_dir()
+                            except OSError:
+                                is_dir = False
+                            (subdirs if is_dir else files).append(item.name)
+                except OSError:
+                    continue
+                racy = started - st.st_mtime < RACY_SECONDS
+                entry = {"mtime": None if racy else st.st_mtime_ns, "files": sorted(files), "dirs": sorted(subdirs)}
+                self.rescanned += 1
+            new[rel] = entry
+            stack.extend(os.path.join(rel, d) for d in entry["dirs"])
+        changed = self.rescanned > 0 or new.keys() != old.keys()
+        self.dirs = new
+        if changed and self.root.is_dir():
+            self.save()
+        return self
+
+    def save(self) -> None:
+        payload = json.dumps({"version": INDEX_VERSION, "root": str(self.root), "dirs": self.dirs}).encode()
+        try:
+            publish_atomic(self.path, lambda f: f.write(payload))
+        except OSError as exc:
+            print(f"Warning: could not save BIDS index {self.path} ({exc}); continuing without a cache.")
+
+    def _match(self, rel: str, segments: List[str], dirs: bool, out: Set[str]) -> None:
+        entry = self.dirs.get(rel)
+        if entry is None:
+            return
+        segment, rest = segments[0], segments[1:]
+        if segment == "**":
+            if rest:
+                self._match(rel, rest, dirs, out)
+            for d in entry["dirs"]:
+                if not d.startswith("."):
+                    self._match(os.path.join(rel, d), segments, dirs, out)
+            return
+        if not rest:
+            out.update(os.path.join(rel, name) for name in entry["dirs" if dirs else "files"] if _name_matches(name, segment))
+            return
+        for d in entry["dirs"]:
+            if _name_matches(d, segment):
+                self._match(os.path.join(rel, d), rest, dirs, out)
+
+    def glob(self, pattern: str, dirs: bool = False) -> List[Path]:
+        """
+        Sorted paths under the root matching a relative glob pattern.
+        Paths are joined onto the root as it was given, so a relative root yields relative paths (as glob.glob
+        does) and callers can take relative_to() against the same root.
+
+        :param dirs: Match directories instead of files
+        """
+        segments = [s for s in pattern.split("/") if s and s != "."]
+        out: Set[str] = set()
+        if segments:
+            self._match("", segments, dirs, out)
+        return [self.base / rel for rel in sorted(out)]
+
+    def rglob(self, pattern: str, dirs: bool = False) -> List[Path]:
+        """As Path.rglob: the pattern may match at any depth."""
+        return self.glob(f"**/{pattern}", dirs)
+
+    @property
+    def n_files(self) -> int:
+        return sum(len(entry["files"]) for entry in self.dirs.values())
+
+
+def open_index(root: Path) -> BidsIndex:
+    """The index for root, loaded from its cache and refreshed once per process."""
+    key = (Path(root), Path(root).absolute())
+    if key not in _OPEN:
+        _OPEN[key] = BidsIndex(root).refresh()
+    return _OPEN[key]
+
+
+def index_glob(base: Path, pattern: str, dirs: bool = False) -> List[Path]:
+    """
+    Drop-in for sorted(glob(base / pattern)) served from the index.
+    base may itself contain wildcards (e.g. /data/sub-*/*/mri); the index is rooted at its literal prefix.
+    """
+    parts = Path(base).parts
+    literal = next((i for i, part in enumerate(parts) if _MAGIC.search(part)), len(parts))
+    root = Path(*parts[:literal]) if literal else Path(".")
+    return open_index(root).glob("/".join([*parts[literal:], pattern]), dirs)
+
+
+def refresh(args: argparse.Namespace) -> None:
+    index = BidsIndex(args.root).refresh()
+    print(f"Indexed {index.n_files} files in {len(index.dirs)} directories under {index.root} ({index.rescanned} rescanned).")
+
+
+def find(args: argparse.Namespace) -> None:
+    index = open_index(args.root)
+    matched = sorted({p for pattern in args.patterns for p in index.glob(pattern, args.dirs)})
+    for path in matched:
+        print(path)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Build, refresh and query the persistent BIDS directory index.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("refresh", help="Create or update the index and report its size.")
+    p.add_argument("--root", type=Path, required=True, help="Data root to index (e.g. /root/data).")
+    p.set_defaults(func=refresh)
+
+    p = sub.add_parser("find", help="Print indexed paths matching glob patterns, one per line (like `find | sort`).")
+    p.add_argument("--root", type=Path, required=True, help="Data root to index (e.g. /root/data).")
+    p.add_argument("--pattern", action="append", dest="patterns", required=True,
+                   help="Glob pattern relative to the root (`**` spans directories). Can be passed multiple times.")
+    p.add_argument("--dirs", action="store_true", default=False, help="Match directories instead of files.")
+    p.set_defaults(func=find)
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
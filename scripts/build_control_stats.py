@@ -0,0 +1,573 @@
+#!/usr/bin/env python3
+"""
+Streaming builder for the normative control distributions used by run_z_scoring.py
+(<tissue>_mean, <tissue>_std, norm_mean, norm_std -- the layout of assets/ctrl_dist).
+
+Notebook 04a_generate_Z_controls.ipynb loads the whole control cohort at once. Here controls are folded
+block by block into voxelwise Welford accumulators, so memory does not grow with cohort size. Accumulators
+are saved as partial aggregates (.npz) that merge exactly, so shards can be built on separate nodes and a
+normative cohort can be extended with new controls without reloading the old ones.
+Quick Start:
+    python build_control_stats.py accumulate --controls-root /data/ctrl --out tissue.npz
+    python build_control_stats.py accumulate-norm --controls-root /data/ctrl --tissue tissue.npz --out norm.npz
+    python build_control_stats.py finalize --tissue tissue.npz --norm norm.npz --out-dir /root/assets/ctrl_dist
+Stages:
+    accumulate: Tissue mean/M2 over processed GM/WM/CSF segments (same processing as run_z_scoring.py).
+                --init folds new controls into an existing partial; subjects already in it are skipped.
+    accumulate-norm: Composite norm mean/M2 of each control's z-scores against a tissue partial.
+                     --init resumes a norm partial scored against the same tissue partial and --ddof.
+    merge: Combine partial aggregates of the same stage (e.g. one per shard, see --shard).
+    finalize: Write the NIfTI stats directory for --control-stats-dir.
+    fit-w: Voxelwise regressions on covariates (and TIV) over all controls, written as a W-score pack for
+           run_z_scoring.py --w-pack (see w_scoring.py). Streams controls twice: normal equations, then the
+           composite norm of each control's W-scores.
+    accumulate-w: The first fit-w pass (normal equations) over one shard, as a partial that merges exactly.
+Sharded W-Score Fits:
+    Both fit-w passes shard. The normal equations are sums over controls, and the second pass needs the
+    solved fit, so the equations are merged before it:
+        python build_control_stats.py accumulate-w --shard 0/4 --controls-root /data/ctrl --covariates p.tsv --out eq0.npz
+        python build_control_stats.py merge --inputs eq*.npz --out eq.npz
+        python build_control_stats.py fit-w --shard 0/4 --equations eq.npz --controls-root /data/ctrl --covariates p.tsv --out wnorm0.npz
+        python build_control_stats.py merge --inputs wnorm*.npz --out wnorm.npz
+        python build_control_stats.py fit-w --equations eq.npz --norm wnorm.npz --controls-root /data/ctrl --covariates p.tsv --out w.npy
+    Equation partials record a key of the design (covariate columns, TIV); W norm partials a key of the
+    equations they were scored against. merge and fit-w refuse partials whose keys differ.
+Robust Norms:
+    --sketch on accumulate/accumulate-norm folds controls into per-voxel quantile sketches (quantile_sketch.py)
+    instead of Welford accumulators. They use bounded memory per voxel and merge across shards and --init the
+    same way. accumulate-norm scores controls against median/MAD when --tissue is a sketch partial. finalize then
+    writes the median as <name>_mean and 1.4826 x MAD as <name>_std, so --control-stats-dir scores with robust
+    norms unchanged. --percentiles also writes <name>_pNN maps.
+    A single sketch pass gives medians within ~alpha but MADs off by tens of percent (see Error Bounds in
+    quantile_sketch.py). For accurate MADs, stream the controls a second time with --center set to the
+    first-pass partial; that pass sketches deviations from the first-pass medians:
+        python build_control_stats.py accumulate --sketch --mask-compress --controls-root /data/ctrl --out pass1.npz
+        python build_control_stats.py accumulate --sketch --center pass1.npz --controls-root /data/ctrl --out tissue.npz
+    and likewise accumulate-norm --center on a first-pass norm partial. finalize prints each sketch's MAD
+    error bound. Sketches need --mask-compress: at 464 uint16 buckets per voxel (927 centered) the full grid
+    costs ~0.85 GB per tissue (~0.2 GB in-mask), twice that past 65535 controls.
+Note:
+    The composite norm depends on the tissue stats it was scored against. Norm partials record a key of the
+    tissue partial's subject set and --ddof; accumulate-norm --init, merge and finalize refuse norm partials
+    whose key differs, and finalize also requires the norm to cover exactly the tissue partial's controls.
+    After new controls are merged into the tissue partial, re-run accumulate-norm over all controls.
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import nibabel as nib
+
+from calvin_utils.vbm_utils.composite_atrophy_mapper import prepocess_dict, generate_tensor, generate_norm
+from calvin_utils.vbm_utils.processing import process_tissue
+from normative_bank import participant_lookup
+from quantile_sketch import MAD_SCALE, QuantileSketch
+from run_z_scoring import DEFAULT_MASK, DEFAULT_SUBJECT_BLOCK, _glob_map, _segments_from_maps, compute_z_with_precalc_stats
+from segment_loading import load_mask_index, segment_tiv
+from stats_cache import publish_atomic
+from w_scoring import W_TISSUES, NormalEquations, covariate_rows, design_matrix, expected_stats, save_w_pack
+
+TISSUES = ["grey_matter", "white_matter", "cerebrospinal_fluid"]
+
+
+class WelfordAccumulator:
+    """
+    Voxelwise running count, mean and sum of squared deviations (M2).
+    Non-finite values are skipped per voxel, matching pandas' skipna mean/std.
+    """
+    STATE_KEYS = ("n", "mean", "m2")
+
+    def __init__(self, n_voxels: int):
+        self.n = np.zeros(n_voxels, dtype=np.int64)
+        self.mean = np.zeros(n_voxels)
+        self.m2 = np.zeros(n_voxels)
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {"n": self.n, "mean": self.mean, "m2": self.m2}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray]) -> "WelfordAccumulator":
+        acc = cls(len(state["n"]))
+        acc.n, acc.mean, acc.m2 = state["n"], state["mean"], state["m2"]
+        return acc
+
+    def update(self, block: np.ndarray) -> None:
+        """Fold a (voxels,) vector or (voxels x subjects) block into the running stats."""
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        valid = np.isfinite(block)
+        k = valid.sum(axis=1)
+        b_mean = np.divide(np.where(valid, block, 0).sum(axis=1), k, out=np.zeros(len(k)), where=k > 0)
+        b_m2 = (np.where(valid, block - b_mean[:, np.newaxis], 0) ** 2).sum(axis=1)
+        self._combine(k, b_mean, b_m2)
+
+    def merge(self, other: "WelfordAccumulator") -> None:
+        """Exact pairwise merge (Chan et al.) of another accumulator over the same voxels."""
+        if other.n.shape != self.n.shape:
+            raise ValueError(f"Cannot merge accumulators over {other.n.shape} and {self.n.shape} voxels.")
+        self._combine(other.n, other.mean, other.m2)
+
+    def _combine(self, n_b: np.ndarray, mean_b: np.ndarray, m2_b: np.ndarray) -> None:
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * np.divide(n_b, n, out=np.zeros(len(n)), where=n > 0)
+        self.m2 += m2_b + delta ** 2 * np.divide(self.n * n_b, n, out=np.zeros(len(n)), where=n > 0)
+        self.n = n
+
+    def std(self, ddof: int = 1) -> np.ndarray:
+        """Voxelwise standard deviation. NaN where fewer than ddof + 1 samples were seen."""
+        dof = self.n - ddof
+        return np.sqrt(np.divide(self.m2, dof, out=np.full(len(dof), np.nan), where=dof > 0))
+
+
+def _accumulator_class(stage: str):
+    """
+    Sketch stages ("tissue-sketch", "norm-sketch") hold QuantileSketches, the "w" stage NormalEquations,
+    and the rest Welford accumulators.
+    """
+    if stage == "w":
+        return NormalEquations
+    return QuantileSketch if stage.endswith("-sketch") else WelfordAccumulator
+
+
+def _new_accumulator(args: argparse.Namespace, n_voxels: int, center: np.ndarray | None = None):
+    if args.sketch:
+        return QuantileSketch(n_voxels, args.alpha, args.min_value, args.max_value, args.signed, center)
+    return WelfordAccumulator(n_voxels)
+
+
+def _sketch_centers(args: argparse.Namespace, stage: str):
+    """
+    Per-voxel centers for a second sketch pass: the medians of the --center partial.
+
+    :return: (Dict. Statistic name -> median, voxel_index of that partial), or (None, None) without --center
+    """
+    if args.center is None:
+        return None, None
+    if not args.sketch:
+        raise SystemExit("--center needs --sketch.")
+    center_stage, accs, _, voxel_index = load_partial(args.center)
+    if center_stage != stage:
+        raise SystemExit(f"--center must be a {stage} partial, got {center_stage}.")
+    return {name: acc.quantile(0.5) for name, acc in accs.items()}, voxel_index
+
+
+def _location_scale(acc, ddof: int) -> tuple:
+    """(mean, std) of a Welford accumulator, or the robust (median, 1.4826 x MAD) of a sketch."""
+    if isinstance(acc, QuantileSketch):
+        return acc.robust_stats()
+    return acc.mean, acc.std(ddof)
+
+
+def tissue_key(subjects: List[str], ddof: int) -> str:
+    """Key of the tissue stats a norm is scored against: the tissue partial's subject set and the std ddof."""
+    return hashlib.sha256("\n".join([f"ddof={ddof}", *sorted(subjects)]).encode()).hexdigest()[:16]
+
+
+def save_partial(path: Path, stage: str, accs: Dict[str, WelfordAccumulator], subjects: List[str], voxel_index: np.ndarray | None,
+                 tissue: str | None = None) -> None:
+    """
+    Atomically write a partial aggregate.
+
+    :param stage: "tissue" or "norm", with a "-sketch" suffix for QuantileSketch accumulators
+    :param accs: Dict. Statistic name -> accumulator
+    :param subjects: Subject keys folded into the accumulators
+    :param voxel_index: Flat in-mask indices if the accumulators are mask-compressed, else None
+    :param tissue: Norm partials: tissue_key of the tissue stats the controls were z-scored against (w_norm_key
+                   for W norms). W equation partials: design_key of their design.
+    """
+    arrays = {"stage": np.array(stage), "names": np.array(list(accs)), "subjects": np.array(subjects, dtype=str),
+              "voxel_index": np.array([], dtype=np.int64) if voxel_index is None else voxel_index}
+    if tissue is not None:
+        arrays["tissue_key"] = np.array(tissue)
+    for name, acc in accs.items():
+        for key, arr in acc.state().items():
+            arrays[f"{name}_{key}"] = arr
+    publish_atomic(Path(path), lambda f: np.savez(f, **arrays))
+    print(f"Saved {stage} partial over {len(subjects)} subjects: {path}")
+
+
+def load_partial(path: Path) -> Tuple[str, Dict[str, WelfordAccumulator], List[str], np.ndarray | None]:
+    """Inverse of save_partial. Returns (stage, accumulators, subjects, voxel_index)."""
+    with np.load(path) as data:
+        stage = str(data["stage"])
+        cls = _accumulator_class(stage)
+        accs = {name: cls.from_state({key: data[f"{name}_{key}"] for key in cls.STATE_KEYS if f"{name}_{key}" in data})
+                for name in data["names"].tolist()}
+        voxel_index = data["voxel_index"] if data["voxel_index"].size else None
+        return stage, accs, data["subjects"].tolist(), voxel_index
+
+
+def partial_tissue_key(path: Path) -> str | None:
+    """tissue_key recorded in a norm partial (None for tissue partials and norm partials that predate it)."""
+    with np.load(path) as data:
+        return str(data["tissue_key"]) if "tissue_key" in data else None
+
+
+def merge_partials(paths: List[Path]):
+    """
+    Merge partial aggregates of one stage. Shards must share voxel layout and tissue key, and not overlap in subjects.
+
+    :return: (stage, accumulators, subjects, voxel_index)
+    """
+    stage, accs, subjects, voxel_index = load_partial(paths[0])
+    for path in paths[1:]:
+        other_stage, other_accs, other_subjects, other_index = load_partial(path)
+        if other_stage != stage:
+            raise SystemExit(f"Cannot merge a {other_stage} partial ({path}) into {stage} partials.")
+        if (other_index is None) != (voxel_index is None) or (voxel_index is not None and not np.array_equal(other_index, voxel_index)):
+            raise SystemExit(f"Voxel layout of {path} differs from {paths[0]}.")
+        if partial_tissue_key(path) != partial_tissue_key(paths[0]):
+            raise SystemExit(f"{path} was z-scored against different tissue stats (or --ddof) than {paths[0]}.")
+        overlap = set(subjects) & set(other_subjects)
+        if overlap:
+            raise SystemExit(f"{path} repeats {len(overlap)} subjects already merged (e.g. {sorted(overlap)[0]}).")
+        for name, acc in accs.items():
+            try:
+                acc.merge(other_accs[name])
+            except ValueError as exc:
+                raise SystemExit(f"Cannot merge {path}: {exc}")
+        subjects += other_subjects
+    return stage, accs, subjects, voxel_index
+
+
+def _tissue_stats(accs: Dict[str, WelfordAccumulator], ddof: int) -> Dict[str, tuple]:
+    """Finalize tissue accumulators into the {tissue: (mean, std)} layout of load_control_stats (median/scaled MAD for sketches)."""
+    return {t: _location_scale(accs[t], ddof) for t in TISSUES}
+
+
+def _control_subjects(args: argparse.Namespace):
+    """Glob control GM/WM/CSF and keep this shard's share of the subjects present in all three."""
+    gm = _glob_map(args.controls_root, args.gm_pattern)
+    wm = _glob_map(args.controls_root, args.wm_pattern)
+    csf = _glob_map(args.controls_root, args.csf_pattern)
+    subjects = sorted(set(gm) & set(wm) & set(csf))
+    if not subjects:
+        raise SystemExit("No overlapping control subjects found across GM/WM/CSF patterns.")
+    index, count = args.shard
+    return gm, wm, csf, subjects[index::count]
+
+
+def _iter_blocks(args: argparse.Namespace, gm, wm, csf, subjects: List[str], voxel_index):
+    """Yield (subject keys, segments) one --subject-block at a time."""
+    for i in range(0, len(subjects), args.subject_block):
+        batch = subjects[i:i + args.subject_block]
+        yield batch, _segments_from_maps(gm, wm, csf, batch, voxel_index, args.io_workers, args.io_backend)
+        print(f"Folded {min(i + args.subject_block, len(subjects))}/{len(subjects)} controls")
+
+
+def accumulate_tissue(args: argparse.Namespace) -> None:
+    """Fold processed control segments into per-tissue Welford accumulators."""
+    gm, wm, csf, subjects = _control_subjects(args)
+    stage = "tissue-sketch" if args.sketch else "tissue"
+    centers, center_index = _sketch_centers(args, stage)
+    if args.init:
+        if centers is not None:
+            raise SystemExit("--init partials keep their own centers; drop --center.")
+        init_stage, accs, done, voxel_index = load_partial(args.init)
+        if init_stage != stage:
+            raise SystemExit(f"--init must be a {stage} partial, got {init_stage}.")
+        seen = set(done)
+        subjects = [s for s in subjects if s not in seen]
+    elif centers is not None:
+        voxel_index, accs, done = center_index, None, []
+    else:
+        if args.sketch and not args.mask_compress:
+            raise SystemExit("--sketch needs --mask-compress (full-grid sketches cost ~0.85 GB per tissue).")
+        voxel_index = load_mask_index(args.mask_path) if args.mask_compress else None
+        accs, done = None, []
+
+    for batch, segments in _iter_blocks(args, gm, wm, csf, subjects, voxel_index):
+        tiv = segment_tiv(segments)
+        for tissue, df in segments.items():
+            processed = process_tissue(df, tiv, threshold=0.2)
+            if accs is None:
+                accs = {t: _new_accumulator(args, len(processed), None if centers is None else centers[t]) for t in TISSUES}
+            accs[tissue].update(processed.values)
+        done += batch
+    if accs is None:
+        raise SystemExit("No new control subjects to accumulate.")
+    save_partial(args.out, stage, accs, done, voxel_index)
+
+
+def accumulate_norm(args: argparse.Namespace) -> None:
+    """
+    Fold each control's composite norm, z-scored against a tissue partial, into a Welford accumulator or sketch.
+    Controls must already be in the tissue partial, so the norm describes the same cohort as the tissue stats.
+    """
+    stage, tissue_accs, tissue_subjects, voxel_index = load_partial(args.tissue)
+    if stage not in ("tissue", "tissue-sketch"):
+        raise SystemExit(f"--tissue must be a tissue partial, got {stage}.")
+    stats = _tissue_stats(tissue_accs, args.ddof)
+    key = tissue_key(tissue_subjects, args.ddof)
+    gm, wm, csf, subjects = _control_subjects(args)
+    missing = sorted(set(subjects) - set(tissue_subjects))
+    if missing:
+        raise SystemExit(f"{len(missing)} controls (e.g. {missing[0]}) are not in {args.tissue}; accumulate them into the "
+                         "tissue partial (accumulate --init) first, then re-run accumulate-norm over all controls.")
+    norm_stage = "norm-sketch" if args.sketch else "norm"
+    centers, center_index = _sketch_centers(args, "norm-sketch")
+    if centers is not None and not np.array_equal(center_index, voxel_index):
+        raise SystemExit(f"Voxel layout of {args.center} differs from {args.tissue}.")
+
+    if args.init:
+        if centers is not None:
+            raise SystemExit("--init partials keep their own centers; drop --center.")
+        init_stage, init_accs, done, init_index = load_partial(args.init)
+        if init_stage != norm_stage:
+            raise SystemExit(f"--init must be a {norm_stage} partial, got {init_stage}.")
+        if partial_tissue_key(args.init) != key:
+            raise SystemExit(f"{args.init} was z-scored against different tissue stats (or --ddof) than {args.tissue}, "
+                             "so its norms are stale. Re-run accumulate-norm over all controls without --init.")
+        if (init_index is None) != (voxel_index is None) or (voxel_index is not None and not np.array_equal(init_index, voxel_index)):
+            raise SystemExit(f"Voxel layout of {args.init} differs from {args.tissue}.")
+        acc = init_accs["norm"]
+        seen = set(done)
+        subjects = [s for s in subjects if s not in seen]
+    else:
+        acc, done = _new_accumulator(args, len(tissue_accs[TISSUES[0]].n), None if centers is None else centers["norm"]), []
+    for batch, segments in _iter_blocks(args, gm, wm, csf, subjects, voxel_index):
+        z, _ = compute_z_with_precalc_stats(segments, stats, dtype=np.float64)
+        acc.update(generate_norm(generate_tensor(prepocess_dict(z)), atrophy_only=False))
+        done += batch
+    save_partial(args.out, norm_stage, {"norm": acc}, done, voxel_index, tissue=key)
+
+
+def merge(args: argparse.Namespace) -> None:
+    """Merge shard partials into one."""
+    save_partial(args.out, *merge_partials(args.inputs), tissue=partial_tissue_key(args.inputs[0]))
+
+
+def finalize(args: argparse.Namespace) -> None:
+    """Write <tissue>_mean/_std.nii.gz (and norm_mean/_std.nii.gz, plus <name>_pNN for sketches) on the mask grid."""
+    mask_img = nib.load(str(args.mask_path))
+    outputs = {}
+    stage, accs, subjects, voxel_index = load_partial(args.tissue)
+    named = {tissue: accs[tissue] for tissue in TISSUES}
+    if args.norm:
+        _, norm_accs, norm_subjects, _ = load_partial(args.norm)
+        if partial_tissue_key(args.norm) != tissue_key(subjects, args.ddof):
+            raise SystemExit(f"{args.norm} was not z-scored against {args.tissue} with --ddof {args.ddof}; "
+                             "re-run accumulate-norm against this tissue partial.")
+        if sorted(norm_subjects) != sorted(subjects):
+            raise SystemExit(f"{args.norm} covers {len(norm_subjects)} of the {len(subjects)} controls in {args.tissue}; "
+                             "accumulate (or merge) the norm over all of them.")
+        named["norm"] = norm_accs["norm"]
+    for name, acc in named.items():
+        outputs[f"{name}_mean"], outputs[f"{name}_std"] = _location_scale(acc, args.ddof)
+        if isinstance(acc, QuantileSketch):
+            median, mad = outputs[f"{name}_mean"], outputs[f"{name}_std"] / MAD_SCALE
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rel = acc.mad_error_bound(median, mad) / mad
+            rel = rel[np.isfinite(rel)]
+            print(f"{name}: MAD error bound {np.median(rel):.1%} of MAD (median voxel), {rel.max(initial=0):.1%} (worst)"
+                  + ("" if acc.center is not None else "; one-pass sketch, re-accumulate with --center for accurate MADs"))
+        if args.percentiles and isinstance(acc, QuantileSketch):
+            for p in args.percentiles:
+                outputs[f"{name}_p{p:02g}"] = acc.quantile(p / 100)
+
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    for name, arr in outputs.items():
+        vol = np.zeros(mask_img.shape, dtype=np.float32).ravel()
+        if voxel_index is None:
+            vol[:] = arr
+        else:
+            vol[voxel_index] = arr
+        out_path = args.out_dir / f"{name}.nii.gz"
+        nib.save(nib.Nifti1Image(vol.reshape(mask_img.shape), mask_img.affine), str(out_path))
+        print(f"Saved {out_path}")
+    print(f"Control stats from {len(subjects)} subjects written to {args.out_dir}")
+
+
+def design_key(args: argparse.Namespace) -> str:
+    """Key of a W-score design: its covariate columns (in order) and whether TIV is in it."""
+    return hashlib.sha256("\n".join(["tiv=" + str(not args.no_tiv), *args.covariate_columns]).encode()).hexdigest()[:16]
+
+
+def w_norm_key(subjects: List[str], design: str) -> str:
+    """Key of the fit a W norm is scored against: the equation partial's subject set and design_key."""
+    return hashlib.sha256("\n".join([f"w-design={design}", *sorted(subjects)]).encode()).hexdigest()[:16]
+
+
+def _normal_equations(args: argparse.Namespace, gm, wm, csf, subjects: List[str], voxel_index, lookup) -> Dict[str, NormalEquations]:
+    """First fit-w pass: fold the controls into per-tissue normal equations."""
+    eqs = None
+    for batch, segments in _iter_blocks(args, gm, wm, csf, subjects, voxel_index):
+        tiv = segment_tiv(segments)
+        X = design_matrix(covariate_rows(batch, lookup, args.covariate_columns, args.covariates), None if args.no_tiv else tiv)
+        for tissue, df in segments.items():
+            processed = process_tissue(df, tiv, threshold=0.2)
+            if eqs is None:
+                eqs = {t: NormalEquations(X.shape[1], len(processed)) for t in W_TISSUES}
+            eqs[tissue].update(X, processed.values)
+    if eqs is None:
+        raise SystemExit("No controls to fit in this shard.")
+    return eqs
+
+
+def _load_equations(args: argparse.Namespace, voxel_index: np.ndarray) -> Tuple[Dict[str, NormalEquations], List[str]]:
+    """The --equations partial, checked against this run's design and mask."""
+    stage, eqs, subjects, eq_index = load_partial(args.equations)
+    if stage != "w":
+        raise SystemExit(f"--equations must be a w partial (accumulate-w), got {stage}.")
+    if partial_tissue_key(args.equations) != design_key(args):
+        raise SystemExit(f"{args.equations} was fitted with a different design; match --covariate-columns and --no-tiv.")
+    if eq_index is None or not np.array_equal(eq_index, voxel_index):
+        raise SystemExit(f"Voxel layout of {args.equations} differs from --mask-path {args.mask_path}.")
+    return eqs, subjects
+
+
+def accumulate_w(args: argparse.Namespace) -> None:
+    """Fold this shard's controls into W-score normal equations and save them as a partial."""
+    gm, wm, csf, subjects = _control_subjects(args)
+    voxel_index = load_mask_index(args.mask_path)
+    eqs = _normal_equations(args, gm, wm, csf, subjects, voxel_index, participant_lookup(args.covariates))
+    save_partial(args.out, "w", eqs, subjects, voxel_index, tissue=design_key(args))
+
+
+def fit_w(args: argparse.Namespace) -> None:
+    """
+    Fit the W-score regressions for every in-mask voxel and write the pack.
+    With --equations and --shard, write this shard's W norm partial instead (see Sharded W-Score Fits).
+    """
+    voxel_index = load_mask_index(args.mask_path)
+    lookup = participant_lookup(args.covariates)
+    sharded = args.shard != (0, 1)
+    if args.equations is None and (sharded or args.norm is not None):
+        raise SystemExit("fit-w --shard/--norm need --equations: run accumulate-w per shard and merge the partials first.")
+    if args.norm is None or args.equations is None:
+        gm, wm, csf, subjects = _control_subjects(args)
+    if args.equations is None:
+        eqs, fitted = _normal_equations(args, gm, wm, csf, subjects, voxel_index, lookup), subjects
+    else:
+        eqs, fitted = _load_equations(args, voxel_index)
+        if args.norm is None:
+            subjects = [s for s in subjects if s in set(fitted)]
+    fits = {t: eq.solve() for t, eq in eqs.items()}
+    coefs, sds, centers = {t: f[0] for t, f in fits.items()}, {t: f[1] for t, f in fits.items()}, fits[W_TISSUES[0]][2]
+    key = w_norm_key(fitted, design_key(args))
+
+    if args.norm is not None:
+        stage, accs, norm_subjects, _ = load_partial(args.norm)
+        if stage != "norm" or partial_tissue_key(args.norm) != key:
+            raise SystemExit(f"{args.norm} is not a W norm partial scored against {args.equations}.")
+        if sorted(norm_subjects) != sorted(fitted):
+            raise SystemExit(f"{args.norm} covers {len(norm_subjects)} of the {len(fitted)} controls in {args.equations}; "
+                             "merge the W norm partials of every shard.")
+        acc = accs["norm"]
+    else:
+        acc = WelfordAccumulator(len(voxel_index))
+        for batch, segments in _iter_blocks(args, gm, wm, csf, subjects, voxel_index):
+            tiv = None if args.no_tiv else segment_tiv(segments)
+            X = design_matrix(covariate_rows(batch, lookup, args.covariate_columns, args.covariates), tiv, centers)
+            w, _ = compute_z_with_precalc_stats(segments, expected_stats(coefs, sds, X, np.float64), dtype=np.float64)
+            acc.update(generate_norm(generate_tensor(prepocess_dict(w)), atrophy_only=False))
+        if sharded:
+            save_partial(args.out, "norm", {"norm": acc}, subjects, voxel_index, tissue=key)
+            return
+    save_w_pack(args.out, coefs, sds, (acc.mean, acc.std(args.ddof)), args.covariate_columns, not args.no_tiv, centers,
+                len(fitted), args.mask_path)
+
+
+def _shard(value: str) -> Tuple[int, int]:
+    index, count = (int(v) for v in value.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard must be INDEX/COUNT with 0 <= INDEX < COUNT, got {value}")
+    return index, count
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Build mergeable control mean/std distributions with Welford accumulators.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def _add_controls(p):
+        p.add_argument("--controls-root", type=Path, required=True, help="Base path to control tissue segments.")
+        p.add_argument("--gm-pattern", default="*/*/anat/mri/mwp1*", help="Glob for control grey matter files.")
+        p.add_argument("--wm-pattern", default="*/*/anat/mri/mwp2*", help="Glob for control white matter files.")
+        p.add_argument("--csf-pattern", default="*/*/anat/mri/mwp3*", help="Glob for control CSF files.")
+        p.add_argument("--shard", type=_shard, default=(0, 1), help="Process subjects[INDEX::COUNT] only (default: 0/1).")
+        p.add_argument("--subject-block", type=int, default=DEFAULT_SUBJECT_BLOCK,
+                       help=f"Controls decoded per step (default: {DEFAULT_SUBJECT_BLOCK}).")
+        p.add_argument("--io-workers", type=int, default=1, help="Concurrent NIfTI decoders (default: 1).")
+        p.add_argument("--io-backend", choices=["thread", "process"], default="thread", help="Pool type for --io-workers.")
+        p.add_argument("--out", type=Path, required=True, help="Partial aggregate to write (.npz).")
+
+    def _add_sketch(p):
+        p.add_argument("--sketch", action="store_true", help="Accumulate per-voxel quantile sketches (median/MAD) instead of mean/M2.")
+        p.add_argument("--alpha", type=float, default=0.02, help="Sketch relative accuracy (default: 0.02).")
+        p.add_argument("--min-value", type=float, default=1e-6, help="Smallest magnitude resolved; smaller values count as 0 (default: 1e-6).")
+        p.add_argument("--max-value", type=float, default=1e2, help="Largest magnitude resolved; larger values are clamped (default: 1e2).")
+        p.add_argument("--signed", action="store_true", help="Also resolve negative values (doubles sketch memory).")
+        p.add_argument("--center", type=Path, default=None,
+                       help="First-pass sketch partial of the same stage. Sketches deviations from its medians (signed), "
+                            "which bounds the MAD error by ~alpha x MAD. Its voxel layout is reused.")
+
+    p = sub.add_parser("accumulate", help="Accumulate tissue mean/M2 over controls.")
+    _add_controls(p)
+    p.add_argument("--init", type=Path, default=None, help="Existing tissue partial to extend. Its subjects are skipped.")
+    p.add_argument("--mask-path", type=Path, default=DEFAULT_MASK, help="Mask used by --mask-compress.")
+    p.add_argument("--mask-compress", action="store_true", help="Accumulate in-mask voxels only. Required by --sketch.")
+    _add_sketch(p)
+    p.set_defaults(func=accumulate_tissue)
+
+    p = sub.add_parser("accumulate-norm", help="Accumulate composite norm mean/M2 against a tissue partial.")
+    _add_controls(p)
+    p.add_argument("--tissue", type=Path, required=True, help="Tissue partial the controls are z-scored against.")
+    p.add_argument("--ddof", type=int, default=1, help="Delta degrees of freedom for the tissue std (default: 1).")
+    p.add_argument("--init", type=Path, default=None,
+                   help="Existing norm partial to extend. Its subjects are skipped; it must have been scored against --tissue.")
+    _add_sketch(p)
+    p.set_defaults(func=accumulate_norm)
+
+    p = sub.add_parser("merge", help="Merge partial aggregates of the same stage.")
+    p.add_argument("--inputs", type=Path, nargs="+", required=True, help="Partials to merge.")
+    p.add_argument("--out", type=Path, required=True, help="Merged partial to write (.npz).")
+    p.set_defaults(func=merge)
+
+    def _add_design(p):
+        p.add_argument("--covariates", type=Path, required=True,
+                       help="Participants CSV/TSV (participant_id, optional session_id) with the covariate columns.")
+        p.add_argument("--covariate-columns", nargs="+", default=["age", "sex"],
+                       help="Covariate columns, in design order (default: age sex). Sex-like strings are coded M=1, F=0.")
+        p.add_argument("--no-tiv", action="store_true", help="Leave TIV (get_tiv) out of the design.")
+        p.add_argument("--mask-path", type=Path, default=DEFAULT_MASK, help="Mask defining the pack's voxel layout.")
+
+    p = sub.add_parser("accumulate-w", help="Accumulate W-score normal equations over a shard of controls.")
+    _add_controls(p)
+    _add_design(p)
+    p.set_defaults(func=accumulate_w)
+
+    p = sub.add_parser("fit-w", help="Fit voxelwise covariate regressions and write a W-score pack.")
+    _add_controls(p)
+    _add_design(p)
+    p.add_argument("--ddof", type=int, default=1, help="Delta degrees of freedom for the composite norm std (default: 1).")
+    p.add_argument("--equations", type=Path, default=None,
+                   help="Merged accumulate-w partial to fit instead of streaming the first pass. Required with --shard, "
+                        "which then writes this shard's W norm partial to --out rather than the pack.")
+    p.add_argument("--norm", type=Path, default=None,
+                   help="Merged W norm partial of every --equations control: write the pack without streaming controls.")
+    p.set_defaults(func=fit_w)
+
+    p = sub.add_parser("finalize", help="Write the NIfTI stats directory.")
+    p.add_argument("--tissue", type=Path, required=True, help="Tissue partial.")
+    p.add_argument("--norm", type=Path, default=None, help="Norm partial (omit to write tissue stats only).")
+    p.add_argument("--out-dir", type=Path, required=True, help="Directory to write <tissue>_mean.nii.gz etc.")
+    p.add_argument("--mask-path", type=Path, default=DEFAULT_MASK, help="Reference grid and affine for outputs.")
+    p.add_argument("--ddof", type=int, default=1, help="Delta degrees of freedom for std (default: 1).")
+    p.add_argument("--percentiles", type=float, nargs="+", default=None,
+                   help="Sketch partials only: also write <name>_pNN.nii.gz percentile maps (e.g. 5 25 75 95).")
+    p.set_defaults(func=finalize)
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ import numpy as np
 import pandas as pd
 
 from calvin_utils.neuroimaging_utils.nifti_utils.damage_score_utils import DamageScorer
+from bids_index import open_index
 
 DEFAULT_BASE = Path("/root/data")
 DEFAULT_MASK = Path("/root/assets/MNI152_T1_2mm_brain_mask.nii")
@@ -46,7 +47,7 @@ def _load_nifti_arrays(paths: Iterable[Path]) -> Dict[str, np.ndarray]:
 
 def _find_composite_maps(base_dir: Path, session: str) -> Iterable[Path]:
     pattern = f"*/*/{session}/unthresholded_tissue_segment_z_scores/*_composite.nii*"
-    return base_dir.glob(pattern)
+    return open_index(base_dir).glob(pattern)
 
 
 def _extract_sub_ses(path: Path) -> Tuple[str, str]:
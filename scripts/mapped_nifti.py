@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Disk-backed views of large NIfTI volumes (warp fields) for slab-wise readers.
+
+np.asarray(img.dataobj) decodes the whole image into anonymous memory, and for a .nii.gz every slice of the
+proxy re-inflates the gzip stream from its start. map_image_data instead returns the data as a read-only
+np.memmap. An uncompressed .nii is mapped in place. A compressed one is inflated once, sequentially, into an
+unlinked temporary file that is mapped instead, so it costs one decompression and the raw size in temp
+space. Slabs are then paged in from disk when sliced, and resident memory stays with the slabs a reader
+holds; pages already read are file-backed and the kernel can drop them under pressure.
+"""
+from __future__ import annotations
+import tempfile
+
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+
+COPY_BLOCK = 1 << 24                                                      # bytes inflated per read
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".zst")
+
+
+def map_image_data(img: nib.spatialimages.SpatialImage, tmp_dir: str | None = None) -> np.ndarray:
+    """
+    Read-only memmap of an image's stored array (on-disk dtype and layout).
+
+    Images that are not file-backed, or whose data are scaled (scl_slope/scl_inter), cannot be mapped raw
+    and are loaded whole instead.
+
+    :param tmp_dir: Directory for the inflated copy of a compressed image (default: tempfile's default)
+    """
+    proxy = img.dataobj
+    source = getattr(proxy, "file_like", None)
+    if not nib.is_proxy(proxy) or not isinstance(source, str) or proxy.slope != 1 or proxy.inter != 0:
+        return np.asanyarray(proxy)
+    shape, dtype, order = proxy.shape, proxy.dtype, proxy.order
+    if not source.endswith(COMPRESSED_SUFFIXES):
+        return np.memmap(source, dtype=dtype, mode="r", offset=proxy.offset, shape=shape, order=order)
+
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    with tempfile.TemporaryFile(dir=tmp_dir) as tmp, ImageOpener(source) as stream:
+        stream.seek(proxy.offset)
+        remaining = nbytes
+        while remaining:
+            chunk = stream.read(min(COPY_BLOCK, remaining))
+            if not chunk:
+                raise ValueError(f"{source} ends {remaining} bytes short of its {shape} {dtype} data.")
+            tmp.write(chunk)
+            remaining -= len(chunk)
+        tmp.flush()
+        return np.memmap(tmp, dtype=dtype, mode="r", shape=shape, order=order)   # the mapping outlives the file handle
@@ -12,6 +12,8 @@ import nibabel as nib
 import numpy as np
 import pandas as pd
 
+from bids_index import open_index
+
 DEFAULT_MASK = Path("/root/assets/MNI152_T1_2mm_brain_mask.nii")
 DEFAULT_ROI_DIR = Path("/root/assets/rois")
 DEFAULT_BASE = Path("/root/data")
@@ -52,14 +54,14 @@ def _load_roi_arrays(roi_paths: Iterable[Path]) -> Dict[str, np.ndarray]:
 def _find_composite_maps(base_dir: Path, session: str) -> Iterable[Path]:
     """Searches <sub>/<ses>/<unthresholded...>/<composite.nii>"""
     pattern = f"*/{session}/unthresholded_tissue_segment_z_scores/*_composite.nii*"
-    return (p for p in base_dir.glob(pattern) if not p.name.startswith("._"))
+    return (p for p in open_index(base_dir).glob(pattern) if not p.name.startswith("._"))
 
 
-def _extract_sub_ses_from_path(path: Path) -> Tuple[str, str]:
-    """Expects .../<sub>/<ses>/unthresholded_tissue_segment_z_scores/..."""
-    relpath = path.relative_to(DEFAULT_BASE)  # will raise if not under base
+def _extract_sub_ses_from_path(path: Path, base_dir: Path = DEFAULT_BASE) -> Tuple[str, str]:
+    """Expects <base_dir>/<sub>/<ses>/unthresholded_tissue_segment_z_scores/..."""
+    relpath = path.absolute().relative_to(Path(base_dir).absolute())  # will raise if not under base
     if len(relpath.parts) < 2:
-        print(f"Path {path} does not contain <sub>/<ses> under {DEFAULT_BASE}. Creating at {relpath.parts[0] if relpath.parts else '<missing>'}/{DEFAULT_SES}")
+        print(f"Path {path} does not contain <sub>/<ses> under {base_dir}. Creating at {relpath.parts[0] if relpath.parts else '<missing>'}/{DEFAULT_SES}")
         sub = relpath.parts[0] if relpath.parts else "sub-unknown"
         ses = DEFAULT_SES
     else:
@@ -68,6 +70,18 @@ def _extract_sub_ses_from_path(path: Path) -> Tuple[str, str]:
     return sub, ses
 
 
+def roi_mean(comp_vals: np.ndarray) -> float:
+    """Mean of the finite composite values at an ROI's voxels (NaN if there are none)."""
+    comp_vals = comp_vals[np.isfinite(comp_vals)]
+    return float(comp_vals.mean()) if comp_vals.size else np.nan
+
+
+def roi_table(rows) -> pd.DataFrame:
+    """(ROI, Atrophy_Z) rows as the regional CSV table, sorted by descending Atrophy_Z."""
+    df = pd.DataFrame(rows, columns=["ROI", "Atrophy_Z"])
+    return df.sort_values(by="Atrophy_Z", ascending=False).reset_index(drop=True)
+
+
 def compute_roi_means(composite_path: Path, roi_arrays: Dict[str, np.ndarray]) -> pd.DataFrame:
     """Expects a binary ROI mask"""
     comp_img = nib.load(str(composite_path))
@@ -86,16 +100,11 @@ def compute_roi_means(composite_path: Path, roi_arrays: Dict[str, np.ndarray]) -
             rows.append((roi_name, np.nan))
             continue
         
-        comp_vals = comp_data[roi_mask & np.isfinite(comp_data)]
-        if comp_vals.size == 0:
+        mean = roi_mean(comp_data[roi_mask])
+        if np.isnan(mean):
             print(f"ROI {roi_name} has no finite composite voxels. Recording NaN.")
-            rows.append((roi_name, np.nan))
-            continue
-        roi_mean = np.nanmean(comp_vals)
-        rows.append((roi_name, roi_mean))
-
-    df = pd.DataFrame(rows, columns=["ROI", "Atrophy_Z"])
-    return df.sort_values(by="Atrophy_Z", ascending=False).reset_index(drop=True)
+        rows.append((roi_name, mean))
+    return roi_table(rows)
 
 
 def save_roi_csv(df: pd.DataFrame, base_dir: Path, sub: str, ses: str, fname: str) -> Path:
@@ -131,7 +140,7 @@ def main():
     if not composites:
         raise SystemExit(f"No composite maps found under {base_dir} for session {args.session}")
     for comp_path in composites:
-        sub, ses = _extract_sub_ses_from_path(comp_path)
+        sub, ses = _extract_sub_ses_from_path(comp_path, base_dir)
         df = compute_roi_means(comp_path, roi_df)
         out_path = save_roi_csv(df, base_dir, sub, ses, args.fname)
         print(f"Saved ROI means for {sub}/{ses} to {out_path}")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Output side of run_z_scoring.py: mask geometry loaded once, and a bounded worker pool for NIfTI writes.
+
+Gzip compression dominates writing .nii.gz outputs and zlib releases the GIL, so a thread pool scales it
+across cores. At most max_pending volumes are queued or in flight at once, which bounds the extra memory
+the writer adds regardless of how many subjects x tissues x analyses are submitted.
+"""
+from __future__ import annotations
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Set
+
+import numpy as np
+import nibabel as nib
+
+
+class MaskGeometry:
+    """Shape and affine of the reference mask, read once and reused for every output volume."""
+    def __init__(self, mask_path: Path):
+        img = nib.load(str(mask_path))
+        self.path = Path(mask_path)
+        self.shape = img.shape[:3]
+        self.affine = img.affine
+        self.size = int(np.prod(self.shape))
+
+    def to_volume(self, arr: np.ndarray, voxel_index: np.ndarray | None = None) -> np.ndarray:
+        """Reshape a full-grid vector, or scatter a mask-compressed one (zeros elsewhere), onto the mask grid."""
+        if voxel_index is None:
+            return np.asarray(arr).reshape(self.shape)
+        vol = np.zeros(self.size, dtype=arr.dtype)
+        vol[voxel_index] = arr
+        return vol.reshape(self.shape)
+
+    def to_nifti(self, arr: np.ndarray, voxel_index: np.ndarray | None = None) -> nib.Nifti1Image:
+        return nib.Nifti1Image(self.to_volume(arr, voxel_index), self.affine)
+
+
+class NiftiWriter:
+    """
+    Scatter-and-save NIfTIs on a thread pool with a bounded number of pending writes.
+
+    With workers <= 1 writes happen inline. Use as a context manager; leaving it waits for every
+    submitted write. Only writes still in flight are tracked: a finished write releases its slot and is
+    dropped. The first failure is re-raised by the next submit, flush or close, whichever comes first.
+    """
+    def __init__(self, geometry: MaskGeometry, workers: int = 1, max_pending: int | None = None):
+        self.geometry = geometry
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * max(workers, 1))
+        self._idle = threading.Condition()                              # guards _pending/_error; notified as writes finish
+        self._pending: Set[Future] = set()
+        self._error: BaseException | None = None
+
+    def _write(self, arr: np.ndarray, out_path: str, voxel_index: np.ndarray | None) -> str:
+        Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+        nib.save(self.geometry.to_nifti(arr, voxel_index), out_path)
+        return out_path
+
+    def _done(self, future: Future) -> None:
+        """Done callback: forget the write, keep its failure if it is the first, and free its slot."""
+        with self._idle:
+            self._pending.discard(future)
+            if self._error is None and not future.cancelled() and future.exception() is not None:
+                self._error = future.exception()
+            self._idle.notify_all()
+        self._slots.release()
+
+    def _raise_error(self) -> None:
+        """Re-raise the first failed write once."""
+        with self._idle:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def submit(self, arr: np.ndarray, out_path: str, voxel_index: np.ndarray | None = None) -> None:
+        """Queue one vector for writing. Blocks while max_pending writes are outstanding."""
+        if self._pool is None:
+            self._write(arr, out_path, voxel_index)
+            return
+        self._raise_error()
+        self._slots.acquire()
+        try:
+            self._raise_error()                                          # a write may have failed while this one waited
+        except BaseException:
+            self._slots.release()
+            raise
+        future = self._pool.submit(self._write, arr, out_path, voxel_index)
+        with self._idle:
+            self._pending.add(future)
+        future.add_done_callback(self._done)                            # runs at once if the write already finished
+
+    def flush(self) -> None:
+        """Wait for every write submitted so far; re-raise the first failure."""
+        with self._idle:                                                 # done callbacks, not just results, have run
+            self._idle.wait_for(lambda: not self._pending)
+        self._raise_error()
+
+    def close(self) -> None:
+        if self._pool is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def __enter__(self) -> "NiftiWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
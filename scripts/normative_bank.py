@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Multi-cohort normative bank for run_z_scoring.py (--normative-bank).
+
+--control-stats-dir picks one normative set per run, so a batch mixing e.g. young and older patients has to
+be split and run once per set. A bank stacks any number of control-stats directories (the assets/ctrl_dist
+layout) into one mask-compressed float32 array of shape (cohorts, 8, voxels). It is mapped with
+mmap_mode="r", and each subject is scored against the cohort a participants table assigns it, either from
+a cohort column or from age brackets. A sidecar JSON holds the cohort names and each cohort's stats
+fingerprint (as stats_cache.stats_fingerprint), so incremental runs see the same fingerprint whether a
+cohort comes from its directory or from the bank.
+Quick Start:
+    python normative_bank.py build --cohort older=/root/assets/ctrl_dist --cohort young=/root/assets/crtl_dist_young \\
+        --mask-path /root/assets/MNI152_T1_2mm_brain_mask.nii --out /root/assets/normative_bank.npy
+    python run_z_scoring.py --experiments-root /data --normative-bank /root/assets/normative_bank.npy \\
+        --participants /data/participants.tsv --age-bracket young=0:60 --age-bracket older=60:200
+Participants Table:
+    CSV/TSV with a participant_id column (sub- prefix optional). An optional session_id column gives
+    per-session rows. The cohort comes from --cohort-column, or from --age-column via the --age-bracket
+    [LO, HI) ranges. Subjects with no row or no match get --default-cohort, or stop the run if it is unset.
+"""
+from __future__ import annotations
+import argparse
+import json
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from stats_cache import STAT_ORDER, publish_atomic, stats_fingerprint
+
+BANK_VERSION = 1
+SUBJECT_PREFIXES = ("subject-", "subid-", "sub-")
+
+
+def sidecar_path(bank_path: Path) -> Path:
+    return Path(bank_path).with_suffix(".json")
+
+
+def build_bank(cohorts: Dict[str, Dict[str, Tuple[Path, Path]]], mask_path: Path, out_path: Path, voxel_index: np.ndarray,
+               loader: Callable[[Path, np.ndarray], np.ndarray]) -> Path:
+    """
+    Stack the control stats of every cohort into one (cohorts, 8, voxels) float32 array.
+
+    :param cohorts: Dict. Cohort name -> {statistic: (mean path, std path)}, as resolved by run_z_scoring
+    :param mask_path: Mask defining the voxel layout
+    :param out_path: .npy to write; the sidecar JSON is written next to it
+    :param loader: Callable(path, voxel_index) -> flat array, e.g. run_z_scoring._load_flattened_nifti
+    """
+    bank = np.empty((len(cohorts), 2 * len(STAT_ORDER), len(voxel_index)), dtype=np.float32)
+    fingerprints = {}
+    for c, (name, paths) in enumerate(cohorts.items()):
+        fingerprints[name] = stats_fingerprint(paths, mask_path)
+        for i, stat in enumerate(STAT_ORDER):
+            mean_path, std_path = paths[stat]
+            bank[c, 2 * i] = loader(mean_path, voxel_index)
+            bank[c, 2 * i + 1] = loader(std_path, voxel_index)
+        print(f"Added cohort {name}")
+    meta = {"version": BANK_VERSION, "cohorts": list(cohorts), "fingerprints": fingerprints,
+            "voxels": int(len(voxel_index)), "mask": str(mask_path)}
+    publish_atomic(out_path, lambda f: np.save(f, bank))
+    publish_atomic(sidecar_path(out_path), lambda f: f.write(json.dumps(meta, indent=1).encode()))
+    print(f"Normative bank with {len(cohorts)} cohorts written to {out_path}")
+    return out_path
+
+
+class NormativeBank:
+    """A mapped bank; stats(cohort) returns rows in the load_control_stats layout without copying."""
+    def __init__(self, bank_path: Path, voxel_index: np.ndarray):
+        with open(sidecar_path(bank_path)) as f:
+            meta = json.load(f)
+        self.cohorts: List[str] = meta["cohorts"]
+        self.fingerprints: Dict[str, str] = meta["fingerprints"]
+        self.array = np.load(bank_path, mmap_mode="r")
+        expected = (len(self.cohorts), 2 * len(STAT_ORDER), len(voxel_index))
+        if self.array.shape != expected:
+            raise SystemExit(f"Normative bank {bank_path} has shape {self.array.shape}; expected {expected} for this mask.")
+
+    def stats(self, cohort: str, dtype=np.float32) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        rows = self.array[self.cohorts.index(cohort)]
+        return {name: (np.asarray(rows[2 * i], dtype=dtype), np.asarray(rows[2 * i + 1], dtype=dtype))
+                for i, name in enumerate(STAT_ORDER)}
+
+
+def _strip_subject(label: str) -> str:
+    for prefix in SUBJECT_PREFIXES:
+        if label.startswith(prefix):
+            return label[len(prefix):]
+    return label
+
+
+def parse_bracket(value: str) -> Tuple[str, float, float]:
+    """NAME=LO:HI (either bound may be empty) -> (NAME, LO, HI) for the half-open range [LO, HI)."""
+    try:
+        name, bounds = value.split("=", 1)
+        lo, hi = bounds.split(":", 1)
+        return name, float(lo) if lo else -np.inf, float(hi) if hi else np.inf
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Age bracket must be NAME=LO:HI, got {value}")
+
+
+def participant_lookup(participants: Path) -> Callable[[str], "pd.Series | None"]:
+    """
+    Index a participants CSV/TSV by participant_id (sub- prefix optional) and, if present, session_id.
+
+    :return: Callable. Subject key (sub-XX or sub-XX/ses-YY) -> its row, preferring a per-session row; None if absent
+    """
+    table = pd.read_csv(participants, sep=None, engine="python", dtype={"participant_id": str, "session_id": str})
+    table["_sub"] = table["participant_id"].map(_strip_subject)
+    by_session = {(r["_sub"], r["session_id"]): r for _, r in table.iterrows()} if "session_id" in table else {}
+    by_subject = {r["_sub"]: r for _, r in table.iterrows()}
+
+    def lookup(key: str):
+        sub, _, ses = key.partition("/")
+        return by_session.get((_strip_subject(sub), ses), by_subject.get(_strip_subject(sub)))
+    return lookup
+
+
+def assign_cohorts(subjects: List[str], participants: Path, cohorts: List[str], cohort_column: str | None = None,
+                   age_column: str | None = None, brackets: List[Tuple[str, float, float]] | None = None,
+                   default: str | None = None) -> Dict[str, List[str]]:
+    """
+    Group subject keys (sub-XX or sub-XX/ses-YY) by the cohort the participants table assigns them.
+
+    :return: Dict. Cohort -> subject keys in input order
+    """
+    lookup = participant_lookup(participants)
+
+    def _cohort(row) -> str | None:
+        if row is None:
+            return None
+        if cohort_column:
+            value = row.get(cohort_column)
+            return None if pd.isna(value) else str(value)
+        age = row.get(age_column)
+        if pd.isna(age):
+            return None
+        return next((name for name, lo, hi in brackets if lo <= float(age) < hi), None)
+
+    groups: Dict[str, List[str]] = {}
+    missing = []
+    for key in subjects:
+        cohort = _cohort(lookup(key)) or default
+        if cohort is None:
+            missing.append(key)
+            continue
+        if cohort not in cohorts:
+            raise SystemExit(f"{key} is assigned cohort {cohort!r}, which is not in the bank ({', '.join(cohorts)}).")
+        groups.setdefault(cohort, []).append(key)
+    if missing:
+        raise SystemExit(f"No cohort for {len(missing)} subjects (e.g. {missing[0]}); add them to {participants} or set --default-cohort.")
+    return groups
+
+
+def build(args: argparse.Namespace) -> None:
+    from run_z_scoring import _control_stat_paths, _load_flattened_nifti, stats_dir_args  # run_z_scoring imports this module
+    from segment_loading import load_mask_index
+    cohorts = {}
+    for spec in args.cohort:
+        name, stats_dir = spec.split("=", 1)
+        cohorts[name] = _control_stat_paths(stats_dir_args(Path(stats_dir), args.mask_path))
+    build_bank(cohorts, args.mask_path, args.out, load_mask_index(args.mask_path), _load_flattened_nifti)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Stack normative control-stats directories into one mapped bank.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("build", help="Build a bank from control-stats directories.")
+    p.add_argument("--cohort", action="append", required=True, metavar="NAME=DIR",
+                   help="Cohort name and its control-stats directory (assets/ctrl_dist layout). Repeatable.")
+    p.add_argument("--mask-path", type=Path, required=True, help="Mask defining the voxel layout (as --mask-path in run_z_scoring.py).")
+    p.add_argument("--out", type=Path, required=True, help="Bank to write (.npy, with a .json sidecar).")
+    p.set_defaults(func=build)
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Mergeable per-voxel quantile sketches for robust normative statistics (build_control_stats.py --sketch).
+
+Medians and MADs over a control cohort normally need every control in memory at once. Here each voxel keeps a
+log-bucketed histogram (DDSketch-style). Any value in [min_value, max_value] lands in a bucket whose
+representative is within relative error alpha, smaller values share a zero bucket, and larger ones are
+clamped. Memory is fixed at 2 bytes x buckets per voxel, independent of cohort size (464 buckets at the
+defaults, so ~0.85 GB per tissue on the full 2 mm grid and ~0.2 GB in-mask; signed sketches double that).
+Counts are uint16 and widen to uint32 (doubling the footprint) only once some voxel could hold more than
+65535 values, i.e. past 65535 controls in one sketch or merge.
+Counts simply add, so sketches built on separate shards, or extended with new controls later, merge
+exactly. Medians, MADs and arbitrary percentiles are read off the cumulative counts in voxel chunks.
+Error Bounds:
+    Buckets map values monotonically, so a quantile is the representative of the true (lower) quantile:
+    within alpha x |q - center| + min_value of it. The MAD is a spread, not a magnitude, and its error is
+    bounded by alpha x MAD + 2 x alpha x |median - center| + 2 x min_value. With center = 0 the middle term
+    is relative to the median itself: on tissue values whose MAD is a few percent of the median, a one-pass
+    MAD is off by tens of percent. A centered sketch (center = a first-pass median) holds x - center,
+    which makes that term 2 x alpha^2 x |median|, leaving about alpha x MAD. mad_error_bound() gives the
+    first-order bound per voxel.
+"""
+from __future__ import annotations
+from typing import Dict, Iterable
+
+import numpy as np
+
+MAD_SCALE = 1.4826                                                       # MAD -> SD for normally distributed data
+CHUNK_CELLS = 1 << 24                                                    # voxels x buckets handled per step
+NARROW_MAX = np.iinfo(np.uint16).max                                     # largest per-voxel count held as uint16
+
+
+class QuantileSketch:
+    """
+    Per-voxel log-bucketed histograms over the same bucket layout.
+    Non-finite values are skipped. Unsigned sketches count negative values in the zero bucket.
+    With a per-voxel center, x - center is sketched (always signed) and added back on every read.
+    """
+    STATE_KEYS = ("counts", "alpha", "min_value", "max_value", "signed", "center")
+
+    def __init__(self, n_voxels: int, alpha: float = 0.02, min_value: float = 1e-6, max_value: float = 1e2, signed: bool = False,
+                 center: np.ndarray | None = None):
+        self.center = None if center is None else np.asarray(center, dtype=np.float64)
+        signed = signed or self.center is not None
+        self.alpha, self.min_value, self.max_value, self.signed = float(alpha), float(min_value), float(max_value), bool(signed)
+        self._log_gamma = np.log((1 + alpha) / (1 - alpha))
+        self._k_min = int(np.floor(np.log(min_value) / self._log_gamma))
+        self._n_log = int(np.ceil(np.log(max_value) / self._log_gamma)) - self._k_min + 1
+        self._zero = self._n_log if signed else 0                       # bucket index of zero
+        self.n_buckets = 2 * self._n_log + 1 if signed else self._n_log + 1
+        self.counts = np.zeros((n_voxels, self.n_buckets), dtype=np.uint16)
+        self._total = 0                                                  # upper bound on any voxel's count
+        gamma = np.exp(self._log_gamma)
+        mags = 2 * gamma ** (np.arange(self._n_log) + self._k_min) / (gamma + 1)
+        self.values = np.concatenate([-mags[::-1], [0.0], mags]) if signed else np.concatenate([[0.0], mags])
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {"counts": self.counts, "alpha": np.array(self.alpha), "min_value": np.array(self.min_value),
+                "max_value": np.array(self.max_value), "signed": np.array(self.signed),
+                "center": np.empty(0) if self.center is None else self.center}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray]) -> "QuantileSketch":
+        center = state.get("center")                                     # absent from partials written before centering
+        sketch = cls(state["counts"].shape[0], float(state["alpha"]), float(state["min_value"]), float(state["max_value"]), bool(state["signed"]),
+                     center if center is not None and center.size else None)
+        counts = np.asarray(state["counts"])                             # uint32 in partials written before uint16 counts
+        sketch._total = int(counts.sum(axis=1, dtype=np.int64).max(initial=0))
+        sketch.counts = counts.astype(np.uint16 if sketch._total <= NARROW_MAX else np.uint32)
+        return sketch
+
+    @property
+    def n(self) -> np.ndarray:
+        return self.counts.sum(axis=1, dtype=np.int64)
+
+    def _reserve(self, extra: int) -> None:
+        """Account for up to `extra` more values per voxel, widening counts to uint32 before uint16 could wrap."""
+        self._total += int(extra)
+        if self.counts.dtype == np.uint16 and self._total > NARROW_MAX:
+            self.counts = self.counts.astype(np.uint32)
+
+    def _bucket(self, block: np.ndarray) -> np.ndarray:
+        mag = np.abs(block)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            k = np.ceil(np.log(np.maximum(mag, self.min_value)) / self._log_gamma) - self._k_min
+        k = np.clip(k, 0, self._n_log - 1).astype(np.int64)
+        small = mag < self.min_value
+        if not self.signed:
+            return np.where(small | (block < 0), 0, k + 1)
+        return np.where(small, self._zero, np.where(block > 0, self._zero + 1 + k, self._zero - 1 - k))
+
+    def _voxel_chunks(self) -> Iterable[slice]:
+        step = max(1, CHUNK_CELLS // self.n_buckets)
+        for start in range(0, len(self.counts), step):
+            yield slice(start, min(start + step, len(self.counts)))
+
+    def update(self, block: np.ndarray) -> None:
+        """Fold a (voxels,) vector or (voxels x subjects) block into the sketches."""
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        self._reserve(block.shape[1])
+        for rows in self._voxel_chunks():
+            part = block[rows] if self.center is None else block[rows] - self.center[rows, np.newaxis]
+            valid = np.isfinite(part)
+            flat = (np.arange(part.shape[0])[:, np.newaxis] * self.n_buckets + self._bucket(np.where(valid, part, 0)))[valid]
+            self.counts[rows] += np.bincount(flat, minlength=part.shape[0] * self.n_buckets).reshape(part.shape[0], -1).astype(self.counts.dtype)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Exact merge of a sketch over the same voxels and bucket layout."""
+        if other.counts.shape != self.counts.shape or (other.alpha, other.min_value, other.max_value, other.signed) != \
+                (self.alpha, self.min_value, self.max_value, self.signed):
+            raise ValueError("Cannot merge sketches with different voxels or bucket parameters.")
+        if (other.center is None) != (self.center is None) or (self.center is not None and not np.array_equal(other.center, self.center, equal_nan=True)):
+            raise ValueError("Cannot merge sketches with different centers.")
+        self._reserve(other._total)
+        self.counts += other.counts
+
+    @staticmethod
+    def _weighted_quantile(values: np.ndarray, counts: np.ndarray, q: float) -> np.ndarray:
+        """Per-row lower q-quantile of `values` (sorted along axis 1) weighted by counts. NaN for empty rows."""
+        cum = counts.cumsum(axis=1, dtype=np.int64)
+        n = cum[:, -1]
+        rank = np.floor(q * np.maximum(n - 1, 0))
+        idx = np.minimum((cum <= rank[:, np.newaxis]).sum(axis=1), counts.shape[1] - 1)
+        out = np.take_along_axis(values, idx[:, np.newaxis], axis=1)[:, 0] if values.ndim == 2 else values[idx]
+        return np.where(n > 0, out, np.nan)
+
+    def quantile(self, q: float) -> np.ndarray:
+        """Voxelwise q-quantile (0 <= q <= 1)."""
+        out = np.empty(len(self.counts))
+        for rows in self._voxel_chunks():
+            out[rows] = self._weighted_quantile(self.values, self.counts[rows], q)
+        return out if self.center is None else out + self.center
+
+    def median_mad(self) -> tuple:
+        """Voxelwise median and median absolute deviation from it (see Error Bounds)."""
+        median = self.quantile(0.5)
+        offset = median if self.center is None else median - self.center
+        mad = np.empty(len(self.counts))
+        for rows in self._voxel_chunks():
+            dev = np.abs(self.values[np.newaxis, :] - offset[rows, np.newaxis])
+            order = np.argsort(dev, axis=1, kind="stable")
+            mad[rows] = self._weighted_quantile(np.take_along_axis(dev, order, axis=1),
+                                                np.take_along_axis(self.counts[rows], order, axis=1), 0.5)
+        return median, mad
+
+    def mad_error_bound(self, median: np.ndarray | None = None, mad: np.ndarray | None = None) -> np.ndarray:
+        """First-order voxelwise bound on |MAD error|: alpha x MAD + 2 x alpha x |median - center| + 2 x min_value."""
+        if median is None or mad is None:
+            median, mad = self.median_mad()
+        offset = np.abs(median if self.center is None else median - self.center)
+        return self.alpha * mad + 2 * self.alpha * offset + 2 * self.min_value
+
+    def robust_stats(self) -> tuple:
+        """(median, MAD_SCALE x MAD): a location/scale pair usable in place of (mean, std)."""
+        median, mad = self.median_mad()
+        return median, MAD_SCALE * mad
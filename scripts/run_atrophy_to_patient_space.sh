@@ -3,12 +3,13 @@
 DATA_DIR=${DATA_DIR:-/root/data}
 SESSION=${SESSION:-ses-01}
 THREADS=${THREADS:-1}
+PLAN_CACHE_DIR=${PLAN_CACHE_DIR:-}           # opt-in: directory for warp coordinate plans (~138 MB each), reused across runs
 ATROPHY_PATTERNS=("*composite*.nii*")
 
 echo "Scanning ${DATA_DIR} for ${SESSION} sessions..."
 
 # Loop over session directories
-find "${DATA_DIR}" -type d -path "*/${SESSION}" | while read -r SES_DIR; do
+python "${SCRIPT_DIR:-/root/scripts}/bids_index.py" find --root "${DATA_DIR}" --pattern "**/${SESSION}" --dirs | while read -r SES_DIR; do
   echo "Processing ${SES_DIR}"
   ATROPHY_DIR="${SES_DIR}/unthresholded_tissue_segment_z_scores"
   MRI_DIR="${SES_DIR}/mri"
@@ -28,36 +29,33 @@ find "${DATA_DIR}" -type d -path "*/${SESSION}" | while read -r SES_DIR; do
     continue
   fi
 
+  input_files=()
+  native_files=()
   for atrophy_file in "${atrophy_files[@]}"; do
     [[ "$(basename "${atrophy_file}")" == ._* ]] && continue
     ATROPHY_BASE="$(basename "${atrophy_file}")"
     ATROPHY_BASE="${ATROPHY_BASE%.nii.gz}"
     ATROPHY_BASE="${ATROPHY_BASE%.nii}"
-
-    # 2) Clean up the atrophy
-    echo "  Masking atrophy file: ${atrophy_file##*/}"
-    if ! python /root/scripts/clean_atrophy.py \
-      --i "${atrophy_file}" \
-      --m "/root/assets/MNI152_T1_2mm_brain_mask.nii" \
-      --o "${OUT_DIR}/${ATROPHY_BASE}_cleaned.nii.gz" \
-      --l "false"; then
-      echo "ERROR: cleaning atrophy for ${ATROPHY_BASE}; skipping to next."
-      continue
-    fi
-
-    # 3) Run python warp
-    echo "  Warping atrophy: ${ATROPHY_BASE}"
-    echo "  with ${iwarp_file##*/}"
-    if ! python /root/scripts/apply_warp_python.py \
-      --i       "${OUT_DIR}/${ATROPHY_BASE}_cleaned.nii.gz" \
-      --o       "${OUT_DIR}/${ATROPHY_BASE}_cleaned_native.nii.gz" \
-      --field   "${iwarp_file}"; then
-      echo "ERROR: apply_warp_python.py for ${ATROPHY_BASE}; skipping to next."
-      continue
-    fi
-
-    # 4) Clean up
-    rm "${OUT_DIR}/${ATROPHY_BASE}_cleaned.nii.gz"
+    input_files+=("${atrophy_file}")
+    native_files+=("${OUT_DIR}/${ATROPHY_BASE}_cleaned_native.nii.gz")
   done
+  [[ "${#input_files[@]}" -eq 0 ]] && continue
+
+  # 2) Clean (as clean_atrophy.py) and warp every map in one process, with no intermediate files;
+  #    the coordinate plan is computed once in memory (or mapped from PLAN_CACHE_DIR when set)
+  plan_args=()
+  [[ -n "${PLAN_CACHE_DIR}" ]] && plan_args=(--plan-cache "${PLAN_CACHE_DIR}")
+  echo "  Masking and warping ${#input_files[@]} atrophy maps"
+  echo "  with ${iwarp_file##*/}"
+  if ! python "${SCRIPT_DIR:-/root/scripts}/apply_warp_python.py" \
+    --i           "${input_files[@]}" \
+    --o           "${native_files[@]}" \
+    --field       "${iwarp_file}" \
+    --clean-mask  "/root/assets/MNI152_T1_2mm_brain_mask.nii" \
+    --clean-limit "false" \
+    --threads     "${THREADS}" \
+    "${plan_args[@]}"; then
+    echo "ERROR: apply_warp_python.py for ${SES_DIR}; skipping to next."
+  fi
 done
 echo "All atrophy warps completed"
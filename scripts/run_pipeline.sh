@@ -4,6 +4,7 @@ set -euo pipefail
 echo "=== Starting neuroimaging pipeline ==="
 
 THREADS=${THREADS:-1}
+SEGMENT_JOBS=${SEGMENT_JOBS:-1}
 SESSION=${SESSION:-ses-01}
 T1_DIR=${T1_DIR:-anat}
 T1_FILE=${T1_FILE:-T1}
@@ -22,19 +23,27 @@ echo "SESSION=$SESSION"
 echo "T1_DIR=$T1_DIR"
 echo "T1_FILE=$T1_FILE"
 echo "THREADS=$THREADS"
+echo "SEGMENT_JOBS=$SEGMENT_JOBS"
 
 echo "=== Validating input T1 images ==="
-T1_FILES=$(find "${DATA_DIR}" -type f -path "*/${SESSION}/${T1_DIR}/*${T1_FILE}*.nii*" ! -name "._*" | sort || true)
+T1_FILES=$(python "${SCRIPT_DIR}/bids_index.py" find \
+    --root    "${DATA_DIR}" \
+    --pattern "**/${SESSION}/${T1_DIR}/*${T1_FILE}*.nii*" || true)
 if [[ -z "${T1_FILES}" ]]; then
   echo "No T1-weighted NIfTI files found under ${DATA_DIR}/*/${SESSION}/${T1_DIR}. Ensure Step 0 placed files (e.g., ${DATA_DIR}/subject-01/${SESSION}/${T1_DIR}/*${T1_FILE}*.nii*)."
   exit 1
 fi
 echo "${T1_FILES}"
 
-echo "=== Step 1: CAT12 segmentation ==="
-while IFS= read -r T1_FILE; do
-  bash "${SCRIPT_DIR}/run_segmentation_single.sh" "$T1_FILE"
-done <<< "$T1_FILES"
+# Split THREADS across the concurrent jobs (at least 1 each) so SEGMENT_JOBS > 1 does not oversubscribe the cores.
+# The CAT12 standalone (MATLAB Runtime) ignores THREADS and the OpenMP/BLAS variables, so each job is pinned to
+# its own JOB_THREADS-core slice instead: xargs numbers its job slots in SEGMENT_SLOT, and
+# run_segmentation_single.sh runs CAT12 under taskset on cores [SEGMENT_SLOT * JOB_THREADS, + JOB_THREADS).
+JOB_THREADS=$(( THREADS / SEGMENT_JOBS ))
+(( JOB_THREADS >= 1 )) || JOB_THREADS=1
+echo "=== Step 1: CAT12 segmentation (${SEGMENT_JOBS} concurrent jobs x ${JOB_THREADS} cores) ==="
+printf '%s\n' "${T1_FILES}" | JOB_THREADS="${JOB_THREADS}" \
+    xargs -d '\n' -P "${SEGMENT_JOBS}" --process-slot-var=SEGMENT_SLOT -I{} bash "${SCRIPT_DIR}/run_segmentation_single.sh" {}
 
 echo "=== Step 1.1: Resampling CAT12 Segments ==="
 python "${SCRIPT_DIR}/run_resample_bids.py" \
@@ -9,6 +9,8 @@ from typing import Iterable, List
 import nibabel as nib
 from nilearn.image import resample_to_img
 
+from bids_index import open_index
+
 
 DEFAULT_MASK = Path("/root/assets/MNI152_T1_2mm_brain_mask.nii")
 
@@ -29,9 +31,14 @@ def derive_output_path(inp_path: Path) -> Path:
 
 
 def iter_inputs(base: Path, patterns: Iterable[str]) -> Iterable[Path]:
-    """Yield input files matching the provided glob patterns under base."""
+    """Yield input files matching the provided glob patterns under base (at any depth, as Path.rglob)."""
+    index = open_index(base)
+    seen = set()
     for pattern in patterns:
-        yield from base.rglob(pattern)
+        for path in index.rglob(pattern):
+            if path not in seen:
+                seen.add(path)
+                yield path
 
 
 def resample_file(inp_path: Path, ref_path: Path, interpolation: str, overwrite: bool) -> Path | None:
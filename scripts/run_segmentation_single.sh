@@ -17,7 +17,15 @@ if find "$SUBJECT_DIR" -type f -iname "*mwp*" -print -quit 2>/dev/null | grep .
   echo "Segmentation already completed for: $T1_FILE. Skipping."
 else
   echo "Running CAT12 segmentation on: $T1_FILE"
-  ${CAT_SCRIPTS}/cat_standalone.sh -b /root/scripts/cat_standalone_segment_calvin.m "$T1_FILE"
+  # run_pipeline.sh sets SEGMENT_SLOT/JOB_THREADS for concurrent jobs: pin this one to its slice of the cores
+  PIN=()
+  if [[ -n "${SEGMENT_SLOT:-}" && -n "${JOB_THREADS:-}" ]] && command -v taskset > /dev/null; then
+    FIRST_CORE=$(( SEGMENT_SLOT * JOB_THREADS ))
+    if (( FIRST_CORE + JOB_THREADS <= $(nproc) )); then
+      PIN=(taskset -c "${FIRST_CORE}-$(( FIRST_CORE + JOB_THREADS - 1 ))")
+    fi
+  fi
+  "${PIN[@]}" ${CAT_SCRIPTS}/cat_standalone.sh -b "${SCRIPT_DIR:-/root/scripts}/cat_standalone_segment_calvin.m" "$T1_FILE"
   echo "Segmentation completed for: $T1_FILE"
 fi
 
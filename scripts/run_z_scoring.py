@@ -17,20 +17,56 @@ Control Statistics:
                         (grey_matter_mean.nii, grey_matter_std.nii, etc.)
     --gm-mean, --gm-std, --wm-mean, --wm-std, --csf-mean, --csf-std,
     --composite-mean, --composite-std: Individual override paths for specific statistics
+    --stats-cache: Directory of memory-mapped, mask-compressed float32 packs of the statistics, keyed by
+                   content hash. Built on first use, then mapped at near-zero cost. Implies --mask-compress.
+    --normative-bank: Mapped stack of several normative cohorts (see normative_bank.py). Each subject is
+                      scored against the cohort --participants assigns it, so mixed cohorts run in one pass.
+    --participants, --cohort-column, --age-column, --age-bracket NAME=LO:HI, --default-cohort:
+                      Cohort assignment for --normative-bank
+    --w-pack: Covariate-adjusted W-scores (see w_scoring.py; fit with build_control_stats.py fit-w). Each
+              block's expected maps are one matrix product of the pack coefficients and the block's
+              covariates (--covariates table, TIV from get_tiv). Written to *_tissue_segment_w_scores.
+    --covariates: Participants table holding the covariates the --w-pack was fitted on
 File Matching Patterns:
     --controls-gm-pattern, --controls-wm-pattern, --controls-csf-pattern: Glob patterns
                                                                            for control files
     --experiments-gm-pattern, --experiments-wm-pattern, --experiments-csf-pattern: Glob
                                                                                     patterns for experimental files
+    Patterns are matched against the persistent directory index (bids_index.py), not a fresh walk of the tree.
 Subject ID Processing:
     --pre-subject-str: String prefix to remove from column names (default: "")
     --post-subject-str: String suffix to remove from column names (default: "_mwp")
 Output Options:
     --session: Session label for BIDS output (default: "ses-01")
     --mask-path: Reference mask for NIfTI output (default: root/assets/MNI152_T1_2mm_brain_mask.nii)
+    --mask-compress: Gather every volume to in-mask voxels at load time and only scatter back to
+                     the full grid when writing NIfTIs (~4x less memory and arithmetic). Each file's
+                     full-volume sum is kept from the decode, so TIV matches an uncompressed run.
+    --compress-check: Decode the first N subjects mask-compressed and on the full grid and fail unless
+                      TIV and z-scores agree (relative 1e-6)
     --unthresholded-analysis: Output folder name for z-scores (default: unthresholded_tissue_segment_z_scores)
     --thresholded-analysis: Output folder name for thresholded z-scores (default: thresholded_tissue_segment_z_scores)
     --dry-run: Preview output paths without writing files
+    --sparse-thresholded: Store thresholded maps in a cohort-level CSR store (voxel index/value per subject)
+                          instead of dense NIfTIs; densify or query it with sparse_store.py
+    --incremental: Skip subjects whose manifest record (input hashes/mtimes, control-stats fingerprint,
+                   code version, options) still matches and whose outputs exist
+    --manifest: Manifest path for --incremental (default: zscore_manifest-<hash>.json in the BIDS index cache dir)
+Memory Options:
+    --subject-block: Subjects decoded and held in memory at once (default: 100)
+    --voxel-chunk: Voxels z-scored per step when streaming against pre-calculated stats (default: 50000)
+    --io-workers: Concurrent NIfTI decoders for GM/WM/CSF loading (default: 1, serial)
+    --io-backend: "thread" (decode straight into the shared array) or "process" (default: thread)
+    --write-workers: Threads compressing and writing output NIfTIs; the mask geometry is read once (default: 1)
+Numeric Options:
+    --leave-one-out: With --controls-root, z-score each control against the other N-1 controls in one
+                     vectorized pass (running sums and centered sums of squares) before building the
+                     control composite distribution, instead of process_atrophy(ctrl, ctrl)
+    --dtype: Voxel tensor dtype from load to write, float32 or float64 (default: float32)
+    --dtype-check: Score the first subject block as configured and through the float64 pandas reference
+                   path, and fail if z-scores or composites differ by more than this absolute tolerance (e.g. 1e-3)
+    --kernel: "fused" computes z, thresholded z and the composite in one NumPy pass per voxel chunk;
+              "pandas" is the reference prepocess_dict/generate_tensor/generate_norm path (default: fused)
 Outputs:
     Z-scored NIfTI files for grey matter, white matter, CSF, and composite atrophy measures
     saved in BIDS format under the specified analysis directories.
@@ -39,8 +75,7 @@ from __future__ import annotations
 import os
 import argparse
 from pathlib import Path
-from typing import Dict, Iterable, List
-from glob import glob
+from typing import Callable, Dict, Iterable, List
 
 import numpy as np
 import pandas as pd
@@ -48,10 +83,26 @@ import pandas as pd
 import nibabel as nib
 from calvin_utils.neuroimaging_utils.nifti_utils.matrix_utilities import import_nifti_to_numpy_array
 from calvin_utils.vbm_utils.composite_atrophy_mapper import generate_norm_map, prepocess_dict, generate_tensor, generate_norm
-from calvin_utils.vbm_utils.processing import get_tiv, process_atrophy, process_tissue
+from calvin_utils.vbm_utils.processing import get_tiv, process_tissue
+from bids_index import index_glob
+from nifti_writer import MaskGeometry, NiftiWriter
+from normative_bank import NormativeBank, assign_cohorts, parse_bracket
+from segment_loading import _load_dfs, _with_volume_rest, load_mask_index, process_atrophy_full_tiv, segment_tiv
+from sparse_store import SparseStore
+from stats_cache import load_stats_pack, stats_fingerprint
+from w_scoring import WScorePack, w_pack_fingerprint, w_stats_for
+from zscore_manifest import ZScoreManifest, code_version, manifest_path
 
 DEFAULT_MASK = Path("/root/assets/MNI152_T1_2mm_brain_mask.nii")
-MAX_BATCH_SIZE = 100
+DEFAULT_SUBJECT_BLOCK = 100
+DEFAULT_VOXEL_CHUNK = 50_000
+DTYPES = {"float32": np.float32, "float64": np.float64}
+COMPOSITE_TISSUES = ("grey_matter", "cerebrospinal_fluid")            # prepocess_dict drops WM from the composite
+OUTPUT_TISSUES = ("grey_matter", "white_matter", "cerebrospinal_fluid", "composite")
+ANALYSES = ("unthresholded_tissue_segment_z_scores", "thresholded_tissue_segment_z_scores")
+W_ANALYSES = ("unthresholded_tissue_segment_w_scores", "thresholded_tissue_segment_w_scores")
+COMPRESS_RTOL = 1e-6                                                    # --compress-check tolerance (float64 both ways)
+STAT_OVERRIDES = ("gm_mean", "gm_std", "wm_mean", "wm_std", "csf_mean", "csf_std", "composite_mean", "composite_std")
 
 def _subject_key(path: Path) -> str:
     parts = path.parts
@@ -62,29 +113,17 @@ def _subject_key(path: Path) -> str:
     return subj or str(path)
 
 def _glob_map(base_dir: Path, pattern: str) -> Dict[str, Path]:
-    files = (Path(p) for p in sorted(glob(str(base_dir / pattern))))
+    files = index_glob(base_dir, pattern)
     return {_subject_key(p): p for p in files}
 
-def _load_df(files: Iterable[Path]) -> pd.DataFrame:
-    arrays = []
-    cols = []
-    for f in files:
-        arr = import_nifti_to_numpy_array(str(f))
-        if arr is None:
-            continue
-        cols.append(str(f))
-        arrays.append(np.asarray(arr).flatten())
-    if not arrays:
-        return pd.DataFrame()
-    data = np.stack(arrays, axis=1)
-    return pd.DataFrame(data, columns=cols)
-
-def _segments_from_maps(gm_map, wm_map, csf_map, subjects: List[str]) -> Dict[str, "pd.DataFrame"]:
-    return {
-        "grey_matter": _load_df(gm_map[s] for s in subjects),
-        "white_matter": _load_df(wm_map[s] for s in subjects),
-        "cerebrospinal_fluid": _load_df(csf_map[s] for s in subjects),
+def _segments_from_maps(gm_map, wm_map, csf_map, subjects: List[str], voxel_index: np.ndarray | None = None,
+                        io_workers: int = 1, io_backend: str = "thread", dtype=np.float32) -> Dict[str, "pd.DataFrame"]:
+    files_by_tissue = {
+        "grey_matter": [gm_map[s] for s in subjects],
+        "white_matter": [wm_map[s] for s in subjects],
+        "cerebrospinal_fluid": [csf_map[s] for s in subjects],
     }
+    return _load_dfs(files_by_tissue, voxel_index, io_workers, io_backend, dtype)
 
 def run_pipeline(args: argparse.Namespace) -> None:
     """
@@ -95,6 +134,8 @@ def run_pipeline(args: argparse.Namespace) -> None:
     # Prep
     use_precalc_stats = any(
         [
+            args.w_pack,
+            args.normative_bank,
             args.control_stats_dir,
             args.gm_mean,
             args.gm_std,
@@ -108,6 +149,8 @@ def run_pipeline(args: argparse.Namespace) -> None:
     )
     if not use_precalc_stats and not args.controls_root:
         raise SystemExit("Provide either a control directory or pre-calculated control stats.")
+    voxel_index = load_mask_index(args.mask_path) if args.mask_compress or args.stats_cache or args.normative_bank or args.w_pack else None
+    dtype = DTYPES[args.dtype]
 
     # Imports
     ctrl_segments = None
@@ -119,8 +162,13 @@ def run_pipeline(args: argparse.Namespace) -> None:
         ctrl_subjects = sorted(set(ctrl_gm) & set(ctrl_wm) & set(ctrl_csf))
         if not ctrl_subjects:
             raise SystemExit("No overlapping control subjects found across GM/WM/CSF patterns.")
-        ctrl_segments = _segments_from_maps(ctrl_gm, ctrl_wm, ctrl_csf, ctrl_subjects)
-        z_ctrl, _, _ = process_atrophy(data_dict=ctrl_segments, ctrl_dict=ctrl_segments)
+        if args.compress_check and voxel_index is not None:
+            check_mask_compress(args, ctrl_gm, ctrl_wm, ctrl_csf, ctrl_subjects, voxel_index)
+        ctrl_segments = _segments_from_maps(ctrl_gm, ctrl_wm, ctrl_csf, ctrl_subjects, voxel_index, args.io_workers, args.io_backend, dtype)
+        if args.leave_one_out:
+            z_ctrl = leave_one_out_z_scores(ctrl_segments, dtype)
+        else:
+            z_ctrl, _, _ = process_atrophy_full_tiv(data_dict=ctrl_segments, ctrl_dict=ctrl_segments)
 
     gm_map = _glob_map(args.experiments_root, args.experiments_gm_pattern)
     wm_map = _glob_map(args.experiments_root, args.experiments_wm_pattern)
@@ -129,37 +177,302 @@ def run_pipeline(args: argparse.Namespace) -> None:
     if not subjects:
         raise SystemExit("No overlapping experimental subjects found across GM/WM/CSF patterns.")
 
-    stats = load_control_stats(args) if use_precalc_stats else None
-    total = len(subjects)
-    batch_size = min(MAX_BATCH_SIZE, total) if total > MAX_BATCH_SIZE else total
-
-    for i in range(0, total, batch_size):
-        batch = subjects[i:i + batch_size]
-        expt_segments = _segments_from_maps(gm_map, wm_map, csf_map, batch)
-
-        if use_precalc_stats:
-            atrophy, atrophy_thresholded = compute_z_with_precalc_stats(expt_segments, stats)
-            composite = compute_composite_with_precalc_stats(atrophy, stats)
-        else:
-            atrophy, atrophy_thresholded, _ = process_atrophy(expt_segments, ctrl_segments)
+    if use_precalc_stats:
+        for label, group, stats_for, fingerprint in _stats_sources(args, subjects, voxel_index):
+            if label is not None:
+                print(f"{label}: {len(group)} subjects")
+            on_written = None
+            if args.incremental:
+                group, on_written = select_stale_subjects(args, gm_map, wm_map, csf_map, group, fingerprint())
+                if not group:
+                    continue
+            if args.compress_check and voxel_index is not None:
+                check_mask_compress(args, gm_map, wm_map, csf_map, group, voxel_index, stats_for)
+            if args.dtype_check is not None:
+                check_dtype_policy(args, gm_map, wm_map, csf_map, group, stats_for, voxel_index)
+            stream_precalc_z_scores(args, gm_map, wm_map, csf_map, group, stats_for, voxel_index, on_written)
+        return
+    if args.incremental or args.sparse_thresholded:
+        raise SystemExit("--incremental and --sparse-thresholded need pre-calculated control stats (--control-stats-dir or overrides).")
+
+    with NiftiWriter(MaskGeometry(args.mask_path), workers=args.write_workers) as writer:
+        for i in range(0, len(subjects), args.subject_block):
+            batch = subjects[i:i + args.subject_block]
+            expt_segments = _segments_from_maps(gm_map, wm_map, csf_map, batch, voxel_index, args.io_workers, args.io_backend, dtype)
+            atrophy, atrophy_thresholded, _ = process_atrophy_full_tiv(expt_segments, ctrl_segments)
             composite, _, _ = generate_norm_map(pt_dict=atrophy, ctrl_dict=z_ctrl)
-        atrophy["composite"] = composite
-        atrophy_thresholded["composite"] = composite.where(composite > 0, 0)
-
-        save_df_to_nifti_bids(
-            atrophy,
-            root=args.experiments_root,
-            mask_path=args.mask_path,
-            analysis="unthresholded_tissue_segment_z_scores",
-            ses=args.session,
-        )
-        save_df_to_nifti_bids(
-            atrophy_thresholded,
-            root=args.experiments_root,
-            mask_path=args.mask_path,
-            analysis="thresholded_tissue_segment_z_scores",
-            ses=args.session,
-        )
+            atrophy["composite"] = composite
+            atrophy_thresholded["composite"] = composite.where(composite > 0, 0)
+
+            save_df_to_nifti_bids(
+                atrophy,
+                root=args.experiments_root,
+                mask_path=args.mask_path,
+                analysis="unthresholded_tissue_segment_z_scores",
+                ses=args.session,
+                voxel_index=voxel_index,
+                writer=writer,
+            )
+            save_df_to_nifti_bids(
+                atrophy_thresholded,
+                root=args.experiments_root,
+                mask_path=args.mask_path,
+                analysis="thresholded_tissue_segment_z_scores",
+                ses=args.session,
+                voxel_index=voxel_index,
+                writer=writer,
+            )
+
+
+def _stats_sources(args: argparse.Namespace, subjects: List[str], voxel_index: np.ndarray | None = None):
+    """
+    Group subjects by the normative reference they are scored against: one group for --control-stats-dir
+    (or overrides) and for --w-pack, one per cohort for --normative-bank.
+    
+    :return: Yields (label or None, subject keys, stats_for, fingerprint). stats_for(batch, segments, dtype) gives
+             the stats to score that block against; fingerprint() identifies them for --incremental.
+    """
+    if args.w_pack:
+        pack = WScorePack(args.w_pack, voxel_index)
+        yield "W-scores", subjects, w_stats_for(pack, args.covariates, segment_tiv), lambda: w_pack_fingerprint(args.w_pack, args.covariates)
+        return
+    if args.normative_bank:
+        bank = NormativeBank(args.normative_bank, voxel_index)
+        groups = assign_cohorts(subjects, args.participants, bank.cohorts, args.cohort_column, args.age_column,
+                                args.age_bracket, args.default_cohort) if args.participants else {args.default_cohort: subjects}
+        for cohort, group in groups.items():
+            yield f"Cohort {cohort}", group, (lambda batch, segments, dtype, c=cohort: bank.stats(c, dtype)), (lambda c=cohort: bank.fingerprints[c])
+        return
+    loaded = {}
+
+    def stats_for(batch, segments, dtype):
+        if dtype not in loaded:
+            loaded[dtype] = load_control_stats(args, voxel_index, dtype)
+        return loaded[dtype]
+    yield None, subjects, stats_for, lambda: stats_fingerprint(_control_stat_paths(args), args.mask_path)
+
+def output_analyses(args: argparse.Namespace):
+    """(unthresholded, thresholded) output folders: W-score folders with --w-pack, else z-score folders."""
+    return W_ANALYSES if getattr(args, "w_pack", None) else ANALYSES
+
+def _iter_voxel_chunks(n_voxels: int, chunk_size: int) -> Iterable[slice]:
+    """Yield contiguous row slices covering n_voxels, chunk_size rows at a time."""
+    for start in range(0, n_voxels, chunk_size):
+        yield slice(start, min(start + chunk_size, n_voxels))
+
+def _slice_stats(stats: dict, rows: slice) -> dict:
+    """Restrict every (mean, std) pair to the same voxel rows."""
+    return {k: (mean[rows], std[rows]) for k, (mean, std) in stats.items()}
+
+def _as_column(a: np.ndarray) -> np.ndarray:
+    """Broadcast a per-voxel statistic over subjects; (voxels x subjects) statistics (W-score expectations) pass through."""
+    return a if a.ndim == 2 else a[:, np.newaxis]
+
+def fused_z_kernel(processed: Dict[str, np.ndarray], stats: dict, z_out: Dict[str, np.ndarray], thr_out: Dict[str, np.ndarray]) -> None:
+    """
+    One pass from processed tissue values to unthresholded z, thresholded z and composite H-score.
+    
+    Equivalent to compute_z_with_precalc_stats + compute_composite_with_precalc_stats + the composite > 0
+    cut, but every result is written in place into contiguous (voxels x subjects) output rows; scratch is
+    limited to chunk-sized buffers. The composite is the L2 norm over COMPOSITE_TISSUES (the CSF sign
+    flip in prepocess_dict does not change the norm), z-scored against stats["composite"].
+    
+    :param processed: Dict. Tissue -> (voxels x subjects) process_tissue output for this chunk
+    :param stats: Dict. Same rows of the load_control_stats arrays. Tissue means may be (voxels x subjects).
+    :param z_out: Dict. Tissue/"composite" -> output rows for unthresholded maps
+    :param thr_out: Dict. Tissue/"composite" -> output rows for thresholded maps
+    """
+    sq = np.zeros_like(z_out["composite"])
+    for tissue, values in processed.items():
+        mean, std = stats[tissue]
+        z = z_out[tissue]
+        np.subtract(values, _as_column(mean), out=z)
+        np.divide(z, std[:, np.newaxis], out=z)
+        thr = thr_out[tissue]
+        thr.fill(0)
+        np.copyto(thr, z, where=(z > 2) if tissue == "cerebrospinal_fluid" else (z < -2))
+        if tissue in COMPOSITE_TISSUES:
+            sq += z * z
+    comp_mean, comp_std = stats["composite"]
+    comp = z_out["composite"]
+    np.sqrt(sq, out=comp)
+    comp -= comp_mean[:, np.newaxis]
+    comp /= comp_std[:, np.newaxis]
+    thr = thr_out["composite"]
+    thr.fill(0)
+    np.copyto(thr, comp, where=comp > 0)
+
+def _score_block(expt_segments: Dict[str, "pd.DataFrame"], stats: dict, voxel_chunk: int, dtype=np.float32, kernel: str = "fused", pt_tiv=None):
+    """
+    Score one block of subjects against precalculated stats, voxel_chunk voxels at a time.
+    
+    :param kernel: "fused" (fused_z_kernel) or "pandas" (the reference DataFrame path)
+    :param pt_tiv: TIV of the block's subjects (default: segment_tiv of expt_segments)
+    :return: (unthresholded, thresholded). Dicts of tissue/composite -> preallocated (voxels x subjects) arrays.
+    """
+    pt_tiv = segment_tiv(expt_segments) if pt_tiv is None else pt_tiv     # TIV needs whole volumes, so take it before chunking
+    first_key = next(iter(expt_segments))
+    n_voxels, n_subjects = expt_segments[first_key].shape
+    atrophy = {k: np.empty((n_voxels, n_subjects), dtype=dtype) for k in [*expt_segments, "composite"]}
+    atrophy_thresholded = {k: np.empty((n_voxels, n_subjects), dtype=dtype) for k in atrophy}
+    for rows in _iter_voxel_chunks(n_voxels, voxel_chunk):
+        chunk = {k: df.iloc[rows] for k, df in expt_segments.items()}
+        chunk_stats = _slice_stats(stats, rows)
+        if kernel == "fused":
+            processed = {k: process_tissue(df, pt_tiv, threshold=0.2).to_numpy(dtype=dtype, copy=False) for k, df in chunk.items()}
+            chunk_stats = {k: (np.asarray(m, dtype=dtype), np.asarray(sd, dtype=dtype)) for k, (m, sd) in chunk_stats.items()}
+            fused_z_kernel(processed, chunk_stats, {k: a[rows] for k, a in atrophy.items()}, {k: a[rows] for k, a in atrophy_thresholded.items()})
+            continue
+        z, z_thresholded = compute_z_with_precalc_stats(chunk, chunk_stats, pt_tiv=pt_tiv, dtype=dtype)
+        composite = compute_composite_with_precalc_stats(z, chunk_stats, dtype=dtype)
+        for k in expt_segments:
+            atrophy[k][rows] = z[k].values
+            atrophy_thresholded[k][rows] = z_thresholded[k].values
+        atrophy["composite"][rows] = composite.values
+        atrophy_thresholded["composite"][rows] = np.where(composite.values > 0, composite.values, 0)
+    return atrophy, atrophy_thresholded
+
+def stream_precalc_z_scores(args: argparse.Namespace, gm_map, wm_map, csf_map, subjects: List[str], stats_for: Callable,
+                            voxel_index: np.ndarray | None = None, on_written: Callable[[List[str]], None] | None = None) -> None:
+    """
+    Z-score subjects against precalculated control stats with bounded peak memory.
+    
+    Each subject is decoded exactly once, args.subject_block subjects at a time. A block is scored
+    args.voxel_chunk voxels at a time into preallocated outputs, and written to BIDS before the next
+    block is read. Peak memory therefore scales with subject_block x voxels, never with cohort size.
+    
+    :param args: Args from the command line.
+    :param gm_map: Dict. Subject key -> GM file (likewise wm_map, csf_map).
+    :param subjects: Subject keys to score, in output order.
+    :param stats_for: Callable(batch, segments, dtype) -> stats in the load_control_stats layout (see _stats_sources).
+    :param voxel_index: Optional flat in-mask indices (see --mask-compress).
+    :param on_written: Optional callback given each block's subject keys once its outputs are on disk.
+    """
+    dtype = DTYPES[args.dtype]
+    geometry = MaskGeometry(args.mask_path)
+    analyses = output_analyses(args)
+    store = SparseStore(args.sparse_thresholded, geometry.shape, geometry.affine, analyses[1]) if args.sparse_thresholded else None
+    with NiftiWriter(geometry, workers=args.write_workers) as writer:
+        for i in range(0, len(subjects), args.subject_block):
+            batch = subjects[i:i + args.subject_block]
+            expt_segments = _segments_from_maps(gm_map, wm_map, csf_map, batch, voxel_index, args.io_workers, args.io_backend, dtype)
+            stats = stats_for(batch, expt_segments, dtype)
+            atrophy, atrophy_thresholded = _score_block(expt_segments, stats, args.voxel_chunk, dtype, args.kernel)
+
+            first_key = next(iter(expt_segments))
+            index = expt_segments[first_key].index
+            columns = {k: df.columns for k, df in expt_segments.items()}
+            columns["composite"] = expt_segments[first_key].columns
+            del expt_segments, stats
+            if store is not None:
+                sources = list(columns["composite"])
+                store.append([_subject_key(Path(src)) for src in sources], sources, atrophy_thresholded, voxel_index)
+                del atrophy_thresholded
+            for analysis, arrays in zip(analyses, (atrophy, atrophy_thresholded) if store is None else (atrophy,)):
+                save_df_to_nifti_bids(
+                    {k: pd.DataFrame(arr, index=index, columns=columns[k]) for k, arr in arrays.items()},
+                    root=args.experiments_root,
+                    mask_path=args.mask_path,
+                    analysis=analysis,
+                    ses=args.session,
+                    voxel_index=voxel_index,
+                    writer=writer,
+                )
+            if on_written is not None:
+                writer.flush()
+                on_written(batch)
+            print(f"Scored {min(i + args.subject_block, len(subjects))}/{len(subjects)} subjects")
+
+def _subject_outputs(root: Path, gm_path: Path, analyses=ANALYSES) -> List[str]:
+    """Every output path a subject gets from the precalculated-stats path."""
+    return [bids_output_path(root, str(gm_path), analysis, tissue) for analysis in analyses for tissue in OUTPUT_TISSUES]
+
+def select_stale_subjects(args: argparse.Namespace, gm_map, wm_map, csf_map, subjects: List[str], stats_fp: str):
+    """
+    --incremental: keep only subjects whose inputs, control stats, code or options changed since the
+    manifest recorded them, or whose outputs are missing.
+    
+    :param stats_fp: stats_fingerprint of the control stats these subjects are scored against
+    :return: (subjects to score, callback that records a written block in the manifest)
+    """
+    manifest = ZScoreManifest(args.manifest or manifest_path(args.experiments_root))
+    context = {
+        "stats": stats_fp,
+        "code": code_version(),
+        "options": {"dtype": args.dtype, "kernel": args.kernel, "mask_compress": bool(args.mask_compress or args.stats_cache),
+                    "sparse_thresholded": str(args.sparse_thresholded) if args.sparse_thresholded else None},
+    }
+    inputs = {s: [gm_map[s], wm_map[s], csf_map[s]] for s in subjects}
+    analyses = output_analyses(args)[:1] if args.sparse_thresholded else output_analyses(args)
+    outputs = {s: _subject_outputs(args.experiments_root, gm_map[s], analyses) for s in subjects}
+    stale = [s for s in subjects if not manifest.is_current(s, inputs[s], context, outputs[s])]
+    print(f"Incremental: {len(subjects) - len(stale)} subjects up to date, {len(stale)} to score (manifest: {manifest.path})")
+
+    def on_written(batch: List[str]) -> None:
+        for s in batch:
+            manifest.record(s, inputs[s], context, outputs[s])
+        manifest.save()
+    return stale, on_written
+
+def check_dtype_policy(args: argparse.Namespace, gm_map, wm_map, csf_map, subjects: List[str], stats_for: Callable, voxel_index: np.ndarray | None = None) -> None:
+    """
+    Tolerance check of the configured --dtype/--kernel path against float64 + pandas on the first subject block.
+    
+    Unthresholded z-scores and composites must agree within args.dtype_check (absolute), with NaNs in the
+    same places. Thresholded maps can only differ where a value sits within rounding of the +/-2 cut-off,
+    so those flips are counted and reported rather than failed on.
+    """
+    batch = subjects[:args.subject_block]
+    dtype = DTYPES[args.dtype]
+    segments64 = _segments_from_maps(gm_map, wm_map, csf_map, batch, voxel_index, args.io_workers, args.io_backend, np.float64)
+    ref, ref_thr = _score_block(segments64, stats_for(batch, segments64, np.float64), args.voxel_chunk, np.float64, "pandas")
+    segments = _segments_from_maps(gm_map, wm_map, csf_map, batch, voxel_index, args.io_workers, args.io_backend, dtype)
+    out, out_thr = _score_block(segments, stats_for(batch, segments, dtype), args.voxel_chunk, dtype, args.kernel)
+    failed = []
+    for k in ref:
+        nan_ref, nan_out = ~np.isfinite(ref[k]), ~np.isfinite(out[k])
+        both = ~(nan_ref | nan_out)
+        err = float(np.abs(ref[k][both] - out[k][both]).max(initial=0.0))
+        flips = int(((ref_thr[k] != 0) != (out_thr[k] != 0)).sum())
+        print(f"dtype check [{args.dtype}/{args.kernel} vs float64/pandas] {k}: max |dz| = {err:.3g}, non-finite mismatches = {int((nan_ref != nan_out).sum())}, threshold flips = {flips}")
+        if err > args.dtype_check or (nan_ref != nan_out).any():
+            failed.append(k)
+    if failed:
+        raise SystemExit(f"{args.dtype}/{args.kernel} z-scores exceed tolerance {args.dtype_check} for: {', '.join(failed)}")
+
+
+def check_mask_compress(args: argparse.Namespace, gm_map, wm_map, csf_map, subjects: List[str], voxel_index: np.ndarray,
+                        stats_for: Callable | None = None) -> None:
+    """
+    --compress-check: decode the first N subjects both mask-compressed and on the full grid, in float64.
+    
+    The compressed TIV (segment_tiv, and get_tiv of the frames process_atrophy_full_tiv builds) must match
+    get_tiv of the full volumes, and with stats_for the compressed z-scores must match full-grid z-scores
+    read at the in-mask voxels, all within COMPRESS_RTOL.
+    """
+    batch = subjects[:args.compress_check]
+    full = _segments_from_maps(gm_map, wm_map, csf_map, batch, None, args.io_workers, args.io_backend, np.float64)
+    ref_tiv = get_tiv(full)
+    full_tiv = np.asarray(ref_tiv, dtype=np.float64)
+    full = {k: df.iloc[voxel_index].set_axis(voxel_index, axis=0) for k, df in full.items()}
+    packed = _segments_from_maps(gm_map, wm_map, csf_map, batch, voxel_index, args.io_workers, args.io_backend, np.float64)
+    failed = []
+    for label, tiv in (("TIV", segment_tiv(packed)), ("process_atrophy TIV", get_tiv(_with_volume_rest(packed)))):
+        err = float(np.max(np.abs(np.asarray(tiv, dtype=np.float64) - full_tiv) / np.abs(full_tiv), initial=0.0))
+        print(f"compress check [{len(batch)} subjects] {label}: max relative error = {err:.3g}")
+        if not err <= COMPRESS_RTOL:
+            failed.append(label)
+    if stats_for is not None:
+        stats = stats_for(batch, packed, np.float64)
+        ref, _ = _score_block(full, stats, args.voxel_chunk, np.float64, "pandas", pt_tiv=ref_tiv)
+        out, _ = _score_block(packed, stats, args.voxel_chunk, np.float64, "pandas")
+        for k in ref:
+            agree = np.isclose(out[k], ref[k], rtol=COMPRESS_RTOL, atol=COMPRESS_RTOL, equal_nan=True)
+            print(f"compress check [{len(batch)} subjects] {k}: {int((~agree).sum())} voxels differ")
+            if not agree.all():
+                failed.append(k)
+    if failed:
+        raise SystemExit(f"Mask-compressed output differs from full-grid output for: {', '.join(failed)}")
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -190,6 +503,24 @@ def build_parser() -> argparse.ArgumentParser:
                         help="Optional override path for composite norm mean NIfTI.")
     parser.add_argument("--composite-std", type=Path, default=None, 
                         help="Optional override path for composite norm std NIfTI.")
+    parser.add_argument("--stats-cache", type=Path, default=None,
+                        help="Directory for memory-mapped control stats packs keyed by content hash. Implies --mask-compress.")
+    parser.add_argument("--normative-bank", type=Path, default=None,
+                        help="Multi-cohort bank from normative_bank.py build. Replaces --control-stats-dir. Implies --mask-compress.")
+    parser.add_argument("--w-pack", type=Path, default=None,
+                        help="W-score pack from build_control_stats.py fit-w. Scores covariate-adjusted W-scores instead of z-scores. Implies --mask-compress.")
+    parser.add_argument("--covariates", type=Path, default=None,
+                        help="Participants CSV/TSV (participant_id, optional session_id) with the --w-pack covariate columns.")
+    parser.add_argument("--participants", type=Path, default=None,
+                        help="Participants CSV/TSV (participant_id, optional session_id) assigning each subject a bank cohort.")
+    parser.add_argument("--cohort-column", default=None,
+                        help="Participants column holding the cohort name.")
+    parser.add_argument("--age-column", default=None,
+                        help="Participants column holding age, mapped to cohorts by --age-bracket.")
+    parser.add_argument("--age-bracket", type=parse_bracket, action="append", default=None, metavar="NAME=LO:HI",
+                        help="Cohort for ages in [LO, HI). Repeatable; the first match wins.")
+    parser.add_argument("--default-cohort", default=None,
+                        help="Cohort for subjects the participants table does not assign (or all subjects without --participants).")
 
     # Args for Globbing out MWP files
     parser.add_argument("--controls-gm-pattern", default="*/*/anat/mri/mwp1*", 
@@ -216,6 +547,42 @@ def build_parser() -> argparse.ArgumentParser:
         help="Session label used when writing BIDS output (e.g. ses-01).")
     parser.add_argument("--mask-path", type=Path, default=DEFAULT_MASK,
         help=f"Reference mask for saving NIfTI outputs (default: {DEFAULT_MASK}).")
+    parser.add_argument("--sparse-thresholded", type=Path, default=None,
+        help="Append thresholded maps to this cohort-level sparse store (see sparse_store.py) instead of writing dense NIfTIs.")
+    parser.add_argument("--incremental", action="store_true",
+        help="Only score subjects whose inputs, control stats, code or options changed since the manifest recorded them.")
+    parser.add_argument("--manifest", type=Path, default=None,
+        help="Manifest used by --incremental (default: zscore_manifest-<hash of experiments root>.json under "
+             "$BIDS_INDEX_DIR, outside the data root).")
+    parser.add_argument("--mask-compress", action="store_true",
+        help="Keep only in-mask voxels from load to write. TIV still comes from the full volumes (sums taken before the gather).")
+    parser.add_argument("--compress-check", type=int, default=None, metavar="N",
+        help="Score the first N subjects mask-compressed and on the full grid, and fail unless TIV and z-scores agree.")
+
+    # Memory bounds
+    parser.add_argument("--subject-block", type=int, default=DEFAULT_SUBJECT_BLOCK,
+        help=f"Subjects decoded and held in memory at once (default: {DEFAULT_SUBJECT_BLOCK}).")
+    parser.add_argument("--voxel-chunk", type=int, default=DEFAULT_VOXEL_CHUNK,
+        help=f"Voxels scored per step against pre-calculated stats (default: {DEFAULT_VOXEL_CHUNK}).")
+
+    # Decoding
+    parser.add_argument("--io-workers", type=int, default=1,
+        help="Concurrent NIfTI decoders for GM/WM/CSF loading (default: 1, serial).")
+    parser.add_argument("--io-backend", choices=["thread", "process"], default="thread",
+        help="Pool type for --io-workers. Threads decode directly into the shared array (default: thread).")
+    parser.add_argument("--write-workers", type=int, default=1,
+        help="Threads compressing and writing output NIfTIs (default: 1, inline).")
+
+    # Numerics
+    parser.add_argument("--dtype", choices=list(DTYPES), default="float32",
+        help="dtype of every voxel tensor from load to write (default: float32).")
+    parser.add_argument("--dtype-check", type=float, default=None, metavar="TOL",
+        help="Compare the first subject block against the float64 pandas path and fail above this absolute z tolerance.")
+    parser.add_argument("--kernel", choices=["fused", "pandas"], default="fused",
+        help="Fused NumPy z/threshold/composite kernel, or the pandas reference path (default: fused).")
+    parser.add_argument("--leave-one-out", action="store_true",
+        help="With --controls-root, z-score each control against the other controls (closed form, one pass) "
+             "instead of against a distribution that includes itself.")
     return parser
 
 def _resolve_stat_path(base: Path | None, override: Path | None, name: str) -> Path:
@@ -233,7 +600,44 @@ def _resolve_stat_path(base: Path | None, override: Path | None, name: str) -> P
         raise SystemExit(f"Missing path for {name}. Provide --control-stats-dir or explicit --{name.replace('_', '-')}.")
     return base / f"{name}.nii.gz"
 
-def save_df_to_nifti_bids(dataframes_dict, root, mask_path, analysis='tissue_segment_z_scores', ses='ses-01'):
+def _extract_subid(root: Path, subj_path: str):
+    """Use the first folder after root as the subject ID (strip a leading sub- if present)."""
+    root = Path(root)
+    subj_path = Path(subj_path)
+    # Compare absolute forms of both sides, so a relative root matches paths globbed under it, and accept paths
+    # given relative to the root; fail loudly if neither places the file under root.
+    for candidate in dict.fromkeys((subj_path, root / subj_path)):
+        try:
+            relative = candidate.absolute().relative_to(root.absolute())
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError(f"{subj_path} is not under root {root}; ensure columns include paths relative to {root}")
+    if len(relative.parts) < 2:
+        raise ValueError(f"Expected subject/session folders under {root}, got: {relative}")
+
+    first = str(relative.parts[0])
+    # Strip common subject prefixes; fall back to the raw folder name.
+    for prefix in ("subject-", "subid-", "sub-"):
+        if first.startswith(prefix):
+            subid = first[len(prefix):]
+            break
+    else:
+        subid = first
+    sesfolder = relative.parts[1]
+    return subid, relative.parts[0], sesfolder
+
+def _construct_bids_path(root: Path, subfolder: Path, sesfolder: Path, subid: str, analysis: str, tissue_type: str):
+    output_name = f'sub-{subid}_{sesfolder}_{tissue_type}.nii.gz'
+    return os.path.join(root, subfolder, sesfolder, analysis, output_name)
+
+def bids_output_path(root: Path, src_path: str, analysis: str, tissue_type: str) -> str:
+    """Output path save_df_to_nifti_bids uses for a column named by src_path."""
+    subid, subfolder, sesfolder = _extract_subid(root, src_path)
+    return _construct_bids_path(root, subfolder, sesfolder, subid, analysis, tissue_type)
+
+def save_df_to_nifti_bids(dataframes_dict, root, mask_path, analysis='tissue_segment_z_scores', ses='ses-01', voxel_index=None, writer=None):
     """
     Saves NIFTI images to a BIDS-compliant directory structure.
 
@@ -243,43 +647,12 @@ def save_df_to_nifti_bids(dataframes_dict, root, mask_path, analysis='tissue_seg
         mask_path (str): Path to the mask file
         analysis (str, optional): Analysis folder name. Defaults to 'tissue_segment_z_scores'.
         ses (str, optional): Session identifier (e.g., 'ses-01'). Defaults to 'ses-01'.
+        voxel_index (np.ndarray, optional): Flat in-mask indices for mask-compressed DataFrames. Rows are
+            scattered back into the mask grid (zeros elsewhere). Defaults to None (rows already span the grid).
+        writer (NiftiWriter, optional): Shared writer (pool + cached mask geometry). Writes may still be pending
+            on return; they are flushed when the writer is closed. Defaults to None (inline writes, mask read once per call).
     """
-    def _extract_subid(root: Path, subj_path: str):
-        """Use the first folder after root as the subject ID (strip a leading sub- if present)."""
-        root = Path(root)
-        subj_path = Path(subj_path)
-        # Normalize to absolute under root; fail loudly if not possible.
-        if not subj_path.is_absolute():
-            subj_path = root / subj_path
-        try:
-            relative = subj_path.relative_to(root)
-        except ValueError as exc:
-            raise ValueError(f"{subj_path} is not under root {root}; ensure columns include paths relative to {root}") from exc
-        if len(relative.parts) < 2:
-            raise ValueError(f"Expected subject/session folders under {root}, got: {relative}")
-
-        first = str(relative.parts[0])
-        # Strip common subject prefixes; fall back to the raw folder name.
-        for prefix in ("subject-", "subid-", "sub-"):
-            if first.startswith(prefix):
-                subid = first[len(prefix):]
-                break
-        else:
-            subid = first
-        sesfolder = relative.parts[1]
-        return subid, relative.parts[0], sesfolder
-        
-    def _construct_bids_path(root: Path, subfolder: Path, sesfolder: Path, subid: str, analysis: str, tissue_type: str):
-        output_name = f'sub-{subid}_{sesfolder}_{tissue_type}.nii.gz'
-        return os.path.join(root, subfolder, sesfolder, analysis, output_name)
-    
-    def _make_nifti(arr):
-        mask_img = nib.load(str(mask_path))
-        mask_data = mask_img.get_fdata()
-        arr = arr.reshape(mask_data.shape)
-        return nib.Nifti1Image(arr, mask_img.affine)
-
-    def _save_nifti(img, out_path, overwrite=True):
+    def _save_nifti(arr, out_path, overwrite=True):
         if Path(out_path).exists() and not overwrite:
             print(f"Skipping. File already exists: {out_path}")
             return
@@ -287,65 +660,90 @@ def save_df_to_nifti_bids(dataframes_dict, root, mask_path, analysis='tissue_seg
             print(f"Overwriting: {out_path}")
         else: 
             print(f"Saving new: {out_path}")
-        Path(out_path).parent.mkdir(parents=True, exist_ok=True)
-        nib.save(img, out_path)
+        out_writer.submit(arr, out_path, voxel_index)
     
+    out_writer = writer if writer is not None else NiftiWriter(MaskGeometry(mask_path))
     for tissue_type, dataframe in dataframes_dict.items():
         for col in dataframe.columns:
-            subid, subfolder, sesfolder = _extract_subid(root, col)             # expects each column to be a full path to the file
-            out_path = _construct_bids_path(root, subfolder, sesfolder, subid, analysis, tissue_type)
-            nii_img = _make_nifti(dataframe[col].values)
-            _save_nifti(nii_img, out_path)
+            out_path = bids_output_path(root, col, analysis, tissue_type)    # expects each column to be a full path to the file
+            _save_nifti(dataframe[col].values, out_path)
+    if writer is None:
+        out_writer.close()
 
-def _load_flattened_nifti(path: Path) -> np.ndarray:
+def _load_flattened_nifti(path: Path, voxel_index: np.ndarray | None = None) -> np.ndarray:
     """
     Simple import to load a nifti directly into a flattened numpy array
     
     :param path: Path to the nifti
+    :param voxel_index: Optional flat in-mask indices. If given, only those voxels are returned.
     :return: np array containing the flattened nifti
     """
     arr = import_nifti_to_numpy_array(str(path))
     if arr is None:
         raise SystemExit(f"Could not read NIfTI: {path}")
-    return np.asarray(arr).flatten()
+    flat = np.asarray(arr).flatten()
+    return flat if voxel_index is None else flat[voxel_index]
 
 
-def load_control_stats(args: argparse.Namespace):
+def stats_dir_args(stats_dir: Path, mask_path: Path, stats_cache: Path | None = None) -> argparse.Namespace:
+    """Args for _control_stat_paths/load_control_stats naming one control-stats directory and no overrides."""
+    return argparse.Namespace(control_stats_dir=stats_dir, mask_path=mask_path, stats_cache=stats_cache, **{k: None for k in STAT_OVERRIDES})
+
+def _control_stat_paths(args: argparse.Namespace) -> Dict[str, tuple]:
     """
-    Loads in the precalculated normative files representing the control distribution.
+    Resolve the (mean, std) NIfTI paths of every statistic from --control-stats-dir and the overrides.
     
     :param args: Args from the command line.
-    :return: A dictionary with keys for each segment, and a tuple holding (mean, stdev) files
+    :return: A dictionary with keys for each segment, and a tuple holding (mean, stdev) paths
     """
-    stats = {}
-    stats["grey_matter"] = (
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.gm_mean, "grey_matter_mean")),
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.gm_std, "grey_matter_std")),
-    )
-    stats["white_matter"] = (
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.wm_mean, "white_matter_mean")),
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.wm_std, "white_matter_std")),
-    )
-    stats["cerebrospinal_fluid"] = (
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.csf_mean, "cerebrospinal_fluid_mean")),
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.csf_std, "cerebrospinal_fluid_std")),
-    )
-    stats["composite"] = (
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.composite_mean, "norm_mean")),
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.composite_std, "norm_std")),
-    )
-    return stats
+    return {
+        "grey_matter": (_resolve_stat_path(args.control_stats_dir, args.gm_mean, "grey_matter_mean"),
+                        _resolve_stat_path(args.control_stats_dir, args.gm_std, "grey_matter_std")),
+        "white_matter": (_resolve_stat_path(args.control_stats_dir, args.wm_mean, "white_matter_mean"),
+                         _resolve_stat_path(args.control_stats_dir, args.wm_std, "white_matter_std")),
+        "cerebrospinal_fluid": (_resolve_stat_path(args.control_stats_dir, args.csf_mean, "cerebrospinal_fluid_mean"),
+                                _resolve_stat_path(args.control_stats_dir, args.csf_std, "cerebrospinal_fluid_std")),
+        "composite": (_resolve_stat_path(args.control_stats_dir, args.composite_mean, "norm_mean"),
+                      _resolve_stat_path(args.control_stats_dir, args.composite_std, "norm_std")),
+    }
 
 
-def compute_z_with_precalc_stats(expt_segments: Dict[str, "pd.DataFrame"], stats: dict):
-    """Calculate patient z-scores using precomputed control mean/std arrays."""
-    pt_tiv = get_tiv(expt_segments)
+def load_control_stats(args: argparse.Namespace, voxel_index: np.ndarray | None = None, dtype=np.float32):
+    """
+    Loads in the precalculated normative files representing the control distribution.
+    With --stats-cache, maps a content-hashed float32 pack instead (built on first use; needs voxel_index).
+    
+    :param args: Args from the command line.
+    :param voxel_index: Optional flat in-mask indices to gather each statistic to.
+    :param dtype: dtype of the returned arrays. Float32 pack rows stay memory-mapped when dtype is float32.
+    :return: A dictionary with keys for each segment, and a tuple holding (mean, stdev) files
+    """
+    paths = _control_stat_paths(args)
+    if getattr(args, "stats_cache", None) is not None:
+        stats = load_stats_pack(paths, args.mask_path, voxel_index, args.stats_cache, _load_flattened_nifti)
+    else:
+        stats = {
+            name: (_load_flattened_nifti(mean_path, voxel_index), _load_flattened_nifti(std_path, voxel_index))
+            for name, (mean_path, std_path) in paths.items()
+        }
+    return {name: (np.asarray(mean, dtype=dtype), np.asarray(std, dtype=dtype)) for name, (mean, std) in stats.items()}
+
+
+def compute_z_with_precalc_stats(expt_segments: Dict[str, "pd.DataFrame"], stats: dict, pt_tiv=None, dtype=np.float32):
+    """
+    Calculate patient z-scores using precomputed control mean/std arrays.
+    Pass pt_tiv when expt_segments only hold a voxel chunk, so TIV still reflects whole volumes.
+    Arithmetic runs in dtype, whatever dtype process_tissue hands back. Means may be (voxels x subjects) W-score expectations.
+    """
+    if pt_tiv is None:
+        pt_tiv = segment_tiv(expt_segments)
     zscore_dict = {}
     zscore_mask_dict = {}
     for tissue, df in expt_segments.items():
         mean, std = stats[tissue]
         processed = process_tissue(df, pt_tiv, threshold=0.2)
-        z_arr = (processed.values - mean[:, np.newaxis]) / std[:, np.newaxis]
+        mean, std = np.asarray(mean, dtype=dtype), np.asarray(std, dtype=dtype)
+        z_arr = (processed.to_numpy(dtype=dtype, copy=False) - _as_column(mean)) / std[:, np.newaxis]
         z_df = pd.DataFrame(z_arr, index=processed.index, columns=processed.columns)
         if tissue == "cerebrospinal_fluid":
             sig_mask = z_df.where(z_df > 2, 0)
@@ -356,23 +754,68 @@ def compute_z_with_precalc_stats(expt_segments: Dict[str, "pd.DataFrame"], stats
     return zscore_dict, zscore_mask_dict
 
 
-def compute_composite_with_precalc_stats(zscore_dict: Dict[str, "pd.DataFrame"], stats: dict) -> "pd.DataFrame":
+def compute_composite_with_precalc_stats(zscore_dict: Dict[str, "pd.DataFrame"], stats: dict, dtype=np.float32) -> "pd.DataFrame":
     """Compute composite Z (H-score) using precomputed control norm mean/std."""
-    comp_mean, comp_std = stats["composite"]
+    comp_mean, comp_std = (np.asarray(a, dtype=dtype) for a in stats["composite"])
     pt_dict_processed = prepocess_dict(zscore_dict)                    # Drops WM and sign-flips CSF. Thus, <0 is atrophy.
     pt_tensor = generate_tensor(pt_dict_processed)                     # Stacks
-    pt_norm = generate_norm(pt_tensor, atrophy_only=False)              # Will only consider negative values (atrophy) 
+    pt_norm = np.asarray(generate_norm(pt_tensor, atrophy_only=False), dtype=dtype)  # Will only consider negative values (atrophy) 
     z = (pt_norm - comp_mean[:, np.newaxis]) / comp_std[:, np.newaxis]
     first_key = next(iter(zscore_dict))
     return pd.DataFrame(z, columns=zscore_dict[first_key].columns, index=zscore_dict[first_key].index)
 
 
+def leave_one_out_z_scores(ctrl_segments: Dict[str, "pd.DataFrame"], dtype=np.float32, ddof: int = 1) -> Dict[str, "pd.DataFrame"]:
+    """
+    Z-score every control against the other N-1 controls, for all controls at once.
+    
+    Per voxel, the mean m and centered sum of squares M2 over all N controls are computed once. Removing
+    control i (d = x_i - m) gives mean_-i = m - d/(N-1) and M2_-i = M2 - d^2 N/(N-1), so
+    z_i = d N/(N-1) / sqrt(M2_-i / (N-1-ddof)). This is O(N*V) and avoids the bias of scoring a
+    control against a distribution that contains it. Non-finite values are skipped as pandas does: N is the
+    per-voxel count of finite controls, a non-finite control gets a NaN z, and so does every control at a
+    voxel with fewer than ddof + 2 finite values.
+    
+    :param ctrl_segments: Dict. Tissue -> (voxels x controls) DataFrame, as loaded for --controls-root
+    :param dtype: Output dtype. Sums are accumulated in float64.
+    :param ddof: Delta degrees of freedom of the leave-one-out std (1 matches pandas .std()).
+    :return: Dict. Tissue -> (voxels x controls) z-score DataFrame, usable as ctrl_dict for generate_norm_map
+    """
+    ctrl_tiv = segment_tiv(ctrl_segments)
+    z_dict = {}
+    for tissue, df in ctrl_segments.items():
+        processed = process_tissue(df, ctrl_tiv, threshold=0.2)
+        x = processed.to_numpy(dtype=np.float64)
+        if x.shape[1] < ddof + 2:
+            raise SystemExit(f"Leave-one-out z-scores need at least {ddof + 2} controls; got {x.shape[1]}.")
+        finite = np.isfinite(x)
+        n = finite.sum(axis=1, keepdims=True).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d = np.where(finite, x - np.where(finite, x, 0).sum(axis=1, keepdims=True) / n, np.nan)
+            centered = np.where(finite, d, 0)
+            m2 = np.einsum("ij,ij->i", centered, centered)[:, np.newaxis]
+            scale = n / (n - 1)
+            loo_var = (m2 - d * d * scale) / np.where(n - 1 - ddof >= 1, n - 1 - ddof, np.nan)
+            z = (d * scale) / np.sqrt(np.maximum(loo_var, 0))
+        z_dict[tissue] = pd.DataFrame(z.astype(dtype, copy=False), index=processed.index, columns=processed.columns)
+    return z_dict
+
+
 def main() -> None:
     parser = build_parser()
     args = parser.parse_args()
 
     if not args.mask_path.exists():
         raise SystemExit(f"Mask not found: {args.mask_path}")
+    if args.subject_block < 1 or args.voxel_chunk < 1:
+        raise SystemExit("--subject-block and --voxel-chunk must be positive.")
+    if args.w_pack and (args.covariates is None or args.normative_bank):
+        raise SystemExit("--w-pack needs --covariates and cannot be combined with --normative-bank.")
+    if args.normative_bank:
+        if args.participants is None and args.default_cohort is None:
+            raise SystemExit("--normative-bank needs --participants or --default-cohort.")
+        if args.participants is not None and bool(args.cohort_column) == bool(args.age_column and args.age_bracket):
+            raise SystemExit("With --participants, give either --cohort-column or --age-column with --age-bracket.")
 
     run_pipeline(args)
 
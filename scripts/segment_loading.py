@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Segment loading shared by run_z_scoring.py (scripts/ and src/), build_control_stats.py and zscore_service.py.
+
+GM/WM/CSF NIfTIs are decoded on one thread/process pool into preallocated (voxels x files) arrays, optionally
+gathered to in-mask voxels (--mask-compress). Mask-compressed frames keep each file's full-volume sum in
+df.attrs[VOLUME_SUM], so TIV (segment_tiv, process_atrophy_full_tiv) is the same with and without compression.
+"""
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from calvin_utils.neuroimaging_utils.nifti_utils.matrix_utilities import import_nifti_to_numpy_array
+from calvin_utils.vbm_utils.processing import get_tiv, process_atrophy
+
+VOLUME_SUM = "volume_sum"                                                # df.attrs key: per-file full-volume sums of mask-compressed frames
+REST_ROW = -1                                                           # row label of the out-of-mask remainder (process_atrophy_full_tiv)
+
+def load_mask_index(mask_path: Path) -> np.ndarray:
+    """
+    Flat (C-order) indices of the voxels inside the brain mask.
+    
+    :param mask_path: Path to the reference mask
+    :return: 1D int array. Gathering a flattened volume with it keeps only in-mask voxels.
+    """
+    mask = nib.load(str(mask_path)).get_fdata()
+    return np.flatnonzero(mask.ravel() > 0)
+
+
+def _decode_flat(path: Path, voxel_index: np.ndarray | None = None) -> tuple | None:
+    """
+    Decode one NIfTI to a flat vector (gathered to voxel_index if given). None if unreadable.
+    
+    :return: (flat vector, sum over the full volume). The sum is taken before the gather so TIV stays a
+             whole-volume quantity under --mask-compress (see segment_tiv).
+    """
+    arr = import_nifti_to_numpy_array(str(path))
+    if arr is None:
+        return None
+    flat = np.asarray(arr).ravel()
+    volume = float(np.nansum(flat, dtype=np.float64))
+    return (flat if voxel_index is None else flat[voxel_index]), volume
+
+
+def _decode_into(out: np.ndarray, volumes: np.ndarray, col: int, path: Path, voxel_index: np.ndarray | None = None) -> bool:
+    """Thread worker: decode straight into column `col` of the preallocated array (and its volume sum into volumes[col])."""
+    decoded = _decode_flat(path, voxel_index)
+    if decoded is None:
+        return False
+    out[:, col], volumes[col] = decoded
+    return True
+
+
+def _load_dfs(files_by_tissue: Dict[str, List[Path]], voxel_index: np.ndarray | None = None,
+              io_workers: int = 1, io_backend: str = "thread", dtype=np.float32) -> Dict[str, "pd.DataFrame"]:
+    """
+    Decode every tissue file into one preallocated (voxels x files) array per tissue.
+    
+    All GM/WM/CSF files are submitted to a single pool so tissues decode concurrently. Column j is
+    always file j regardless of completion order, so output is deterministic. Unreadable files are dropped.
+    
+    :param files_by_tissue: Dict. Tissue -> ordered list of files
+    :param voxel_index: Optional flat in-mask indices (see --mask-compress)
+    :param io_workers: Number of concurrent decoders. 1 decodes serially.
+    :param io_backend: "thread" writes into the shared arrays from workers; "process" ships vectors back.
+    :param dtype: dtype of the preallocated arrays (see --dtype).
+    :return: Dict. Tissue -> DataFrame with file paths as columns. Mask-compressed frames carry each file's
+             full-volume sum in df.attrs[VOLUME_SUM].
+    """
+    first = next((files[0] for files in files_by_tissue.values() if files), None)
+    if first is None:
+        return {k: pd.DataFrame() for k in files_by_tissue}
+    n_rows = len(voxel_index) if voxel_index is not None else int(np.prod(nib.load(str(first)).shape))
+    data = {k: np.empty((n_rows, len(files)), dtype=dtype) for k, files in files_by_tissue.items()}
+    volumes = {k: np.full(len(files), np.nan) for k, files in files_by_tissue.items()}
+    loaded = {k: np.zeros(len(files), dtype=bool) for k, files in files_by_tissue.items()}
+    jobs = [(k, j, f) for k, files in files_by_tissue.items() for j, f in enumerate(files)]
+
+    if io_workers <= 1:
+        for k, j, f in jobs:
+            loaded[k][j] = _decode_into(data[k], volumes[k], j, f, voxel_index)
+    elif io_backend == "thread":
+        with ThreadPoolExecutor(max_workers=io_workers) as pool:
+            futures = {pool.submit(_decode_into, data[k], volumes[k], j, f, voxel_index): (k, j) for k, j, f in jobs}
+            for fut in as_completed(futures):
+                k, j = futures[fut]
+                loaded[k][j] = fut.result()
+    else:
+        with ProcessPoolExecutor(max_workers=io_workers) as pool:
+            futures = {pool.submit(_decode_flat, f, voxel_index): (k, j) for k, j, f in jobs}
+            for fut in as_completed(futures):
+                k, j = futures[fut]
+                decoded = fut.result()
+                if decoded is not None:
+                    data[k][:, j], volumes[k][j] = decoded
+                    loaded[k][j] = True
+
+    out = {}
+    for k, files in files_by_tissue.items():
+        ok = loaded[k]
+        if not ok.any():
+            out[k] = pd.DataFrame()
+            continue
+        arr = data[k] if ok.all() else data[k][:, ok]
+        out[k] = pd.DataFrame(arr, columns=[str(f) for f, keep in zip(files, ok) if keep], index=voxel_index)
+        if voxel_index is not None:
+            out[k].attrs[VOLUME_SUM] = volumes[k][ok]
+    return out
+
+
+def _volume_frames(segments: Dict[str, "pd.DataFrame"]) -> Dict[str, "pd.DataFrame"] | None:
+    """One-row frames of each file's full-volume sum, or None if the segments are not mask-compressed."""
+    if not all(VOLUME_SUM in df.attrs for df in segments.values()):
+        return None
+    return {k: pd.DataFrame(df.attrs[VOLUME_SUM][np.newaxis, :], columns=df.columns) for k, df in segments.items()}
+
+
+def segment_tiv(segments: Dict[str, "pd.DataFrame"]):
+    """
+    get_tiv that is the same with and without --mask-compress.
+    
+    TIV sums whole volumes, and the normative stats (assets/ctrl_dist, notebook 04a) were built from full-grid
+    segments. Mask-compressed frames only hold in-mask voxels, so get_tiv runs on the per-file full-volume
+    sums that _load_dfs kept in df.attrs instead. Uncompressed frames go to get_tiv unchanged.
+    """
+    volumes = _volume_frames(segments)
+    return get_tiv(segments if volumes is None else volumes)
+
+
+def _with_volume_rest(segments: Dict[str, "pd.DataFrame"]) -> Dict[str, "pd.DataFrame"]:
+    """Append REST_ROW, each file's out-of-mask sum, to mask-compressed frames so column sums cover the full volume."""
+    volumes = _volume_frames(segments)
+    if volumes is None:
+        return segments
+    return {k: pd.concat([df, pd.DataFrame((volumes[k].to_numpy() - df.sum(axis=0).to_numpy()).astype(df.dtypes.iloc[0]),
+                                           columns=df.columns, index=[REST_ROW])])
+            for k, df in segments.items()}
+
+
+def process_atrophy_full_tiv(data_dict: Dict[str, "pd.DataFrame"], ctrl_dict: Dict[str, "pd.DataFrame"]):
+    """
+    process_atrophy for segments that may be mask-compressed.
+    
+    process_atrophy takes TIV from the frames it is given, so compressed frames go in with REST_ROW appended
+    (see _with_volume_rest) and the row is dropped from the outputs again.
+    """
+    atrophy, atrophy_thresholded, stats = process_atrophy(_with_volume_rest(data_dict), _with_volume_rest(ctrl_dict))
+    drop = lambda frames: {k: df.drop(index=REST_ROW, errors="ignore") for k, df in frames.items()}
+    return drop(atrophy), drop(atrophy_thresholded), stats
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Cohort-level sparse store for thresholded z-score maps (run_z_scoring.py --sparse-thresholded).
+
+Thresholded maps are zero except at suprathreshold voxels, yet each one is normally written as a dense gzip
+NIfTI per tissue per subject. Instead, a store keeps them CSR-style. Every scored block is appended as one
+part file holding, per tissue, row pointers over its subjects, int32 flat grid indices of the non-zero
+voxels, and their float32 values. A JSON index records the grid, the parts and which part holds each
+subject; the latest part wins if a subject is re-scored. Maps are densified to NIfTI on demand. Cohort
+queries, such as which subjects have at least N suprathreshold voxels in an ROI, read only the sparse
+indices and never decode volumes.
+Quick Start:
+    python sparse_store.py list --store /data/derivatives/thresholded_store
+    python sparse_store.py densify --store /data/derivatives/thresholded_store --subject sub-01/ses-01
+    python sparse_store.py query --store /data/derivatives/thresholded_store --roi /root/assets/rois/yeo_7/7Networks_1.nii.gz \\
+        --tissue grey_matter --min-voxels 10
+"""
+from __future__ import annotations
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import nibabel as nib
+
+from stats_cache import publish_atomic
+
+STORE_VERSION = 1
+INDEX_NAME = "store.json"
+
+
+class SparseStore:
+    """Append-only CSR store of (voxels x subjects) maps on one grid."""
+    def __init__(self, path: Path, shape: Tuple[int, ...] | None = None, affine: np.ndarray | None = None, analysis: str | None = None):
+        """
+        Open the store at path, creating it when shape and affine are given and no store exists yet.
+
+        :param analysis: Analysis folder the maps would have been written to (used to name densified files)
+        """
+        self.path = Path(path)
+        index_path = self.path / INDEX_NAME
+        if index_path.exists():
+            with open(index_path) as f:
+                self.index = json.load(f)
+            if shape is not None and tuple(self.index["shape"]) != tuple(shape):
+                raise SystemExit(f"Sparse store {self.path} is on grid {tuple(self.index['shape'])}, not {tuple(shape)}.")
+        elif shape is not None:
+            self.index = {"version": STORE_VERSION, "shape": [int(s) for s in shape], "affine": np.asarray(affine).tolist(),
+                          "analysis": analysis, "parts": [], "subjects": {}}
+        else:
+            raise SystemExit(f"No sparse store at {self.path}.")
+        self.shape = tuple(self.index["shape"])
+        self.affine = np.asarray(self.index["affine"])
+
+    def _save_index(self) -> None:
+        publish_atomic(self.path / INDEX_NAME, lambda f: f.write(json.dumps(self.index, indent=1).encode()))
+
+    def append(self, subjects: List[str], sources: List[str], arrays: Dict[str, np.ndarray], voxel_index: np.ndarray | None = None) -> Path:
+        """
+        Store one block of maps as a new part.
+
+        :param subjects: Subject keys, one per column
+        :param sources: Source path per subject (the column names save_df_to_nifti_bids would use), kept for densify
+        :param arrays: Dict. Tissue -> (voxels x subjects) maps; zeros are dropped
+        :param voxel_index: Flat in-mask indices if rows are mask-compressed, else None (rows span the grid)
+        """
+        part = {"subjects": np.array(subjects, dtype=str)}
+        for tissue, arr in arrays.items():
+            cols, rows = np.nonzero(np.asarray(arr).T)                   # row-major over subjects, so indices are grouped per subject
+            part[f"{tissue}_indptr"] = np.searchsorted(cols, np.arange(len(subjects) + 1)).astype(np.int64)
+            part[f"{tissue}_indices"] = (rows if voxel_index is None else voxel_index[rows]).astype(np.int32)
+            part[f"{tissue}_values"] = np.asarray(arr).T[cols, rows].astype(np.float32)
+        name = f"part-{len(self.index['parts']):05d}.npz"
+        self.path.mkdir(parents=True, exist_ok=True)
+        publish_atomic(self.path / name, lambda f: np.savez(f, **part))
+        self.index["parts"].append({"name": name, "tissues": list(arrays)})
+        for col, (subject, source) in enumerate(zip(subjects, sources)):
+            self.index["subjects"][subject] = {"part": name, "column": col, "source": source}
+        self._save_index()
+        return self.path / name
+
+    def subjects(self) -> List[str]:
+        return sorted(self.index["subjects"])
+
+    def entry(self, subject: str) -> dict:
+        """Index entry (part, column, source) of one subject; ValueError if the store does not hold it."""
+        entry = self.index["subjects"].get(subject)
+        if entry is None:
+            raise ValueError(f"Sparse store {self.path} has no subject {subject!r} (see: sparse_store.py list --store {self.path}).")
+        return entry
+
+    def get(self, subject: str, tissue: str) -> Tuple[np.ndarray, np.ndarray]:
+        """(flat grid indices, values) of one subject's non-zero voxels."""
+        entry = self.entry(subject)
+        with np.load(self.path / entry["part"]) as part:
+            if f"{tissue}_indptr" not in part:
+                raise ValueError(f"Sparse store {self.path} has no {tissue!r} maps for subject {subject!r}.")
+            indptr = part[f"{tissue}_indptr"]
+            lo, hi = indptr[entry["column"]], indptr[entry["column"] + 1]
+            return part[f"{tissue}_indices"][lo:hi], part[f"{tissue}_values"][lo:hi]
+
+    def densify(self, subject: str, tissue: str) -> nib.Nifti1Image:
+        indices, values = self.get(subject, tissue)
+        vol = np.zeros(int(np.prod(self.shape)), dtype=np.float32)
+        vol[indices] = values
+        return nib.Nifti1Image(vol.reshape(self.shape), self.affine)
+
+    def count_in_region(self, region: np.ndarray, tissue: str) -> Dict[str, int]:
+        """
+        Suprathreshold voxel count inside a region for every subject, from the sparse indices alone.
+
+        :param region: Boolean mask on the store grid (any shape with the same number of voxels)
+        :return: Dict. Subject key -> count
+        """
+        region = np.asarray(region, dtype=bool).ravel()
+        counts = {}
+        for meta in self.index["parts"]:
+            if tissue not in meta["tissues"]:
+                continue
+            with np.load(self.path / meta["name"]) as part:
+                indptr, hits = part[f"{tissue}_indptr"], region[part[f"{tissue}_indices"]]
+                rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+                per_subject = np.bincount(rows[hits], minlength=len(indptr) - 1)
+                for col, subject in enumerate(part["subjects"].tolist()):
+                    entry = self.index["subjects"].get(subject)
+                    if entry is not None and entry["part"] == meta["name"]:
+                        counts[subject] = int(per_subject[col])
+        return counts
+
+
+def list_store(args: argparse.Namespace) -> None:
+    store = SparseStore(args.store)
+    print(f"{len(store.subjects())} subjects in {len(store.index['parts'])} parts on grid {store.shape}")
+    for subject in store.subjects():
+        print(subject)
+
+
+def densify(args: argparse.Namespace) -> None:
+    """Write dense NIfTIs, by default to the BIDS paths the dense writer would have used."""
+    from run_z_scoring import OUTPUT_TISSUES, bids_output_path              # run_z_scoring imports this module
+    store = SparseStore(args.store)
+    subjects = args.subject or store.subjects()
+    sources = {subject: store.entry(subject)["source"] for subject in subjects}   # unknown subjects fail before any write
+    for subject, source in sources.items():
+        for tissue in args.tissue or OUTPUT_TISSUES:
+            if args.out_dir:
+                out_path = args.out_dir / subject.replace("/", "_") / f"{tissue}.nii.gz"
+            else:
+                out_path = Path(bids_output_path(args.root, source, store.index["analysis"], tissue))
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            nib.save(store.densify(subject, tissue), str(out_path))
+            print(f"Saved {out_path}")
+
+
+def query(args: argparse.Namespace) -> None:
+    store = SparseStore(args.store)
+    region = nib.load(str(args.roi)).get_fdata() > 0
+    if region.size != int(np.prod(store.shape)):
+        raise SystemExit(f"ROI {args.roi} has {region.size} voxels; the store grid has {int(np.prod(store.shape))}.")
+    counts = store.count_in_region(region, args.tissue)
+    hits = sorted((s for s, c in counts.items() if c >= args.min_voxels), key=lambda s: -counts[s])
+    for subject in hits:
+        print(f"{subject}\t{counts[subject]}")
+    print(f"{len(hits)}/{len(counts)} subjects with >= {args.min_voxels} suprathreshold {args.tissue} voxels in {args.roi.name}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Inspect, densify and query sparse thresholded z-score stores.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("list", help="List the subjects in a store.")
+    p.add_argument("--store", type=Path, required=True, help="Store directory.")
+    p.set_defaults(func=list_store)
+
+    p = sub.add_parser("densify", help="Write dense NIfTIs for stored subjects.")
+    p.add_argument("--store", type=Path, required=True, help="Store directory.")
+    p.add_argument("--subject", nargs="+", default=None, help="Subject keys (default: all).")
+    p.add_argument("--tissue", nargs="+", default=None, help="Tissues (default: all four maps).")
+    p.add_argument("--root", type=Path, default=None, help="BIDS root to write the usual output paths under.")
+    p.add_argument("--out-dir", type=Path, default=None, help="Write <out-dir>/<subject>/<tissue>.nii.gz instead.")
+    p.set_defaults(func=densify)
+
+    p = sub.add_parser("query", help="Subjects with suprathreshold voxels in an ROI.")
+    p.add_argument("--store", type=Path, required=True, help="Store directory.")
+    p.add_argument("--roi", type=Path, required=True, help="ROI NIfTI on the store grid (voxels > 0).")
+    p.add_argument("--tissue", default="composite", help="Tissue map to query (default: composite).")
+    p.add_argument("--min-voxels", type=int, default=1, help="Minimum suprathreshold voxels in the ROI (default: 1).")
+    p.set_defaults(func=query)
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    if args.command == "densify" and (args.root is None) == (args.out_dir is None):
+        raise SystemExit("densify needs exactly one of --root or --out-dir.")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
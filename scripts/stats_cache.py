@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped cache for precalculated control statistics.
+
+load_control_stats in run_z_scoring.py gunzips eight NIfTIs (<tissue>_mean/_std, norm_mean/_std) on every
+run. Here they are converted once into a single mask-compressed float32 .npy pack of shape (8, voxels),
+named by a content hash of the stat files and the mask. Later runs, and concurrent workers, np.load it with
+mmap_mode="r", which costs a header read; pages are faulted in and shared through the OS page cache.
+Packs are published with an atomic rename, so concurrent builders never expose a partial file.
+The per-file sha256 digests behind the fingerprint are kept in a small sidecar (DIGESTS_NAME, in the
+bids_index.py cache directory) keyed on path, size and mtime, so an unchanged stats directory is
+fingerprinted with one stat() per file instead of re-reading all eight volumes on every run.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+PACK_VERSION = "1"
+STAT_ORDER = ["grey_matter", "white_matter", "cerebrospinal_fluid", "composite"]
+DIGESTS_NAME = "stats_digests.json"
+
+
+def _hash_file(h: "hashlib._Hash", path: Path, block: int = 1 << 20) -> None:
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+
+
+def _file_digest(path: Path, digests: Dict[str, dict]) -> str:
+    """sha256 of one file, reusing the digests record while its size and mtime are unchanged (else re-hashed and updated)."""
+    st = os.stat(path)
+    key = str(Path(path).absolute())
+    old = digests.get(key)
+    if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+        return old["sha256"]
+    h = hashlib.sha256()
+    _hash_file(h, Path(path))
+    digests[key] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": h.hexdigest()}
+    return digests[key]["sha256"]
+
+
+def stats_fingerprint(paths: Dict[str, Tuple[Path, Path]], mask_path: Path) -> str:
+    """
+    Content hash of the (mean, std) files for every statistic plus the mask that defines the layout.
+    Per-file digests come from the DIGESTS_NAME sidecar when a file's size and mtime match its record.
+
+    :param paths: Dict. Statistic -> (mean path, std path), as resolved by run_z_scoring
+    :param mask_path: Mask used to compress the pack
+    :return: Hex sha256 digest
+    """
+    from bids_index import cache_dir                                    # bids_index imports this module
+    sidecar = cache_dir() / DIGESTS_NAME
+    try:
+        with open(sidecar) as f:
+            digests = json.load(f)
+    except (OSError, ValueError):
+        digests = {}
+    before = dict(digests)
+    h = hashlib.sha256(f"vbm-stats-pack-v{PACK_VERSION}".encode())
+    for name in STAT_ORDER:
+        for path in paths[name]:
+            h.update(name.encode())
+            h.update(_file_digest(Path(path), digests).encode())
+    h.update(_file_digest(Path(mask_path), digests).encode())
+    if digests != before:
+        payload = json.dumps(digests, indent=1, sort_keys=True).encode()
+        try:
+            publish_atomic(sidecar, lambda f: f.write(payload))
+        except OSError as exc:
+            print(f"Warning: could not save stats digests {sidecar} ({exc}); files will be re-hashed next run.")
+    return h.hexdigest()
+
+
+def publish_mode(out_path: Path) -> int:
+    """
+    Permission bits for a file about to be published at out_path: those of the file it replaces, else what
+    open() would create (0o666 less the umask). mkstemp creates its temp files 0600, and os.replace keeps that.
+    """
+    try:
+        return os.stat(out_path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def publish_atomic(out_path: Path, write: Callable) -> None:
+    """Write out_path through a temp file in the same directory and rename it into place (see publish_mode)."""
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=out_path.parent, suffix=".tmp")
+    try:
+        os.fchmod(fd, publish_mode(out_path))
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, out_path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def pack_path(cache_dir: Path, fingerprint: str) -> Path:
+    return Path(cache_dir) / f"ctrlstats-{fingerprint[:24]}.npy"
+
+
+def build_stats_pack(paths: Dict[str, Tuple[Path, Path]], out_path: Path, voxel_index: np.ndarray,
+                     loader: Callable[[Path, np.ndarray], np.ndarray]) -> Path:
+    """
+    Decode every statistic once, gather it to voxel_index and publish the (8, voxels) float32 pack.
+
+    :param loader: Callable(path, voxel_index) -> flat array, e.g. run_z_scoring._load_flattened_nifti
+    """
+    pack = np.empty((2 * len(STAT_ORDER), len(voxel_index)), dtype=np.float32)
+    for i, name in enumerate(STAT_ORDER):
+        mean_path, std_path = paths[name]
+        pack[2 * i] = loader(mean_path, voxel_index)
+        pack[2 * i + 1] = loader(std_path, voxel_index)
+    publish_atomic(out_path, lambda f: np.save(f, pack))
+    print(f"Built control stats pack: {out_path}")
+    return out_path
+
+
+def load_stats_pack(paths: Dict[str, Tuple[Path, Path]], mask_path: Path, voxel_index: np.ndarray, cache_dir: Path,
+                    loader: Callable[[Path, np.ndarray], np.ndarray]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Map the pack for these stat files, building it first if no pack with this fingerprint exists.
+
+    :return: Dict in the load_control_stats layout. Each (mean, std) is a read-only memmap row view.
+    """
+    out_path = pack_path(cache_dir, stats_fingerprint(paths, mask_path))
+    if not out_path.exists():
+        build_stats_pack(paths, out_path, voxel_index, loader)
+    pack = np.load(out_path, mmap_mode="r")
+    if pack.shape != (2 * len(STAT_ORDER), len(voxel_index)):
+        raise SystemExit(f"Control stats pack {out_path} has shape {pack.shape}; expected {(2 * len(STAT_ORDER), len(voxel_index))}.")
+    return {name: (pack[2 * i], pack[2 * i + 1]) for i, name in enumerate(STAT_ORDER)}
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+W-score (covariate-adjusted) normative engine for run_z_scoring.py (--w-pack).
+
+Z-scores compare a patient with the control mean. W-scores compare them with what controls of the same age,
+sex and TIV look like. Per voxel and tissue, processed control values y are regressed on covariates,
+y = X b + e, and a patient's W-score is (y - x b) / sd(e). Controls are streamed once into the normal
+equations X'X, X'Y and sum(y^2), and every in-mask voxel is then fitted with one batched solve
+(build_control_stats.py fit-w). The coefficient and residual-SD maps, plus the control composite norm
+mean/std, go into a reusable float32 pack with a JSON sidecar. Applying the pack to a block of patients is
+one matrix product per tissue, which gives each patient's expected map. Covariates are centred on the control
+means so the float32 intercept holds the expected value and the products do not cancel. That expected map then takes the
+place of the control mean in fused_z_kernel.
+Pack Layout:
+    (tissues * (covariates + 2) + 2, voxels) float32, mask-compressed. For each tissue in W_TISSUES there
+    are rows for the intercept and covariate coefficients, then the residual SD. The last two rows are
+    the composite norm mean and std.
+"""
+from __future__ import annotations
+import hashlib
+import json
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from normative_bank import participant_lookup, sidecar_path
+from stats_cache import publish_atomic
+
+PACK_VERSION = 1
+W_TISSUES = ["grey_matter", "white_matter", "cerebrospinal_fluid"]
+TIV_COVARIATE = "tiv"
+SEX_CODES = {"m": 1.0, "male": 1.0, "f": 0.0, "female": 0.0}
+
+
+def _covariate_value(value) -> float:
+    if isinstance(value, str):
+        code = SEX_CODES.get(value.strip().lower())
+        if code is not None:
+            return code
+    return float(value)
+
+
+def covariate_rows(subjects: List[str], lookup: Callable, columns: Sequence[str], table: Path) -> np.ndarray:
+    """
+    Covariates of each subject key from a participants CSV/TSV.
+    Sex-like strings (M/F/male/female) are coded 1/0; everything else must be numeric.
+
+    :param lookup: normative_bank.participant_lookup(table)
+    :return: (subjects x columns) float64 array
+    """
+    out = np.empty((len(subjects), len(columns)))
+    for i, key in enumerate(subjects):
+        row = lookup(key)
+        if row is None:
+            raise SystemExit(f"{key} has no row in {table}.")
+        try:
+            out[i] = [_covariate_value(row[c]) for c in columns]
+        except (KeyError, ValueError) as exc:
+            raise SystemExit(f"Bad covariates for {key} in {table}: {exc}")
+    if not np.isfinite(out).all():
+        bad = subjects[int(np.flatnonzero(~np.isfinite(out).all(axis=1))[0])]
+        raise SystemExit(f"Missing covariates for {bad} in {table}.")
+    return out
+
+
+def design_matrix(covariates: np.ndarray, tiv=None, centers: np.ndarray | None = None) -> np.ndarray:
+    """
+    [1, covariates..., TIV] per subject.
+
+    :param tiv: get_tiv output for the same subjects, or None to leave TIV out
+    :param centers: Control means of the non-intercept columns (from the pack), or None for raw columns
+    """
+    cols = [*covariates.T]
+    if tiv is not None:
+        cols.append(np.asarray(tiv, dtype=np.float64).ravel())
+    X = np.column_stack(cols) if cols else np.empty((len(covariates), 0))
+    if centers is not None:
+        X = X - centers
+    return np.column_stack([np.ones(len(X)), X])
+
+
+class NormalEquations:
+    """
+    Streaming X'X, X'Y and sum(y^2) for every voxel of one tissue; solve() fits all voxels at once.
+    Non-finite values are skipped per voxel, as in WelfordAccumulator: X'X is kept for all subjects plus,
+    once a block has any, the per-voxel X'X and count of the subjects each voxel skipped.
+    Every term is a sum over subjects, so equations built on separate shards merge exactly.
+    """
+    STATE_KEYS = ("n", "xtx", "xty", "yy", "skipped_n", "skipped_xtx")
+
+    def __init__(self, n_params: int, n_voxels: int):
+        self.n = 0
+        self.xtx = np.zeros((n_params, n_params))
+        self.xty = np.zeros((n_params, n_voxels))
+        self.yy = np.zeros(n_voxels)
+        self.skipped_n: np.ndarray | None = None
+        self.skipped_xtx: np.ndarray | None = None
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {"n": np.array(self.n), "xtx": self.xtx, "xty": self.xty, "yy": self.yy,
+                "skipped_n": np.empty(0, dtype=np.int64) if self.skipped_n is None else self.skipped_n,
+                "skipped_xtx": np.empty(0) if self.skipped_xtx is None else self.skipped_xtx}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray]) -> "NormalEquations":
+        eq = cls(*state["xty"].shape)
+        eq.n, eq.xtx, eq.xty, eq.yy = int(state["n"]), state["xtx"].copy(), state["xty"].copy(), state["yy"].copy()
+        if state["skipped_n"].size:
+            eq.skipped_n, eq.skipped_xtx = state["skipped_n"].copy(), state["skipped_xtx"].copy()
+        return eq
+
+    def _ensure_skipped(self) -> None:
+        if self.skipped_n is None:
+            self.skipped_n = np.zeros(len(self.yy), dtype=np.int64)
+            self.skipped_xtx = np.zeros((len(self.yy), *self.xtx.shape))
+
+    def merge(self, other: "NormalEquations") -> None:
+        """Exact merge of equations over the same voxels and design columns (different subjects)."""
+        if other.xty.shape != self.xty.shape:
+            raise ValueError(f"Cannot merge normal equations over {other.xty.shape} and {self.xty.shape} (params x voxels).")
+        self.n += other.n
+        self.xtx += other.xtx
+        self.xty += other.xty
+        self.yy += other.yy
+        if other.skipped_n is not None:
+            self._ensure_skipped()
+            self.skipped_n += other.skipped_n
+            self.skipped_xtx += other.skipped_xtx
+
+    def update(self, X: np.ndarray, Y: np.ndarray) -> None:
+        """Fold a (subjects x params) design block and its (voxels x subjects) values."""
+        Y = np.asarray(Y, dtype=np.float64)
+        valid = np.isfinite(Y)
+        if not valid.all():
+            self._ensure_skipped()
+            hit = np.flatnonzero(~valid.all(axis=1))
+            missing = ~valid[hit]
+            self.skipped_n[hit] += missing.sum(axis=1)
+            self.skipped_xtx[hit] += np.einsum("vs,sp,sq->vpq", missing.astype(np.float64), X, X)
+            Y = np.where(valid, Y, 0)
+        self.n += X.shape[0]
+        self.xtx += X.T @ X
+        self.xty += X.T @ Y.T
+        self.yy += np.einsum("vs,vs->v", Y, Y)
+
+    def solve(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Least-squares coefficients and residual SD for every voxel from one batched solve.
+        X'X is Jacobi-scaled first, since raw TIV is orders of magnitude larger than the other columns.
+        Voxels that skipped subjects get their own batched solve; those left with no more than params finite
+        subjects are NaN. The intercept is then moved to the control means of the covariates.
+
+        :return: (coefficients for the centred design (params x voxels), residual SD (voxels,), ddof = params,
+                  covariate centers (params - 1,))
+        """
+        p = self.xtx.shape[0]
+        if self.n <= p:
+            raise SystemExit(f"W-score fit needs more than {p} controls; got {self.n}.")
+        scale = 1 / np.sqrt(np.diag(self.xtx))
+        outer = np.outer(scale, scale)
+        rhs = scale[:, np.newaxis] * self.xty
+        coef = scale[:, np.newaxis] * np.linalg.solve(self.xtx * outer, rhs)
+        n = np.full(len(self.yy), self.n, dtype=np.int64)
+        if self.skipped_n is not None:
+            n -= self.skipped_n
+            hit = np.flatnonzero(self.skipped_n > 0)
+            solvable = hit[n[hit] > p]
+            coef[:, hit] = np.nan
+            if len(solvable):
+                a = (self.xtx - self.skipped_xtx[solvable]) * outer
+                coef[:, solvable] = scale[:, np.newaxis] * np.linalg.solve(a, rhs[:, solvable].T[..., np.newaxis])[..., 0].T
+        rss = np.maximum(self.yy - np.einsum("pv,pv->v", coef, self.xty), 0)
+        centers = self.xtx[0, 1:] / self.n
+        coef[0] += centers @ coef[1:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sd = np.sqrt(rss / np.where(n > p, n - p, np.nan))
+        return coef, sd, centers
+
+
+def save_w_pack(out_path: Path, coefs: Dict[str, np.ndarray], sds: Dict[str, np.ndarray], composite: Tuple[np.ndarray, np.ndarray],
+                covariates: List[str], use_tiv: bool, centers: np.ndarray, n_controls: int, mask_path: Path) -> Path:
+    """Publish the pack (see Pack Layout) and its sidecar atomically."""
+    rows = []
+    for tissue in W_TISSUES:
+        rows += [*coefs[tissue], sds[tissue]]
+    rows += list(composite)
+    meta = {"version": PACK_VERSION, "tissues": W_TISSUES, "covariates": list(covariates), "tiv": use_tiv,
+            "centers": [float(c) for c in centers], "n_controls": n_controls, "voxels": int(len(rows[0])), "mask": str(mask_path)}
+    publish_atomic(out_path, lambda f: np.save(f, np.asarray(rows, dtype=np.float32)))
+    publish_atomic(sidecar_path(out_path), lambda f: f.write(json.dumps(meta, indent=1).encode()))
+    print(f"W-score pack from {n_controls} controls ({', '.join(['intercept', *covariates] + ([TIV_COVARIATE] if use_tiv else []))}) written to {out_path}")
+    return out_path
+
+
+def expected_stats(coefs: Dict[str, np.ndarray], sds: Dict[str, np.ndarray], X: np.ndarray, dtype=np.float32) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Tissue -> ((voxels x subjects) expected values X b, residual SD): one matrix product per tissue."""
+    X = np.asarray(X, dtype=dtype)
+    return {t: (np.asarray(coefs[t], dtype=dtype).T @ X.T, np.asarray(sds[t], dtype=dtype)) for t in coefs}
+
+
+class WScorePack:
+    """A mapped W-score pack. stats() gives the load_control_stats layout with per-subject expected maps as means."""
+    def __init__(self, path: Path, voxel_index: np.ndarray):
+        with open(sidecar_path(path)) as f:
+            meta = json.load(f)
+        self.covariates: List[str] = meta["covariates"]
+        self.use_tiv: bool = meta["tiv"]
+        self.centers = np.asarray(meta["centers"])
+        self.n_params = 1 + len(self.covariates) + int(self.use_tiv)
+        self.array = np.load(path, mmap_mode="r")
+        expected = (len(W_TISSUES) * (self.n_params + 1) + 2, len(voxel_index))
+        if self.array.shape != expected:
+            raise SystemExit(f"W-score pack {path} has shape {self.array.shape}; expected {expected} for this mask.")
+
+    def _rows(self, t: int) -> Tuple[np.ndarray, np.ndarray]:
+        start = t * (self.n_params + 1)
+        return self.array[start:start + self.n_params], self.array[start + self.n_params]
+
+    def stats(self, X: np.ndarray, dtype=np.float32) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        :param X: (subjects x params) design_matrix(..., centers=self.centers), columns in pack order
+        :return: Dict. Tissue -> ((voxels x subjects) expected values, residual SD); "composite" -> (mean, std)
+        """
+        rows = {tissue: self._rows(t) for t, tissue in enumerate(W_TISSUES)}
+        stats = expected_stats({t: r[0] for t, r in rows.items()}, {t: r[1] for t, r in rows.items()}, X, dtype)
+        stats["composite"] = (np.asarray(self.array[-2], dtype=dtype), np.asarray(self.array[-1], dtype=dtype))
+        return stats
+
+
+def w_pack_fingerprint(pack_path: Path, covariates_table: Path) -> str:
+    """Content hash of the pack, its sidecar and the covariates table (for --incremental)."""
+    h = hashlib.sha256(f"vbm-w-pack-v{PACK_VERSION}".encode())
+    for path in (pack_path, sidecar_path(pack_path), covariates_table):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def w_stats_for(pack: WScorePack, covariates_table: Path, get_tiv: Callable) -> Callable[[List[str], Dict[str, "pd.DataFrame"], type], dict]:
+    """Callable(subject keys, segments, dtype) -> that block's stats, so streaming code can build them per block."""
+    lookup = participant_lookup(covariates_table)
+
+    def _stats(batch: List[str], segments: Dict[str, "pd.DataFrame"], dtype=np.float32) -> dict:
+        tiv = get_tiv(segments) if pack.use_tiv else None
+        return pack.stats(design_matrix(covariate_rows(batch, lookup, pack.covariates, covariates_table), tiv, pack.centers), dtype)
+    return _stats
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Manifest for incremental re-scoring in run_z_scoring.py (--incremental).
+
+One JSON record per subject key holds the size, mtime and sha256 of each input segment, the control-stats
+fingerprint, the code version, the scoring options and the output paths. A subject is re-scored only when
+one of those changed or an output is missing. Inputs whose size and mtime match the stored record are not
+re-hashed, so checking an unchanged tree costs one stat() per file. By default the manifest lives next to the
+BIDS index cache (see bids_index.py), keyed by the experiments root, so the data root stays read-only.
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+from importlib import metadata
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+from bids_index import cache_path
+from stats_cache import publish_atomic
+
+ENGINE_FILES = ("run_z_scoring.py", "segment_loading.py", "nifti_writer.py", "stats_cache.py", "w_scoring.py", "normative_bank.py")
+
+
+def _sha256(path: Path, block: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def manifest_path(experiments_root: Path) -> Path:
+    """Default manifest for an experiments root: <cache dir>/zscore_manifest-<hash of root>.json."""
+    return cache_path(Path(experiments_root).absolute(), prefix="zscore_manifest")
+
+
+def code_version() -> str:
+    """Hash of the scoring sources next to this file plus the installed calvin_utils version."""
+    h = hashlib.sha256()
+    here = Path(__file__).resolve().parent
+    for name in ENGINE_FILES:
+        path = here / name
+        if path.exists():
+            h.update(path.read_bytes())
+    for dist in ("calvin-utils", "calvin_utils"):
+        try:
+            h.update(metadata.version(dist).encode())
+            break
+        except metadata.PackageNotFoundError:
+            continue
+    return h.hexdigest()[:16]
+
+
+class ZScoreManifest:
+    """Per-subject records of what each set of outputs was computed from."""
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.records: Dict[str, dict] = {}
+        self._fresh: Dict[str, Dict[str, dict]] = {}                    # input records computed by is_current
+        if self.path.exists():
+            with open(self.path) as f:
+                self.records = json.load(f).get("subjects", {})
+
+    def _file_record(self, key: str, path: Path) -> dict:
+        """size/mtime/sha256 of one input, reusing the stored hash when size and mtime are unchanged."""
+        st = os.stat(path)
+        old = self.records.get(key, {}).get("inputs", {}).get(str(path))
+        if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            return old
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": _sha256(path)}
+
+    def input_records(self, key: str, inputs: Iterable[Path]) -> Dict[str, dict]:
+        return {str(p): self._file_record(key, Path(p)) for p in inputs}
+
+    def is_current(self, key: str, inputs: Iterable[Path], context: dict, outputs: List[str]) -> bool:
+        """
+        :param key: Subject key (e.g. sub-01/ses-01)
+        :param inputs: Input segment paths
+        :param context: Dict with stats fingerprint, code version and options
+        :param outputs: Output paths the subject should have
+        :return: True if the stored record matches and every output exists
+        """
+        old = self.records.get(key)
+        if old is None or old.get("context") != context or sorted(old.get("outputs", [])) != sorted(outputs):
+            return False
+        if not all(Path(o).exists() for o in outputs):
+            return False
+        current = self._fresh[key] = self.input_records(key, inputs)
+        return {p: r["sha256"] for p, r in current.items()} == {p: r["sha256"] for p, r in old["inputs"].items()}
+
+    def record(self, key: str, inputs: Iterable[Path], context: dict, outputs: List[str]) -> None:
+        fresh = self._fresh.pop(key, None)
+        inputs = [str(p) for p in inputs]
+        if fresh is None or sorted(fresh) != sorted(inputs):
+            fresh = self.input_records(key, inputs)
+        self.records[key] = {"inputs": fresh, "context": context, "outputs": list(outputs)}
+
+    def save(self) -> None:
+        """Atomically rewrite the manifest."""
+        payload = json.dumps({"subjects": self.records}, indent=1, sort_keys=True).encode()
+        publish_atomic(self.path, lambda f: f.write(payload))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Resident z-scoring service for low-latency single-patient scoring.
+
+Each run of run_z_scoring.py starts a fresh Python. It re-imports pandas/nilearn/calvin_utils and decodes
+the mask, the eight control-stat NIfTIs and every ROI atlas before it scores a single subject. `serve`
+loads all of that once and keeps it resident: the mask index and geometry, the control stats (optionally
+from a --stats-cache pack), and each ROI atlas as in-mask index lists. It then answers scoring requests
+over localhost HTTP or a Unix socket. A request decodes only the patient's three segments, runs the same
+_score_block as run_z_scoring.py, writes the usual BIDS outputs and regional CSVs, and returns the output
+paths and regional tables as JSON.
+Quick Start:
+    python zscore_service.py serve --control-stats-dir /root/assets/ctrl_dist --socket /tmp/vbm.sock
+    python zscore_service.py score --socket /tmp/vbm.sock --root /root/data \\
+        --gm /root/data/sub-01/ses-01/mri/mwp1T1_resampled.nii ...
+    python zscore_service.py bench --socket /tmp/vbm.sock --root /root/data --gm ... --repeat 20
+Endpoints:
+    GET /health: Stats fingerprint, atlases, startup time and requests served
+    POST /score: JSON {"root", "gm", "wm", "csf", "write": true}. Returns {"outputs", "regional", "seconds"}
+Note:
+    Scoring is always mask-compressed (see --mask-compress in run_z_scoring.py). TIV still comes from the
+    full volumes, and written maps are zero outside the mask. Regional means use measure_regional_atrophy.py's
+    roi_mean over every ROI voxel of the composite as written (zero outside the mask), so they match what
+    measure_regional_atrophy.py computes from the written composite maps.
+    Requests are scored one at a time; --write-workers parallelises the NIfTI writes within a request.
+"""
+from __future__ import annotations
+import argparse
+import http.client
+import json
+import socket
+import socketserver
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from measure_regional_atrophy import _load_roi_arrays, roi_mean, roi_table, save_roi_csv
+from nifti_writer import MaskGeometry, NiftiWriter
+from run_z_scoring import (ANALYSES, DEFAULT_MASK, DEFAULT_VOXEL_CHUNK, DTYPES, _control_stat_paths, _extract_subid,
+                           _score_block, bids_output_path, load_control_stats, stats_dir_args)
+from segment_loading import _load_dfs, load_mask_index
+from stats_cache import stats_fingerprint
+
+DEFAULT_STATS_DIR = Path("/root/assets/ctrl_dist")
+DEFAULT_ATLASES = (
+    "regional_atrophy_coarse=/root/assets/rois/anatomic_coarse",
+    "regional_atrophy_fine=/root/assets/rois/aal_fine",
+    "tract_atrophy=/root/assets/rois/jhu_81",
+    "network_atrophy=/root/assets/rois/yeo_7",
+)
+DEFAULT_PORT = 8765
+
+
+class RoiAtlas:
+    """An ROI directory held as the flat grid indices of each ROI."""
+    def __init__(self, roi_dir: Path, voxel_index: np.ndarray, grid_size: int):
+        roi_paths = sorted(p for p in Path(roi_dir).rglob("*.nii*") if p.is_file())
+        if not roi_paths:
+            raise SystemExit(f"No ROI NIfTI files found under {roi_dir}")
+        self.voxel_index = voxel_index
+        self.grid_size = grid_size
+        self.rois: List[Tuple[str, np.ndarray | None]] = []
+        for name, data in _load_roi_arrays(roi_paths).items():
+            if data.shape[0] != grid_size:
+                print(f"Warning: ROI {name} has {data.shape[0]} voxels, mask grid has {grid_size}. Recording NaN.")
+                self.rois.append((name, None))
+                continue
+            self.rois.append((name, np.flatnonzero((data > 0) & np.isfinite(data))))
+
+    def table(self, composite: np.ndarray) -> pd.DataFrame:
+        """
+        Regional table of a mask-compressed composite vector, as compute_roi_means gives for the written map.
+        The composite is scattered onto the grid with zeros outside the mask, as the NIfTI writer does.
+        """
+        grid = np.zeros(self.grid_size, dtype=composite.dtype)
+        grid[self.voxel_index] = composite
+        return roi_table([(name, roi_mean(grid[idx]) if idx is not None else np.nan) for name, idx in self.rois])
+
+
+class ZScoreService:
+    """Mask, control stats and atlases loaded once; score() handles one patient."""
+    def __init__(self, args: argparse.Namespace):
+        start = time.perf_counter()
+        self.dtype = DTYPES[args.dtype]
+        self.kernel = args.kernel
+        self.voxel_chunk = args.voxel_chunk
+        self.voxel_index = load_mask_index(args.mask_path)
+        self.geometry = MaskGeometry(args.mask_path)
+        stat_args = stats_dir_args(args.control_stats_dir, args.mask_path, args.stats_cache)
+        self.fingerprint = stats_fingerprint(_control_stat_paths(stat_args), args.mask_path)
+        self.stats = load_control_stats(stat_args, self.voxel_index, self.dtype)
+        self.atlases: Dict[str, RoiAtlas] = {}
+        for spec in args.atlas:
+            name, roi_dir = spec.split("=", 1)
+            self.atlases[name] = RoiAtlas(Path(roi_dir), self.voxel_index, self.geometry.size)
+        self.writer = NiftiWriter(self.geometry, workers=args.write_workers)
+        self._lock = threading.Lock()
+        self.served = 0
+        self.startup_seconds = time.perf_counter() - start
+
+    def health(self) -> dict:
+        return {"status": "ok", "stats": self.fingerprint, "atlases": list(self.atlases),
+                "startup_seconds": round(self.startup_seconds, 3), "served": self.served}
+
+    def score(self, root: str, gm: str, wm: str, csf: str, write: bool = True) -> dict:
+        """
+        Score one patient against the resident control stats.
+
+        :param root: BIDS root the outputs are written under (as --experiments-root)
+        :param gm: Grey matter segment (likewise wm, csf). Outputs are named from the gm path.
+        :param write: Write the z-score NIfTIs and regional CSVs. Regional tables are returned either way.
+        :return: Dict with output paths, regional tables (ROI -> Atrophy_Z per atlas) and seconds taken
+        """
+        start = time.perf_counter()
+        with self._lock:
+            segments = _load_dfs({"grey_matter": [Path(gm)], "white_matter": [Path(wm)], "cerebrospinal_fluid": [Path(csf)]},
+                                 self.voxel_index, io_workers=3, dtype=self.dtype)
+            unreadable = [k for k, df in segments.items() if df.empty]
+            if unreadable:
+                raise ValueError(f"Could not read segments: {', '.join(unreadable)}")
+            atrophy, atrophy_thresholded = _score_block(segments, self.stats, self.voxel_chunk, self.dtype, self.kernel)
+            tables = {name: atlas.table(atrophy["composite"][:, 0]) for name, atlas in self.atlases.items()}
+
+            outputs = {}
+            if write:
+                for analysis, arrays in zip(ANALYSES, (atrophy, atrophy_thresholded)):
+                    for tissue, arr in arrays.items():
+                        out_path = bids_output_path(root, gm, analysis, tissue)
+                        self.writer.submit(arr[:, 0], out_path, self.voxel_index)
+                        outputs[f"{analysis}/{tissue}"] = out_path
+                _, subfolder, sesfolder = _extract_subid(root, gm)
+                for name, df in tables.items():
+                    outputs[f"measurements/{name}"] = str(save_roi_csv(df, Path(root), subfolder, sesfolder, name))
+                self.writer.flush()
+            self.served += 1
+        return {
+            "outputs": outputs,
+            "regional": {name: {roi: None if np.isnan(z) else z for roi, z in zip(df["ROI"], df["Atrophy_Z"])}
+                         for name, df in tables.items()},
+            "seconds": round(time.perf_counter() - start, 4),
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service: ZScoreService
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else "unix"
+
+    def _reply(self, code: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path != "/health":
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        self._reply(200, self.service.health())
+
+    def do_POST(self) -> None:
+        if self.path != "/score":
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            result = self.service.score(req["root"], req["gm"], req["wm"], req["csf"], write=req.get("write", True))
+        except (KeyError, ValueError) as exc:
+            self._reply(400, {"error": str(exc)})
+            return
+        except Exception as exc:
+            self._reply(500, {"error": f"{type(exc).__name__}: {exc}"})
+            return
+        self._reply(200, result)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _connection(args: argparse.Namespace) -> http.client.HTTPConnection:
+    if args.socket:
+        return _UnixHTTPConnection(str(args.socket), args.timeout)
+    return http.client.HTTPConnection(args.host, args.port, timeout=args.timeout)
+
+
+def request(args: argparse.Namespace, method: str, path: str, body: dict | None = None) -> dict:
+    """One request to a running service. Raises SystemExit with the service's error message on failure."""
+    conn = _connection(args)
+    try:
+        payload = json.dumps(body).encode() if body is not None else None
+        conn.request(method, path, body=payload, headers={"Content-Type": "application/json"} if payload else {})
+        resp = conn.getresponse()
+        result = json.loads(resp.read())
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise SystemExit(f"Service returned {resp.status}: {result.get('error')}")
+    return result
+
+
+def _score_body(args: argparse.Namespace) -> dict:
+    return {"root": str(args.root), "gm": str(args.gm), "wm": str(args.wm), "csf": str(args.csf), "write": not args.no_write}
+
+
+def serve(args: argparse.Namespace) -> None:
+    service = ZScoreService(args)
+    _Handler.service = service
+    if args.socket:
+        args.socket.unlink(missing_ok=True)
+        server = _UnixHTTPServer(str(args.socket), _Handler)
+        where = str(args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), _Handler)
+        where = f"http://{args.host}:{args.port}"
+    print(f"Loaded mask, control stats and {len(service.atlases)} atlases in {service.startup_seconds:.2f}s. Serving on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.writer.close()
+        if args.socket:
+            args.socket.unlink(missing_ok=True)
+
+
+def score(args: argparse.Namespace) -> None:
+    result = request(args, "POST", "/score", _score_body(args))
+    if args.out:
+        args.out.write_text(json.dumps(result, indent=1))
+    for key, path in result["outputs"].items():
+        print(f"{key}: {path}")
+    print(f"Scored in {result['seconds']:.3f}s (service time)")
+
+
+def bench(args: argparse.Namespace) -> None:
+    """Round-trip latency of --repeat requests for the same patient, after --warmup untimed ones."""
+    print(json.dumps(request(args, "GET", "/health")))
+    body = _score_body(args)
+    for _ in range(args.warmup):
+        request(args, "POST", "/score", body)
+    wall, service_time = [], []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = request(args, "POST", "/score", body)
+        wall.append(time.perf_counter() - start)
+        service_time.append(result["seconds"])
+    wall.sort()
+    p95 = wall[min(len(wall) - 1, int(round(0.95 * (len(wall) - 1))))]
+    print(f"{args.repeat} requests (write={body['write']}): round trip min {wall[0]:.3f}s, median {statistics.median(wall):.3f}s, "
+          f"p95 {p95:.3f}s, max {wall[-1]:.3f}s; service median {statistics.median(service_time):.3f}s")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Resident VBM z-scoring service, client and latency benchmark.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def _add_transport(p):
+        p.add_argument("--socket", type=Path, default=None, help="Unix socket path (overrides --host/--port).")
+        p.add_argument("--host", default="127.0.0.1", help="Host to bind/connect (default: 127.0.0.1).")
+        p.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"TCP port (default: {DEFAULT_PORT}).")
+
+    def _add_patient(p):
+        p.add_argument("--timeout", type=float, default=120.0, help="Client timeout in seconds (default: 120).")
+        p.add_argument("--root", type=Path, required=True, help="BIDS root outputs are written under.")
+        p.add_argument("--gm", type=Path, required=True, help="Grey matter segment (outputs are named from it).")
+        p.add_argument("--wm", type=Path, required=True, help="White matter segment.")
+        p.add_argument("--csf", type=Path, required=True, help="CSF segment.")
+        p.add_argument("--no-write", action="store_true", help="Return z/regional results without writing files.")
+
+    p = sub.add_parser("serve", help="Load control stats and atlases once and serve scoring requests.")
+    _add_transport(p)
+    p.add_argument("--control-stats-dir", type=Path, default=DEFAULT_STATS_DIR,
+                   help=f"Directory with <tissue>_mean/_std and norm_mean/_std (default: {DEFAULT_STATS_DIR}).")
+    p.add_argument("--stats-cache", type=Path, default=None, help="Memory-mapped stats pack directory (see run_z_scoring.py).")
+    p.add_argument("--mask-path", type=Path, default=DEFAULT_MASK, help=f"Reference mask (default: {DEFAULT_MASK}).")
+    p.add_argument("--atlas", action="append", default=None, metavar="NAME=DIR",
+                   help="ROI directory kept resident; NAME is the regional CSV name. Repeatable (default: the run_pipeline.sh atlases).")
+    p.add_argument("--dtype", choices=sorted(DTYPES), default="float32", help="Voxel tensor dtype (default: float32).")
+    p.add_argument("--kernel", choices=["fused", "pandas"], default="fused", help="Scoring kernel (default: fused).")
+    p.add_argument("--voxel-chunk", type=int, default=DEFAULT_VOXEL_CHUNK, help=f"Voxels per step (default: {DEFAULT_VOXEL_CHUNK}).")
+    p.add_argument("--write-workers", type=int, default=4, help="Threads writing output NIfTIs (default: 4).")
+    p.set_defaults(func=serve)
+
+    p = sub.add_parser("score", help="Score one patient on a running service.")
+    _add_transport(p)
+    _add_patient(p)
+    p.add_argument("--out", type=Path, default=None, help="Write the full JSON response here.")
+    p.set_defaults(func=score)
+
+    p = sub.add_parser("bench", help="Measure request latency against a running service.")
+    _add_transport(p)
+    _add_patient(p)
+    p.add_argument("--repeat", type=int, default=20, help="Timed requests (default: 20).")
+    p.add_argument("--warmup", type=int, default=2, help="Untimed requests first (default: 2).")
+    p.set_defaults(func=bench)
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    if args.command == "serve" and args.atlas is None:
+        args.atlas = list(DEFAULT_ATLASES)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
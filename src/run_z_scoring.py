@@ -30,6 +30,14 @@ Output Options:
     --output-base-dir: BIDS dataset root directory for output
     --session: Session label for BIDS output (default: "ses-01")
     --mask-path: Reference mask for NIfTI output (default: rois/MNI152_T1_2mm_brain_mask.nii)
+    --mask-compress: Gather every volume to in-mask voxels at load time and only scatter back to
+                     the full grid when writing NIfTIs (~4x less memory and arithmetic). TIV is still
+                     taken from the full volumes.
+Loading Options:
+    --io-workers: Concurrent NIfTI decoders. Above 1, segments are loaded by a thread/process pool
+                  (scripts/segment_loading.py) instead of import_segments. Columns are named by
+                  --subject-id-index/--sub-id-str if given, else by file path (default: 1)
+    --io-backend: "thread" (decode straight into the shared array) or "process" (default: thread)
     --unthresholded-analysis: Output folder name for z-scores (default: unthresholded_tissue_segment_z_scores)
     --thresholded-analysis: Output folder name for thresholded z-scores (default: thresholded_tissue_segment_z_scores)
     --dry-run: Preview output paths without writing files
@@ -39,10 +47,13 @@ Outputs:
 """
 from __future__ import annotations
 import os
+import sys
 import argparse
+from glob import glob
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List
 
+import nibabel as nib
 import numpy as np
 import pandas as pd
 
@@ -50,7 +61,10 @@ from calvin_utils.file_utils.import_functions import GiiNiiFileImport
 from calvin_utils.nifti_utils.matrix_utilities import import_nifti_to_numpy_array
 from calvin_utils.vbm_utils.composite_atrophy_mapper import generate_norm, generate_norm_map, generate_tensor, prepocess_dict
 from calvin_utils.vbm_utils.loading import import_segments
-from calvin_utils.vbm_utils.processing import get_tiv, process_atrophy, process_tissue, save_nifti_to_bids
+from calvin_utils.vbm_utils.processing import process_tissue, save_nifti_to_bids
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))  # segment loading is shared with scripts/run_z_scoring.py
+from segment_loading import VOLUME_SUM, _load_dfs, load_mask_index, process_atrophy_full_tiv, segment_tiv
 
 DEFAULT_MASK = Path("rois/MNI152_T1_2mm_brain_mask.nii")
 
@@ -67,9 +81,91 @@ def _splice_columns(data_dict: Dict[str, "pd.DataFrame"], pre: str, post: str) -
         return data_dict
 
     for tissue in data_dict:
+        attrs = data_dict[tissue].attrs
         data_dict[tissue] = GiiNiiFileImport.splice_colnames(data_dict[tissue], pre=pre, post=post)
+        data_dict[tissue].attrs.update(attrs)                          # keep VOLUME_SUM (see segment_tiv)
     return data_dict
 
+def _gather_to_mask(data_dict: Dict[str, "pd.DataFrame"], voxel_index: np.ndarray) -> Dict[str, "pd.DataFrame"]:
+    """
+    Keep only the in-mask rows of each full-grid DataFrame. The flat voxel indices become the row index.
+    
+    :param data_dict: Dict. Tissue -> (voxels x subjects) DataFrame spanning the full grid
+    :param voxel_index: Flat in-mask indices from load_mask_index
+    :return: Dict. Same keys, mask-compressed DataFrames with each column's full-grid sum in df.attrs[VOLUME_SUM]
+    """
+    out = {}
+    for k, df in data_dict.items():
+        out[k] = df.iloc[voxel_index].set_axis(voxel_index, axis=0)
+        out[k].attrs[VOLUME_SUM] = df.sum(axis=0).to_numpy(dtype=np.float64)
+    return out
+
+def _scatter_to_grid(data_dict: Dict[str, "pd.DataFrame"], voxel_index: np.ndarray, n_voxels: int) -> Dict[str, "pd.DataFrame"]:
+    """
+    Inverse of _gather_to_mask. Out-of-mask voxels are filled with 0.
+    
+    :param data_dict: Dict. Tissue -> mask-compressed DataFrame
+    :param voxel_index: Flat in-mask indices used for the gather
+    :param n_voxels: Number of voxels in the full grid
+    :return: Dict. Same keys, full-grid DataFrames ready for save_nifti_to_bids
+    """
+    out = {}
+    for k, df in data_dict.items():
+        full = np.zeros((n_voxels, df.shape[1]), dtype=df.values.dtype)
+        full[voxel_index] = df.values
+        out[k] = pd.DataFrame(full, columns=df.columns)
+    return out
+
+def _column_name(path: Path, sub_id_index: int | None, sub_id_str: str | None) -> str:
+    """Subject column name: the path component at sub_id_index, else the folder after sub_id_str, else the file path."""
+    parts = Path(path).parts
+    if sub_id_index is not None:
+        return parts[sub_id_index]
+    if sub_id_str:
+        hit = next((i for i, p in enumerate(parts[:-1]) if sub_id_str in p), None)
+        if hit is not None:
+            return parts[hit + 1]
+    return str(path)
+
+def pool_import_segments(
+    base_dir: Path,
+    patterns: Dict[str, str],
+    sub_id_index: int | None,
+    sub_id_str: str | None,
+    drop_substring: str | None,
+    voxel_index: np.ndarray | None = None,
+    io_workers: int = 1,
+    io_backend: str = "thread",
+    dtype=np.float32,
+) -> Dict[str, "pd.DataFrame"]:
+    """
+    Concurrent replacement for import_segments: globs each tissue and decodes every file on one shared pool
+    with segment_loading._load_dfs (as scripts/run_z_scoring.py does). Column j is always the j-th sorted
+    file, so output is deterministic regardless of completion order.
+    
+    :param base_dir: The root to start globbing from.
+    :param patterns: Dict. Tissue -> glob pattern relative to base_dir.
+    :param sub_id_index: Path component used as the column name (--subject-id-index).
+    :param sub_id_str: Otherwise, the folder after the first component containing it names the column (--sub-id-str).
+    :param voxel_index: Optional flat in-mask indices (see --mask-compress).
+    :param io_workers: Number of concurrent decoders.
+    :param io_backend: "thread" writes into the shared arrays from workers; "process" ships vectors back.
+    :param dtype: dtype of the preallocated arrays. float32, as import_segments hands the segments back.
+    :return: Dict. Tissue -> DataFrame with one column per file, named by file path unless sub_id_index/sub_id_str is given
+    """
+    files_by_tissue: Dict[str, List[Path]] = {}
+    for tissue, pattern in patterns.items():
+        files = sorted(glob(os.path.join(str(base_dir), pattern)))
+        files_by_tissue[tissue] = [Path(f) for f in files if not (drop_substring and drop_substring in f)]
+    if not any(files_by_tissue.values()):
+        raise SystemExit(f"No segments matched {list(patterns.values())} under {base_dir}")
+    segments = _load_dfs(files_by_tissue, voxel_index, io_workers, io_backend, dtype)
+    for tissue, df in segments.items():
+        attrs = df.attrs
+        segments[tissue] = df.set_axis([_column_name(f, sub_id_index, sub_id_str) for f in df.columns], axis=1)
+        segments[tissue].attrs.update(attrs)
+    return segments
+
 def load_segments(
     label: str,
     base_dir: Path,
@@ -79,6 +175,9 @@ def load_segments(
     subject_id_index: int | None,
     sub_id_str: str | None,
     drop_substring: str | None,
+    voxel_index: np.ndarray | None = None,
+    io_workers: int = 1,
+    io_backend: str = "thread",
 ) -> Dict[str, "pd.DataFrame"]:
     """
     Loads in each patient's MWP file into a dataframe, 
@@ -88,9 +187,23 @@ def load_segments(
     :param gm_pattern: File match for grey matter. 
     :param wm_pattern: File match for white matter. 
     :param csf_pattern: File match for CSF. 
+    :param voxel_index: Optional flat in-mask indices. If given, each DataFrame keeps only those rows.
+    :param io_workers: Above 1, decode with pool_import_segments instead of import_segments.
+    :param io_backend: Pool type for io_workers ("thread" or "process").
     :return: Dictionary with a K:V pair for each MWP segment, where keys are dataframes for the corresponding segment
     """
     print(f"Loading {label} segments from {base_dir} ...")
+    if io_workers > 1:
+        return pool_import_segments(
+            base_dir=base_dir,
+            patterns={"grey_matter": gm_pattern, "white_matter": wm_pattern, "cerebrospinal_fluid": csf_pattern},
+            sub_id_index=subject_id_index,
+            sub_id_str=sub_id_str,
+            drop_substring=drop_substring,
+            voxel_index=voxel_index,
+            io_workers=io_workers,
+            io_backend=io_backend,
+        )
     segments = import_segments(
         base_dir=str(base_dir),
         gm_pattern=gm_pattern,
@@ -100,6 +213,8 @@ def load_segments(
         sub_id_str=sub_id_str,
         drop_substring=drop_substring,
     )
+    if voxel_index is not None:
+        segments = _gather_to_mask(segments, voxel_index)
     return segments
 
 def run_pipeline(args: argparse.Namespace) -> None:
@@ -124,6 +239,7 @@ def run_pipeline(args: argparse.Namespace) -> None:
     )
     if not use_precalc_stats and not args.controls_root:
         raise SystemExit("Provide either a control directory or pre-calculated control stats.")
+    voxel_index = load_mask_index(args.mask_path) if args.mask_compress else None
 
     # Imports
     ctrl_segments = None
@@ -137,6 +253,9 @@ def run_pipeline(args: argparse.Namespace) -> None:
             subject_id_index=args.subject_id_index,
             sub_id_str=args.sub_id_str,
             drop_substring=args.drop_substring,
+            voxel_index=voxel_index,
+            io_workers=args.io_workers,
+            io_backend=args.io_backend,
         )
 
     expt_segments = load_segments(
@@ -148,6 +267,9 @@ def run_pipeline(args: argparse.Namespace) -> None:
         subject_id_index=args.subject_id_index,
         sub_id_str=args.sub_id_str,
         drop_substring=args.drop_substring,
+        voxel_index=voxel_index,
+        io_workers=args.io_workers,
+        io_backend=args.io_backend,
     )
     expt_segments = _splice_columns(expt_segments, pre=args.pre_subject_str, post=args.post_subject_str)
     if ctrl_segments is not None:
@@ -155,33 +277,43 @@ def run_pipeline(args: argparse.Namespace) -> None:
 
     # Atrophy Calculation
     if use_precalc_stats:
-        stats = load_control_stats(args)
+        stats = load_control_stats(args, voxel_index)
         atrophy, atrophy_thresholded = compute_z_with_precalc_stats(expt_segments, stats)
         composite = compute_composite_with_precalc_stats(atrophy, stats)
     else:
-        atrophy, atrophy_thresholded, _ = process_atrophy(expt_segments, ctrl_segments)
-        z_ctrl, _, _ = process_atrophy(data_dict=ctrl_segments, ctrl_dict=ctrl_segments)
+        atrophy, atrophy_thresholded, _ = process_atrophy_full_tiv(expt_segments, ctrl_segments)
+        z_ctrl, _, _ = process_atrophy_full_tiv(data_dict=ctrl_segments, ctrl_dict=ctrl_segments)
         composite, _, _ = generate_norm_map(pt_dict=atrophy, ctrl_dict=z_ctrl)
     atrophy["composite"] = composite
     atrophy_thresholded["composite"] = composite.where(composite > 0, 0)
 
     # Save outputs
-    save_nifti_to_bids(
-        atrophy,
-        bids_base_dir=str(args.output_base_dir),
-        mask_path=str(args.mask_path),
-        analysis=args.unthresholded_analysis,
-        ses=args.session,
-        dry_run=args.dry_run,
-    )
-    save_nifti_to_bids(
-        atrophy_thresholded,
-        bids_base_dir=str(args.output_base_dir),
-        mask_path=str(args.mask_path),
-        analysis=args.thresholded_analysis,
-        ses=args.session,
-        dry_run=args.dry_run,
-    )
+    save_outputs(atrophy, args, args.unthresholded_analysis, voxel_index)
+    save_outputs(atrophy_thresholded, args, args.thresholded_analysis, voxel_index)
+
+def save_outputs(data_dict: Dict[str, "pd.DataFrame"], args: argparse.Namespace, analysis: str, voxel_index: np.ndarray | None = None) -> None:
+    """
+    save_nifti_to_bids for one analysis. Mask-compressed frames are scattered back to the full grid one
+    tissue at a time, just before that tissue is saved, so only one full-grid frame exists at a time.
+    
+    :param data_dict: Dict. Tissue -> (voxels x subjects) DataFrame, mask-compressed if voxel_index is given
+    :param analysis: Output folder name
+    :param voxel_index: Flat in-mask indices used for the gather, or None for full-grid frames
+    """
+    if voxel_index is None:
+        frames = [data_dict]
+    else:
+        n_voxels = nib.load(str(args.mask_path)).get_fdata().size
+        frames = (_scatter_to_grid({tissue: df}, voxel_index, n_voxels) for tissue, df in data_dict.items())
+    for frame in frames:
+        save_nifti_to_bids(
+            frame,
+            bids_base_dir=str(args.output_base_dir),
+            mask_path=str(args.mask_path),
+            analysis=analysis,
+            ses=args.session,
+            dry_run=args.dry_run,
+        )
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -252,6 +384,13 @@ def build_parser() -> argparse.ArgumentParser:
         help="Analysis folder name for thresholded outputs.")
     parser.add_argument("--dry-run", action="store_true",
         help="Print intended output paths instead of writing NIfTI files.")
+    parser.add_argument("--mask-compress", action="store_true",
+        help="Keep only in-mask voxels from load until saving. TIV still comes from the full volumes.")
+    parser.add_argument("--io-workers", type=int, default=1,
+        help="Concurrent NIfTI decoders. Above 1, segments are loaded by a pool; columns are named by --subject-id-index/"
+             "--sub-id-str, else by file path (default: 1).")
+    parser.add_argument("--io-backend", choices=["thread", "process"], default="thread",
+        help="Pool type for --io-workers. Threads decode directly into the shared array (default: thread).")
     return parser
 
 def _resolve_stat_path(base: Path | None, override: Path | None, name: str) -> Path:
@@ -275,49 +414,52 @@ def _resolve_stat_path(base: Path | None, override: Path | None, name: str) -> P
         return nii_gz_path
     raise SystemExit(f"Missing control stat file: {nii_path} or {nii_gz_path}")
 
-def _load_flattened_nifti(path: Path) -> np.ndarray:
+def _load_flattened_nifti(path: Path, voxel_index: np.ndarray | None = None) -> np.ndarray:
     """
     Simple import to load a nifti directly into a flattened numpy array
     
     :param path: Path to the nifti
+    :param voxel_index: Optional flat in-mask indices. If given, only those voxels are returned.
     :return: np array containing the flattened nifti
     """
     arr = import_nifti_to_numpy_array(str(path))
     if arr is None:
         raise SystemExit(f"Could not read NIfTI: {path}")
-    return np.asarray(arr).flatten()
+    flat = np.asarray(arr).flatten()
+    return flat if voxel_index is None else flat[voxel_index]
 
 
-def load_control_stats(args: argparse.Namespace):
+def load_control_stats(args: argparse.Namespace, voxel_index: np.ndarray | None = None):
     """
     Loads in the precalculated normative files representing the control distribution.
     
     :param args: Args from the command line.
+    :param voxel_index: Optional flat in-mask indices to gather each statistic to.
     :return: A dictionary with keys for each segment, and a tuple holding (mean, stdev) files
     """
     stats = {}
     stats["grey_matter"] = (
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.gm_mean, "grey_matter_mean")),
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.gm_std, "grey_matter_std")),
+        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.gm_mean, "grey_matter_mean"), voxel_index),
+        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.gm_std, "grey_matter_std"), voxel_index),
     )
     stats["white_matter"] = (
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.wm_mean, "white_matter_mean")),
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.wm_std, "white_matter_std")),
+        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.wm_mean, "white_matter_mean"), voxel_index),
+        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.wm_std, "white_matter_std"), voxel_index),
     )
     stats["cerebrospinal_fluid"] = (
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.csf_mean, "cerebrospinal_fluid_mean")),
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.csf_std, "cerebrospinal_fluid_std")),
+        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.csf_mean, "cerebrospinal_fluid_mean"), voxel_index),
+        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.csf_std, "cerebrospinal_fluid_std"), voxel_index),
     )
     stats["composite"] = (
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.composite_mean, "norm_mean")),
-        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.composite_std, "norm_std")),
+        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.composite_mean, "norm_mean"), voxel_index),
+        _load_flattened_nifti(_resolve_stat_path(args.control_stats_dir, args.composite_std, "norm_std"), voxel_index),
     )
     return stats
 
 
 def compute_z_with_precalc_stats(expt_segments: Dict[str, "pd.DataFrame"], stats: dict):
     """Calculate patient z-scores using precomputed control mean/std arrays."""
-    pt_tiv = get_tiv(expt_segments)
+    pt_tiv = segment_tiv(expt_segments)
     zscore_dict = {}
     zscore_mask_dict = {}
     for tissue, df in expt_segments.items():
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The pipeline modules import each other as top-level scripts (python scripts/<name>.py).
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
@@ -0,0 +1,48 @@
+from pathlib import Path
+
+import pytest
+
+import bids_index
+from bids_index import BidsIndex, index_glob, open_index
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    monkeypatch.setenv("BIDS_INDEX_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(bids_index, "_OPEN", {})
+    for sub in ("sub-01", "sub-02"):
+        anat = tmp_path / "data" / sub / "ses-01" / "anat"
+        anat.mkdir(parents=True)
+        (anat / f"{sub}_T1w.nii.gz").touch()
+        (anat / f"._{sub}_T1w.nii.gz").touch()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_glob_matches_glob_module(tree):
+    index = BidsIndex(tree / "data").refresh()
+    assert index.glob("*/ses-01/anat/*T1w.nii*") == sorted((tree / "data").glob("*/ses-01/anat/[!.]*T1w.nii*"))
+    assert index.rglob("ses-01", dirs=True) == [tree / "data" / s / "ses-01" for s in ("sub-01", "sub-02")]
+
+
+def test_relative_root_yields_paths_relative_to_it(tree):
+    root = Path("data")
+    hits = open_index(root).glob("**/anat/*T1w.nii.gz")
+    assert hits == [Path("data/sub-01/ses-01/anat/sub-01_T1w.nii.gz"), Path("data/sub-02/ses-01/anat/sub-02_T1w.nii.gz")]
+    assert [p.relative_to(root).parts[0] for p in hits] == ["sub-01", "sub-02"]
+    assert all(p.is_file() for p in hits)
+
+
+def test_index_glob_keeps_the_callers_spelling(tree):
+    relative = index_glob(Path("data/sub-*/ses-01"), "anat/*T1w.nii.gz")
+    absolute = index_glob(tree / "data" / "sub-*" / "ses-01", "anat/*T1w.nii.gz")
+    assert [p.absolute() for p in relative] == absolute
+    assert all(not p.is_absolute() for p in relative)
+
+
+def test_cache_stays_out_of_the_data_tree(tree, monkeypatch):
+    monkeypatch.setattr(bids_index, "RACY_SECONDS", 0.0)                  # the tree was written just now
+    index = BidsIndex(Path("data")).refresh()
+    assert index.path.parent == tree / "cache"
+    assert not list((tree / "data").rglob("*.json"))
+    assert BidsIndex(Path("data")).refresh().rescanned == 0
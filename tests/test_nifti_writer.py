@@ -0,0 +1,50 @@
+import time
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from nifti_writer import MaskGeometry, NiftiWriter
+
+SHAPE = (4, 3, 2)
+
+
+@pytest.fixture
+def geometry(tmp_path):
+    path = tmp_path / "mask.nii.gz"
+    nib.save(nib.Nifti1Image(np.ones(SHAPE, dtype=np.uint8), np.eye(4)), path)
+    return MaskGeometry(path)
+
+
+def _wait_idle(writer, timeout=10):
+    deadline = time.monotonic() + timeout
+    while writer._pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_finished_writes_are_dropped(geometry, tmp_path):
+    with NiftiWriter(geometry, workers=2, max_pending=3) as writer:
+        for i in range(20):
+            writer.submit(np.full(int(np.prod(SHAPE)), i, dtype=np.float32), str(tmp_path / "out" / f"{i}.nii.gz"))
+            assert len(writer._pending) <= 3
+        writer.flush()
+        assert not writer._pending
+    assert nib.load(tmp_path / "out" / "19.nii.gz").get_fdata().max() == 19
+
+
+def test_failure_is_raised_by_the_next_submit(geometry, tmp_path):
+    (tmp_path / "blocker").write_text("a file where a directory is needed")
+    vec = np.zeros(int(np.prod(SHAPE)), dtype=np.float32)
+    writer = NiftiWriter(geometry, workers=2)
+    writer.submit(vec, str(tmp_path / "blocker" / "sub" / "x.nii.gz"))
+    _wait_idle(writer)
+    with pytest.raises(OSError):
+        writer.submit(vec, str(tmp_path / "ok.nii.gz"))
+    writer.close()                                                      # already reported: closes cleanly
+
+
+def test_failure_is_raised_by_close(geometry, tmp_path):
+    (tmp_path / "blocker").write_text("a file where a directory is needed")
+    with pytest.raises(OSError):
+        with NiftiWriter(geometry, workers=2) as writer:
+            writer.submit(np.zeros(int(np.prod(SHAPE)), dtype=np.float32), str(tmp_path / "blocker" / "sub" / "x.nii.gz"))
@@ -0,0 +1,27 @@
+import numpy as np
+
+import quantile_sketch
+from quantile_sketch import QuantileSketch
+
+
+def test_counts_stay_uint16_and_match_a_uint32_sketch():
+    block = np.random.default_rng(0).uniform(0.1, 1, (50, 40))
+    sketch = QuantileSketch(50)
+    sketch.update(block)
+    assert sketch.counts.dtype == np.uint16
+    wide = QuantileSketch.from_state(dict(sketch.state(), counts=sketch.counts.astype(np.uint32)))
+    assert wide.counts.dtype == np.uint16
+    np.testing.assert_array_equal(wide.quantile(0.5), sketch.quantile(0.5))
+
+
+def test_counts_widen_before_they_could_wrap(monkeypatch):
+    monkeypatch.setattr(quantile_sketch, "NARROW_MAX", 10)
+    left, right = QuantileSketch(3), QuantileSketch(3)
+    left.update(np.full((3, 6), 0.5))
+    right.update(np.full((3, 6), 0.5))
+    assert left.counts.dtype == np.uint16
+    left.merge(right)
+    assert left.counts.dtype == np.uint32 and (left.n == 12).all()
+    left.update(np.full((3, 1), 0.5))
+    assert (left.n == 13).all()
+    assert QuantileSketch.from_state(left.state()).counts.dtype == np.uint32
@@ -0,0 +1,126 @@
+from argparse import Namespace
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+pytest.importorskip("calvin_utils")
+
+from calvin_utils.vbm_utils.processing import get_tiv
+from run_z_scoring import (ANALYSES, COMPOSITE_TISSUES, _glob_map, _score_block, _segments_from_maps, bids_output_path,
+                           fused_z_kernel, stream_precalc_z_scores)
+from segment_loading import REST_ROW, VOLUME_SUM, _load_dfs, _with_volume_rest, segment_tiv
+
+TISSUES = ("grey_matter", "white_matter", "cerebrospinal_fluid")
+SHAPE = (7, 6, 5)
+
+
+def _kernel_inputs(rng, n_voxels=500, n_subjects=6):
+    processed = {k: rng.normal(0.5, 0.2, (n_voxels, n_subjects)) for k in TISSUES}
+    stats = {k: (rng.normal(0.5, 0.05, n_voxels), rng.uniform(0.05, 0.15, n_voxels)) for k in TISSUES}
+    stats["composite"] = (rng.uniform(1, 2, n_voxels), rng.uniform(0.5, 1, n_voxels))
+    return processed, stats
+
+
+def _run_kernel(processed, stats, dtype):
+    processed = {k: v.astype(dtype) for k, v in processed.items()}
+    stats = {k: (m.astype(dtype), sd.astype(dtype)) for k, (m, sd) in stats.items()}
+    shape = next(iter(processed.values())).shape
+    z = {k: np.empty(shape, dtype=dtype) for k in [*processed, "composite"]}
+    thr = {k: np.empty(shape, dtype=dtype) for k in z}
+    fused_z_kernel(processed, stats, z, thr)
+    return z, thr
+
+
+def test_fused_z_kernel_float32_tracks_float64():
+    processed, stats = _kernel_inputs(np.random.default_rng(0))
+    z64, thr64 = _run_kernel(processed, stats, np.float64)
+    z32, thr32 = _run_kernel(processed, stats, np.float32)
+    cuts = {k: 2.0 if k == "cerebrospinal_fluid" else -2.0 for k in TISSUES}
+    cuts["composite"] = 0.0
+    for k in z64:
+        np.testing.assert_allclose(z32[k], z64[k], rtol=0, atol=1e-4)
+        clear = np.abs(z64[k] - cuts[k]) > 1e-3                         # float32 may land either side of the cut
+        np.testing.assert_allclose(thr32[k][clear], thr64[k][clear], rtol=0, atol=1e-4)
+    expected = np.sqrt(sum(z64[k] ** 2 for k in COMPOSITE_TISSUES))
+    np.testing.assert_allclose(z64["composite"], (expected - stats["composite"][0][:, None]) / stats["composite"][1][:, None])
+
+
+@pytest.fixture
+def segments(tmp_path):
+    rng = np.random.default_rng(1)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    nib.save(nib.Nifti1Image(mask, affine), tmp_path / "mask.nii.gz")
+    files = {}
+    for tissue in TISSUES:
+        files[tissue] = []
+        for sub in range(3):
+            path = tmp_path / f"sub-0{sub}_{tissue}.nii.gz"
+            nib.save(nib.Nifti1Image(rng.uniform(0, 1, SHAPE).astype(np.float32), affine), path)
+            files[tissue].append(path)
+    return files, np.flatnonzero(mask.ravel())
+
+
+def test_compressed_frames_match_full_grid(segments):
+    files, voxel_index = segments
+    full = _load_dfs(files, dtype=np.float64)
+    packed = _load_dfs(files, voxel_index, dtype=np.float64)
+    for k in TISSUES:
+        assert VOLUME_SUM not in full[k].attrs
+        np.testing.assert_array_equal(packed[k].index, voxel_index)
+        np.testing.assert_allclose(packed[k].to_numpy(), full[k].to_numpy()[voxel_index])
+        np.testing.assert_allclose(packed[k].attrs[VOLUME_SUM], full[k].sum(axis=0).to_numpy())
+    np.testing.assert_allclose(np.asarray(segment_tiv(packed), dtype=np.float64), np.asarray(get_tiv(full), dtype=np.float64))
+
+
+def test_rest_row_carries_the_out_of_mask_remainder(segments):
+    files, voxel_index = segments
+    full = _load_dfs(files, dtype=np.float64)
+    packed = _load_dfs(files, voxel_index, dtype=np.float64)
+    rested = _with_volume_rest(packed)
+    outside = np.setdiff1d(np.arange(np.prod(SHAPE)), voxel_index)
+    for k in TISSUES:
+        assert rested[k].index[-1] == REST_ROW and len(rested[k]) == len(voxel_index) + 1
+        np.testing.assert_allclose(rested[k].loc[REST_ROW].to_numpy(), full[k].to_numpy()[outside].sum(axis=0))
+        np.testing.assert_allclose(rested[k].sum(axis=0).to_numpy(), full[k].sum(axis=0).to_numpy())
+    np.testing.assert_allclose(np.asarray(get_tiv(rested), dtype=np.float64), np.asarray(get_tiv(full), dtype=np.float64))
+    assert _with_volume_rest(full) is full
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_streamed_blocks_and_chunks_match_one_shot(tmp_path, compress):
+    rng = np.random.default_rng(2)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    mask_path = tmp_path / "mask.nii.gz"
+    nib.save(nib.Nifti1Image(mask, affine), mask_path)
+    root = tmp_path / "data"
+    for sub in range(5):
+        mri = root / f"sub-0{sub}" / "ses-01" / "mri"
+        mri.mkdir(parents=True)
+        for t in (1, 2, 3):
+            nib.save(nib.Nifti1Image(rng.uniform(0.1, 1, SHAPE).astype(np.float32), affine), mri / f"mwp{t}_sub-0{sub}.nii.gz")
+    maps = [_glob_map(root, f"*/*/mri/mwp{t}*") for t in (1, 2, 3)]
+    subjects = sorted(maps[0])
+    voxel_index = np.flatnonzero(mask.ravel()) if compress else None
+    n_rows = len(voxel_index) if compress else mask.size
+    stats = {k: (rng.uniform(0, 0.1, n_rows), rng.uniform(0.05, 0.1, n_rows)) for k in TISSUES}
+    stats["composite"] = (rng.uniform(1, 2, n_rows), rng.uniform(0.5, 1, n_rows))
+
+    args = Namespace(dtype="float64", mask_path=mask_path, sparse_thresholded=None, write_workers=2, subject_block=2,
+                     io_workers=1, io_backend="thread", voxel_chunk=37, kernel="fused", experiments_root=root,
+                     session="ses-01", w_pack=None)
+    assert len(subjects) % args.subject_block and n_rows % args.voxel_chunk   # uneven tail block and tail chunk
+    stream_precalc_z_scores(args, *maps, subjects, lambda batch, segments, dtype: stats, voxel_index)
+
+    segments = _segments_from_maps(*maps, subjects, voxel_index, dtype=np.float64)
+    one_shot = _score_block(segments, stats, n_rows, np.float64)
+    for analysis, arrays in zip(ANALYSES, one_shot):
+        for k, expected in arrays.items():
+            for j, src in enumerate(segments["grey_matter"].columns):
+                written = nib.load(bids_output_path(root, src, analysis, k)).get_fdata().ravel()
+                np.testing.assert_allclose(written if voxel_index is None else written[voxel_index], expected[:, j],
+                                           rtol=1e-12, atol=1e-12)
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from sparse_store import SparseStore
+
+SHAPE = (4, 3, 2)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SparseStore(tmp_path / "store", SHAPE, np.eye(4), "thresholded_tissue_segment_z_scores")
+    maps = np.zeros((int(np.prod(SHAPE)), 2), dtype=np.float32)
+    maps[[1, 5], 0] = -2.5
+    maps[7, 1] = -3.0
+    store.append(["sub-01/ses-01", "sub-02/ses-01"], ["a.nii.gz", "b.nii.gz"], {"grey_matter": maps})
+    return store
+
+
+def test_densify_round_trips(store):
+    img = store.densify("sub-01/ses-01", "grey_matter")
+    assert img.shape == SHAPE
+    np.testing.assert_array_equal(np.flatnonzero(img.get_fdata().ravel()), [1, 5])
+
+
+def test_unknown_subject_or_tissue_names_the_store(store):
+    with pytest.raises(ValueError, match="sub-09/ses-01") as err:
+        store.densify("sub-09/ses-01", "grey_matter")
+    assert str(store.path) in str(err.value)
+    with pytest.raises(ValueError, match="white_matter"):
+        store.densify("sub-01/ses-01", "white_matter")
@@ -0,0 +1,22 @@
+import numpy as np
+
+from w_scoring import NormalEquations, design_matrix
+
+
+def test_merged_shard_equations_solve_like_one_fit():
+    rng = np.random.default_rng(0)
+    X = design_matrix(rng.uniform(50, 80, (12, 1)), tiv=rng.uniform(1200, 1600, 12))
+    Y = rng.normal(0.5, 0.1, (30, 12))
+    Y[4, [1, 7]] = np.nan                                                # skipped subjects in both shards
+    one = NormalEquations(X.shape[1], len(Y))
+    one.update(X, Y)
+    shards = []
+    for rows in (slice(0, 5), slice(5, 12)):
+        eq = NormalEquations(X.shape[1], len(Y))
+        eq.update(X[rows], Y[:, rows])
+        shards.append(NormalEquations.from_state(eq.state()))
+    merged = NormalEquations(X.shape[1], len(Y))
+    for eq in shards:
+        merged.merge(eq)
+    for got, want in zip(merged.solve(), one.solve()):
+        np.testing.assert_allclose(got, want, rtol=1e-9)